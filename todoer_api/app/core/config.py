@@ -3,7 +3,7 @@ from logging.config import dictConfig
 import logging
 
 from pydantic import AnyHttpUrl, BaseSettings, EmailStr, validator
-from typing import List, Optional, Union
+from typing import Any, Dict, List, Optional, Union
 
 
 class LogConfig(BaseModel):
@@ -36,8 +36,15 @@ class LogConfig(BaseModel):
     }
 
 
+_logging_configured = False
+
+
 def get_logger(name: str):
-    dictConfig(LogConfig().dict())
+    # configured by the first caller, every module asks for its logger at import
+    global _logging_configured
+    if not _logging_configured:
+        dictConfig(LogConfig().dict())
+        _logging_configured = True
     return logging.getLogger("todoer")
 
 
@@ -60,6 +67,98 @@ class Settings(BaseSettings):
     SQLALCHEMY_DATABASE_URI: Optional[str] = "sqlite:///example.db"
     FIRST_SUPERUSER: EmailStr = "todd.coops@gmail.com"
 
+    # mongo connection, one client per process is shared by all users of the settings
+    MONGO_USERNAME: str = "localdev"
+    MONGO_PASSWORD: str = "localdev"
+    MONGO_HOST: str = "mongo"
+    MONGO_PORT: int = 27017
+    MONGO_MAX_POOL_SIZE: int = 100
+    MONGO_MIN_POOL_SIZE: int = 0
+    MONGO_MAX_IDLE_TIME_MS: Optional[int] = None
+    MONGO_WAIT_QUEUE_TIMEOUT_MS: Optional[int] = None
+    # wire compression, comma separated in order of preference e.g. "zstd,snappy,zlib"
+    # the server picks the first it supports, zstd needs zstandard and snappy python-snappy
+    MONGO_COMPRESSORS: Optional[str] = None
+    # -1 (default) to 9, only used with zlib
+    MONGO_ZLIB_COMPRESSION_LEVEL: Optional[int] = None
+    MONGO_READ_PREFERENCE: str = "primary"
+    # e.g. "majority" or "1"
+    MONGO_WRITE_CONCERN: Optional[str] = None
+
+    def mongo_client_options(self) -> Dict[str, Any]:
+        """Keyword arguments for the mongo client, unset options use the driver default."""
+        options = {
+            "maxPoolSize": self.MONGO_MAX_POOL_SIZE,
+            "minPoolSize": self.MONGO_MIN_POOL_SIZE,
+            "maxIdleTimeMS": self.MONGO_MAX_IDLE_TIME_MS,
+            "waitQueueTimeoutMS": self.MONGO_WAIT_QUEUE_TIMEOUT_MS,
+            "compressors": self.MONGO_COMPRESSORS,
+            "zlibCompressionLevel": self.MONGO_ZLIB_COMPRESSION_LEVEL,
+            "readPreference": self.MONGO_READ_PREFERENCE,
+        }
+        if self.MONGO_WRITE_CONCERN is not None:
+            w = self.MONGO_WRITE_CONCERN
+            options["w"] = int(w) if w.isdigit() else w
+        return {name: val for name, val in options.items() if val is not None}
+
+    # backend of the API, "mongo-data-obj-mgr" or "in-memory-data-obj-mgr" which keeps the
+    # tasks in each worker's memory, for load tests and CI without mongo
+    DATABASE_TYPE: str = "mongo-data-obj-mgr"
+    # "server" returns stored documents from the write, "local" the validated model
+    CRUD_RETURN_MODE: str = "server"
+    # skip validating documents read back from the DB, they were validated when written
+    TRUSTED_READS: bool = False
+    # "mongo" takes one id per task from the counter, "mongo-leased" leases blocks of
+    # ID_BLOCK_SIZE per worker and returns the unused ids at shutdown if it can
+    ID_GENERATOR: str = "mongo"
+    ID_BLOCK_SIZE: int = 100
+    ID_RELEASE_ON_SHUTDOWN: bool = True
+    # per worker cache of tasks by id and key, size 0 disables it. Writes made by other
+    # workers are only seen once the entry expires so reads can be stale up to TTL seconds
+    TASK_CACHE_SIZE: int = 1024
+    TASK_CACHE_TTL: float = 5.0
+    # per worker cache of /tasks/stats results, 0 disables it
+    TASK_STATS_TTL: float = 10.0
+    # watch the tasks for writes by other processes, to invalidate the caches and feed
+    # /tasks/events. Polls every CHANGE_FEED_POLL_INTERVAL seconds without a replica set
+    CHANGE_FEED: bool = True
+    CHANGE_FEED_POLL_INTERVAL: float = 1.0
+    CHANGE_FEED_QUEUE_SIZE: int = 100
+    # set per worker by gunicorn_conf.py, the same for the worker started in the place of
+    # one that exited, so its change feed resumes from the saved position
+    WORKER_SLOT: Optional[int] = None
+    # at startup open MONGO_MIN_POOL_SIZE connections, ensure the indexes and run a trial
+    # query. Startup waits for it up to WARM_UP_TIMEOUT seconds, keep it below the startup
+    # timeout of the server or harness (5s for asgi-lifespan), after that
+    # /todoer/api/v1/ready is 503 until it is done. While mongo is unavailable the warm-up
+    # is retried every WARM_UP_RETRY_INTERVAL seconds
+    WARM_UP_TIMEOUT: float = 3.0
+    WARM_UP_RETRY_INTERVAL: float = 5.0
+    # request and DB op metrics at /todoer/admin/v1/metrics. Under gunicorn set METRICS_DIR
+    # to a directory shared by the workers (e.g. /dev/shm/todoer-metrics) to aggregate them
+    METRICS_ENABLED: bool = True
+    METRICS_DIR: Optional[str] = None
+    METRICS_FLUSH_INTERVAL: float = 5.0
+    # a span per request with its dependencies, CRUD calls and mongo commands, summarised in
+    # the Server-Timing header. TRACE_EXPORT is "stdout" or a file to append OTLP JSON lines to
+    TRACING_ENABLED: bool = True
+    TRACE_EXPORT: Optional[str] = None
+    # CPU profiles of requests, switched on at /todoer/admin/v1/profile/config. Under gunicorn
+    # set PROFILE_DIR to a directory shared by the workers (e.g. /dev/shm/todoer-profile)
+    PROFILE_DIR: Optional[str] = None
+    PROFILE_SYNC_INTERVAL: float = 2.0
+    # reads and writes taking at least SLOW_OP_MS are logged with the shape of their filter,
+    # the last SLOW_OP_LOG_SIZE per worker are at /todoer/admin/v1/slow-ops. Unset disables it.
+    # SLOW_OP_EXPLAIN adds the query plan from explain(), run after the operation
+    SLOW_OP_MS: Optional[float] = 100.0
+    SLOW_OP_LOG_SIZE: int = 100
+    SLOW_OP_EXPLAIN: bool = False
+    # redis cache of task and list page JSON shared by all workers, unset disables it
+    # e.g. redis://redis:6379/0 for docker-compose
+    REDIS_URL: Optional[str] = None
+    REDIS_MAX_CONNECTIONS: int = 20
+    SHARED_CACHE_TTL: int = 60
+
     class Config:
         case_sensitive = True
 
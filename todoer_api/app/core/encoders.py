@@ -0,0 +1,41 @@
+""" JSON encoding of raw BSON documents, matching how the API serialises the pydantic models.
+
+orjson is used when installed (it encodes datetimes natively), otherwise the stdlib json.
+"""
+
+import datetime as dt
+import json
+from typing import Any
+from bson import ObjectId
+
+try:
+    import orjson
+except ImportError:  # optional dependency
+    orjson = None
+
+
+def bson_default(obj: Any) -> Any:
+    """Encode the BSON types json does not know, as jsonable_encoder does for the models."""
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, (dt.datetime, dt.date)):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _orjson_dumps(obj: Any) -> bytes:
+    return orjson.dumps(obj, default=bson_default)
+
+
+def _json_dumps(obj: Any) -> bytes:
+    # the output of orjson and JSONResponse, UTF-8 not \u escapes and no NaN
+    return json.dumps(
+        obj,
+        default=bson_default,
+        ensure_ascii=False,
+        allow_nan=False,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+dumps = _json_dumps if orjson is None else _orjson_dumps
@@ -0,0 +1,298 @@
+""" Request and DB operation metrics in the Prometheus text format.
+
+Each process records into its own registry, no locks are taken across processes. Under
+gunicorn each worker writes a snapshot to <METRICS_DIR>/metrics_<pid>.json every
+METRICS_FLUSH_INTERVAL seconds and the worker serving /metrics merges all the snapshots.
+When a worker exits gunicorn's child_exit hook calls mark_process_dead, which folds its
+counts into metrics_dead.json and drops its in-flight gauges.
+
+Only the standard library is used so gunicorn_conf.py can import it in the arbiter.
+"""
+
+import asyncio
+import functools
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from app.core.routes import route_path
+from app.core.tracing import tracer
+
+# upper bounds in seconds, +Inf is implied
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+SNAPSHOT_PREFIX = "metrics_"
+DEAD_SNAPSHOT = "metrics_dead.json"
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Metrics:
+    """Counters, gauges and histograms keyed by name and labels."""
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        self.gauges: Dict[Tuple[str, Labels], float] = {}
+        # name, labels -> [count per bucket..., count, sum]
+        self.histograms: Dict[Tuple[str, Labels], List[float]] = {}
+        self._flusher: Optional[asyncio.Task] = None
+
+    def inc(self, name: str, labels: Labels, amount: float = 1) -> None:
+        with self._lock:
+            self.counters[(name, labels)] = (
+                self.counters.get((name, labels), 0) + amount
+            )
+
+    def add_gauge(self, name: str, labels: Labels, delta: float) -> None:
+        with self._lock:
+            self.gauges[(name, labels)] = self.gauges.get((name, labels), 0) + delta
+
+    def observe(self, name: str, labels: Labels, value: float) -> None:
+        with self._lock:
+            hist = self.histograms.get((name, labels))
+            if hist is None:
+                hist = self.histograms[(name, labels)] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    hist[i] += 1
+                    break
+            hist[-2] += 1
+            hist[-1] += value
+
+    def clear(self) -> None:
+        with self._lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """The metrics as JSON compatible data, see merge_snapshots."""
+        with self._lock:
+            return {
+                "buckets": list(self.buckets),
+                "counters": [[n, list(l), v] for (n, l), v in self.counters.items()],
+                "gauges": [[n, list(l), v] for (n, l), v in self.gauges.items()],
+                "histograms": [
+                    [n, list(l), list(v)] for (n, l), v in self.histograms.items()
+                ],
+            }
+
+    # region multiprocess
+
+    def write_snapshot(self, metrics_dir: str) -> None:
+        path = Path(metrics_dir) / f"{SNAPSHOT_PREFIX}{os.getpid()}.json"
+        _write_json(path, self.snapshot())
+
+    def collect(self, metrics_dir: Optional[str] = None) -> Dict[str, Any]:
+        """This process' snapshot, merged with those of the other workers if there is a dir."""
+        if metrics_dir is None:
+            return self.snapshot()
+        self.write_snapshot(metrics_dir)
+        return merge_snapshots(read_snapshots(metrics_dir))
+
+    def start_flusher(self, metrics_dir: str, interval: float) -> None:
+        async def flush() -> None:
+            while True:
+                await asyncio.sleep(interval)
+                self.write_snapshot(metrics_dir)
+
+        Path(metrics_dir).mkdir(parents=True, exist_ok=True)
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(flush())
+
+    async def stop_flusher(self, metrics_dir: str) -> None:
+        if self._flusher is None:
+            return
+        self._flusher.cancel()
+        try:
+            await self._flusher
+        except asyncio.CancelledError:
+            pass
+        self._flusher = None
+        self.write_snapshot(metrics_dir)
+
+    # endregion
+
+
+def _write_json(path: Path, data: Any) -> None:
+    # readers never see a partly written file
+    tmp_path = path.with_suffix(f".tmp{os.getpid()}")
+    tmp_path.write_text(json.dumps(data))
+    os.replace(tmp_path, path)
+
+
+def read_snapshots(metrics_dir: str) -> List[Dict[str, Any]]:
+    snapshots = []
+    for path in Path(metrics_dir).glob(f"{SNAPSHOT_PREFIX}*.json"):
+        try:
+            snapshots.append(json.loads(path.read_text()))
+        except (OSError, ValueError):
+            # removed by child_exit or being replaced, it is read next time
+            continue
+    return snapshots
+
+
+def merge_snapshots(snapshots: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+    """Sums the snapshots of several processes, histograms must share their buckets."""
+    merged: Dict[str, Dict[Tuple, Any]] = {
+        "counters": {},
+        "gauges": {},
+        "histograms": {},
+    }
+    buckets: List[float] = list(DEFAULT_BUCKETS)
+    for snapshot in snapshots:
+        buckets = snapshot.get("buckets", buckets)
+        for kind in ("counters", "gauges"):
+            for name, labels, value in snapshot.get(kind, []):
+                key = (name, tuple(map(tuple, labels)))
+                merged[kind][key] = merged[kind].get(key, 0) + value
+        for name, labels, values in snapshot.get("histograms", []):
+            key = (name, tuple(map(tuple, labels)))
+            total = merged["histograms"].get(key)
+            merged["histograms"][key] = (
+                values if total is None else [a + b for a, b in zip(total, values)]
+            )
+    return {
+        "buckets": buckets,
+        **{
+            kind: [[n, [list(p) for p in l], v] for (n, l), v in values.items()]
+            for kind, values in merged.items()
+        },
+    }
+
+
+def mark_process_dead(pid: int, metrics_dir: Optional[str]) -> None:
+    """Folds the counts of an exited worker into the dead snapshot, its gauges are dropped."""
+    if not metrics_dir:
+        return
+    path = Path(metrics_dir) / f"{SNAPSHOT_PREFIX}{pid}.json"
+    try:
+        snapshot = json.loads(path.read_text())
+    except (OSError, ValueError):
+        return
+    snapshot["gauges"] = []
+    dead_path = Path(metrics_dir) / DEAD_SNAPSHOT
+    snapshots = [snapshot]
+    if dead_path.exists():
+        snapshots.append(json.loads(dead_path.read_text()))
+    _write_json(dead_path, merge_snapshots(snapshots))
+    path.unlink()
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Iterable[Iterable[str]], **extra: str) -> str:
+    pairs = [*labels, *extra.items()]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def render(snapshot: Dict[str, Any]) -> str:
+    """The snapshot in the Prometheus text exposition format."""
+    lines: List[str] = []
+    typed = set()
+
+    def type_line(name: str, kind: str) -> None:
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} {kind}")
+
+    for kind, prom_type in (("counters", "counter"), ("gauges", "gauge")):
+        for name, labels, value in sorted(snapshot[kind]):
+            type_line(name, prom_type)
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+    buckets = snapshot["buckets"]
+    for name, labels, values in sorted(snapshot["histograms"]):
+        type_line(name, "histogram")
+        cumulative = 0
+        for bound, count in zip(buckets, values):
+            cumulative += count
+            lines.append(
+                f"{name}_bucket{_format_labels(labels, le=str(bound))} {cumulative}"
+            )
+        lines.append(f'{name}_bucket{_format_labels(labels, le="+Inf")} {values[-2]}')
+        lines.append(f"{name}_count{_format_labels(labels)} {values[-2]}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {values[-1]}")
+    return "\n".join(lines) + "\n"
+
+
+# one per process shared by the middleware and the data layer
+metrics = Metrics()
+
+
+def _doc_count(result: Any) -> int:
+    if result is None:
+        return 0
+    if isinstance(result, tuple):
+        # a page and its cursor
+        result = result[0]
+    if isinstance(result, list):
+        return len(result)
+    return 1
+
+
+def record_db_op(func: Callable) -> Callable:
+    """Records the latency, errors and documents returned of an async CRUD method, labelled
+    by the CRUD class and method name, and runs it in a span of the request's trace."""
+    op = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        model = type(self).__name__
+        labels = (("model", model), ("op", op))
+        start = time.perf_counter()
+        try:
+            with tracer.span(f"{model}.{op}", "crud"):
+                result = await func(self, *args, **kwargs)
+        except Exception:
+            metrics.inc("todoer_db_op_errors_total", labels)
+            raise
+        finally:
+            metrics.observe(
+                "todoer_db_op_duration_seconds", labels, time.perf_counter() - start
+            )
+        metrics.inc("todoer_db_op_documents_total", labels, _doc_count(result))
+        return result
+
+    return wrapper
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording the latency, status and in-flight count of each request,
+    labelled by the route's path template so task keys do not create new series."""
+
+    def __init__(self, app: Callable) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Dict, receive: Callable, send: Callable) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        method = scope["method"]
+        status_code = 500
+
+        async def send_status(message: Dict) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        in_flight = (("method", method),)
+        metrics.add_gauge("todoer_http_requests_in_flight", in_flight, 1)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.add_gauge("todoer_http_requests_in_flight", in_flight, -1)
+            route = (("method", method), ("route", route_path(scope)))
+            metrics.observe("todoer_http_request_duration_seconds", route, elapsed)
+            metrics.inc(
+                "todoer_http_requests_total", route + (("status", str(status_code)),)
+            )
@@ -0,0 +1,297 @@
+""" CPU profiles of live requests, switched on at runtime from the admin API.
+
+A request is profiled if it is picked at the sample rate, or if it has the X-Profile header
+and header profiling is on. In "sampling" mode a thread reads the event loop thread's stack
+every interval_ms while the loop is running a profiled request's task, giving flamegraph
+collapsed stacks. Work the request hands to the thread pool is not seen. In "cprofile" mode
+cProfile runs while any profiled request is in flight, so it also counts other requests
+served meanwhile, giving pstats. "cprofile" is used when stack sampling is not available.
+
+Under gunicorn set PROFILE_DIR to a directory shared by the workers. The config set through
+any worker is written there and picked up by the others every PROFILE_SYNC_INTERVAL seconds,
+and each worker writes its profile there to be merged by the worker serving the profile.
+"""
+
+import asyncio
+import cProfile
+import io
+import json
+import marshal
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from types import FrameType
+from typing import Callable, Dict, List, Optional, Set
+from pydantic import BaseModel, Field
+from app.core.config import get_logger
+
+logger = get_logger("profiler")
+
+PROFILE_HEADER = b"x-profile"
+CONFIG_FILE = "profile_config.json"
+PROFILE_PREFIX = "profile_"
+SAMPLING_AVAILABLE = hasattr(sys, "_current_frames")
+
+
+class ProfileConfig(BaseModel):
+    # fraction of requests profiled, 0 for none
+    sample_rate: float = Field(0.0, ge=0.0, le=1.0)
+    # profile requests with the X-Profile header
+    header: bool = False
+    mode: str = Field("sampling", regex="^(sampling|cprofile)$")
+    interval_ms: float = Field(5.0, gt=0.0)
+
+
+def _frame_label(frame: FrameType) -> str:
+    code = frame.f_code
+    path = "/".join(Path(code.co_filename).parts[-2:])
+    return f"{code.co_name} ({path}:{code.co_firstlineno})"
+
+
+def collapse_stack(frame: Optional[FrameType]) -> str:
+    """The stack of the frame root first, as a line of flamegraph collapsed stacks."""
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+def _write_atomic(path: Path, write: Callable[[Path], None]) -> None:
+    # readers never see a partly written file
+    tmp_path = path.with_suffix(f".tmp{os.getpid()}")
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+class Profiler:
+    """Profiles the requests picked by the config, the profile builds up until reset."""
+
+    def __init__(self) -> None:
+        self.config = ProfileConfig()
+        # bumped by reset, workers reset when the shared config has a new generation
+        self.generation = 0
+        self.stacks: Counter = Counter()
+        self._cprofile: Optional[cProfile.Profile] = None
+        self._tasks: Set[asyncio.Task] = set()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._sampler: Optional[threading.Thread] = None
+        self._sampling = threading.Event()
+        self._lock = threading.Lock()
+        self._config_mtime = 0.0
+        self._sync: Optional[asyncio.Task] = None
+
+    @property
+    def mode(self) -> str:
+        return self.config.mode if SAMPLING_AVAILABLE else "cprofile"
+
+    def set_config(self, config: ProfileConfig) -> None:
+        self.config = config
+
+    def reset(self) -> None:
+        with self._lock:
+            self.stacks.clear()
+        if not self._tasks:
+            self._cprofile = None
+
+    def should_profile(self, scope: Dict) -> bool:
+        config = self.config
+        if config.sample_rate > 0 and random.random() < config.sample_rate:
+            return True
+        return config.header and any(
+            name == PROFILE_HEADER for name, _ in scope.get("headers", [])
+        )
+
+    # region collection
+
+    def start_request(self) -> None:
+        """Profile the current task until end_request, called on the event loop thread."""
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        if self.mode == "cprofile":
+            if len(self._tasks) == 1:
+                if self._cprofile is None:
+                    self._cprofile = cProfile.Profile()
+                self._cprofile.enable()
+            return
+        if self._sampler is None:
+            self._loop = asyncio.get_running_loop()
+            self._loop_thread_id = threading.get_ident()
+            self._sampler = threading.Thread(
+                target=self._sample, name="profiler", daemon=True
+            )
+            self._sampler.start()
+        self._sampling.set()
+
+    def end_request(self) -> None:
+        self._tasks.discard(asyncio.current_task())
+        if self._tasks:
+            return
+        self._sampling.clear()
+        if self._cprofile is not None:
+            self._cprofile.disable()
+
+    def _sample(self) -> None:
+        while True:
+            self._sampling.wait()
+            time.sleep(self.config.interval_ms / 1000)
+            # only while the loop is running a profiled task, not other requests
+            if asyncio.current_task(self._loop) not in self._tasks:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is not None:
+                stack = collapse_stack(frame)
+                with self._lock:
+                    self.stacks[stack] += 1
+
+    # endregion
+
+    # region output
+
+    def collapsed(self, profile_dir: Optional[str] = None) -> str:
+        """Flamegraph collapsed stacks of this worker, and the others if there is a dir."""
+        with self._lock:
+            stacks = Counter(self.stacks)
+        if profile_dir is not None:
+            self.write(profile_dir)
+            stacks = Counter()
+            for path in Path(profile_dir).glob(f"{PROFILE_PREFIX}*.collapsed"):
+                stacks.update(_read_collapsed(path))
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+    def pstats(self, profile_dir: Optional[str] = None, limit: int = 50) -> str:
+        """The top functions by cumulative time as pstats prints them."""
+        stream = io.StringIO()
+        stats = pstats.Stats(stream=stream)
+        if profile_dir is not None:
+            self.write(profile_dir)
+            for path in Path(profile_dir).glob(f"{PROFILE_PREFIX}*.prof"):
+                stats.add(str(path))
+        elif self._cprofile is not None and not self._tasks:
+            stats.add(self._cprofile)
+        if not stats.stats:
+            return "No cProfile data\n"
+        stats.sort_stats("cumulative").print_stats(limit)
+        return stream.getvalue()
+
+    # endregion
+
+    # region multiprocess
+
+    def write(self, profile_dir: str) -> None:
+        """Writes this worker's profile for the others to read."""
+        base = Path(profile_dir) / f"{PROFILE_PREFIX}{os.getpid()}"
+        with self._lock:
+            lines = "".join(
+                f"{stack} {count}\n" for stack, count in self.stacks.items()
+            )
+        _write_atomic(base.with_suffix(".collapsed"), lambda p: p.write_text(lines))
+        # stats can not be taken while profiling, they are written next time
+        if self._cprofile is not None and not self._tasks:
+            self._cprofile.create_stats()
+            stats = self._cprofile.stats
+            _write_atomic(
+                base.with_suffix(".prof"), lambda p: p.write_bytes(marshal.dumps(stats))
+            )
+
+    def save_config(self, profile_dir: Optional[str], reset: bool = False) -> None:
+        """Shares the config with the other workers, reset clears every worker's profile."""
+        if reset:
+            self.generation += 1
+            self.reset()
+        if profile_dir is None:
+            return
+        if reset:
+            # not the other workers' temporary files, about to be moved into place
+            for suffix in ("collapsed", "prof"):
+                for path in Path(profile_dir).glob(f"{PROFILE_PREFIX}*.{suffix}"):
+                    path.unlink(missing_ok=True)
+        data = {"generation": self.generation, "config": self.config.dict()}
+        _write_atomic(
+            Path(profile_dir) / CONFIG_FILE, lambda p: p.write_text(json.dumps(data))
+        )
+
+    def load_config(self, profile_dir: str) -> None:
+        """Applies the shared config if it changed since last loaded."""
+        path = Path(profile_dir) / CONFIG_FILE
+        try:
+            mtime = path.stat().st_mtime
+            if mtime == self._config_mtime:
+                return
+            data = json.loads(path.read_text())
+        except (OSError, ValueError):
+            return
+        self._config_mtime = mtime
+        self.set_config(ProfileConfig(**data["config"]))
+        if data["generation"] != self.generation:
+            self.generation = data["generation"]
+            self.reset()
+
+    def start_sync(self, profile_dir: str, interval: float) -> None:
+        async def sync() -> None:
+            while True:
+                await asyncio.sleep(interval)
+                self.load_config(profile_dir)
+                try:
+                    self.write(profile_dir)
+                except OSError as exc:
+                    logger.warning(f"profile not written to {profile_dir} {exc}")
+
+        Path(profile_dir).mkdir(parents=True, exist_ok=True)
+        self.load_config(profile_dir)
+        if self._sync is None:
+            self._sync = asyncio.create_task(sync())
+
+    async def stop_sync(self, profile_dir: str) -> None:
+        if self._sync is None:
+            return
+        self._sync.cancel()
+        try:
+            await self._sync
+        except asyncio.CancelledError:
+            pass
+        self._sync = None
+        self.write(profile_dir)
+
+    # endregion
+
+
+def _read_collapsed(path: Path) -> Dict[str, int]:
+    stacks: Dict[str, int] = {}
+    try:
+        lines: List[str] = path.read_text().splitlines()
+    except OSError:
+        # removed by a reset
+        return stacks
+    for line in lines:
+        stack, _, count = line.rpartition(" ")
+        if stack:
+            stacks[stack] = stacks.get(stack, 0) + int(count)
+    return stacks
+
+
+# one per process shared by the middleware and the admin endpoints
+profiler = Profiler()
+
+
+class ProfilerMiddleware:
+    """ASGI middleware profiling the requests the profiler's config picks."""
+
+    def __init__(self, app: Callable) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Dict, receive: Callable, send: Callable) -> None:
+        if scope["type"] != "http" or not profiler.should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+        profiler.start_request()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            profiler.end_request()
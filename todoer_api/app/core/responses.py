@@ -0,0 +1,12 @@
+""" Response classes for the API. """
+
+from typing import Any
+from fastapi.responses import JSONResponse
+from app.core.encoders import dumps
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson when available, also encodes ObjectId and datetime."""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
@@ -0,0 +1,23 @@
+""" Path templates of the routes, to label requests without the values of path parameters. """
+
+from typing import Any, Callable, Dict
+from weakref import WeakKeyDictionary
+
+UNMATCHED = "unmatched"
+
+_route_paths: "WeakKeyDictionary[Any, Dict[Callable, str]]" = WeakKeyDictionary()
+
+
+def route_path(scope: Dict) -> str:
+    """The path template of the route that served the request e.g. /tasks/{task_key}, or
+    "unmatched" when no route did. Only known once the router has handled the request."""
+    app = scope["app"]
+    paths = _route_paths.get(app)
+    if paths is None:
+        # routes are all added before the first request is served
+        paths = _route_paths[app] = {
+            route.endpoint: route.path
+            for route in app.router.routes
+            if hasattr(route, "endpoint")
+        }
+    return paths.get(scope.get("endpoint"), UNMATCHED)
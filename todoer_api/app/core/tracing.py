@@ -0,0 +1,325 @@
+""" Request tracing, a span per request with child spans for dependencies, CRUD calls and
+mongo commands.
+
+The current span is held in a context variable so a child span finds its parent without it
+being passed down. Starlette copies the context into the thread pool for sync dependencies
+and Motor does the same for the driver calls, so spans opened there join the request's trace.
+Spans opened outside a request, e.g. at startup, are not recorded.
+
+When the request span ends its trace is given to each exporter: InMemoryExporter keeps the
+last traces for tests, JsonLinesExporter writes each trace as an OTLP JSON line, the format
+of the OpenTelemetry collector's otlpjsonfile receiver.
+
+Only the standard library is used so gunicorn_conf.py can import the metrics module.
+"""
+
+import asyncio
+import functools
+import json
+import random
+import sys
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import IO, Any, Callable, Deque, Dict, Iterator, List, Optional
+from app.core.routes import route_path
+
+# categories summed in the Server-Timing header, in header order
+TIMING_CATEGORIES = ("dependency", "crud", "mongo")
+# OTLP span kinds
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+_SPAN_KINDS = {"request": SPAN_KIND_SERVER, "mongo": SPAN_KIND_CLIENT}
+
+
+class Trace:
+    """The spans of one request, appended as they end."""
+
+    def __init__(self) -> None:
+        self.trace_id = f"{random.getrandbits(128):032x}"
+        self.spans: List["Span"] = []
+
+
+class Span:
+    __slots__ = (
+        "trace",
+        "name",
+        "category",
+        "span_id",
+        "parent_id",
+        "start_ns",
+        "end_ns",
+        "attributes",
+        "error",
+    )
+
+    def __init__(
+        self,
+        trace: Trace,
+        name: str,
+        category: str,
+        parent_id: Optional[str] = None,
+        attributes: Optional[Dict[str, Any]] = None,
+        start_ns: Optional[int] = None,
+    ) -> None:
+        self.trace = trace
+        self.name = name
+        self.category = category
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns() if start_ns is None else start_ns
+        self.end_ns: Optional[int] = None
+        self.attributes = attributes or {}
+        self.error: Optional[str] = None
+
+    @property
+    def duration_ms(self) -> float:
+        end_ns = time.time_ns() if self.end_ns is None else self.end_ns
+        return (end_ns - self.start_ns) / 1e6
+
+    def end(self, end_ns: Optional[int] = None) -> None:
+        self.end_ns = time.time_ns() if end_ns is None else end_ns
+        # list.append is atomic, spans of driver threads end here too
+        self.trace.spans.append(self)
+
+    def to_otlp(self) -> Dict[str, Any]:
+        otlp = {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": _SPAN_KINDS.get(self.category, SPAN_KIND_INTERNAL),
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns),
+            "attributes": [
+                {"key": key, "value": _otlp_value(value)}
+                for key, value in {
+                    "todoer.category": self.category,
+                    **self.attributes,
+                }.items()
+            ],
+        }
+        if self.parent_id is not None:
+            otlp["parentSpanId"] = self.parent_id
+        if self.error is not None:
+            otlp["status"] = {"code": 2, "message": self.error}
+        return otlp
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        # int64 is a string in OTLP JSON
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("todoer_span", default=None)
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+# region exporters
+
+
+class InMemoryExporter:
+    """Keeps the spans of the last max_traces traces, for tests."""
+
+    def __init__(self, max_traces: int = 100) -> None:
+        self.traces: Deque[List[Span]] = deque(maxlen=max_traces)
+
+    def export(self, spans: List[Span]) -> None:
+        self.traces.append(spans)
+
+    def clear(self) -> None:
+        self.traces.clear()
+
+
+class JsonLinesExporter:
+    """Writes each trace as an OTLP ExportTraceServiceRequest on one JSON line."""
+
+    def __init__(self, stream: IO[str], service_name: str = "todoer") -> None:
+        self.stream = stream
+        self.resource = {
+            "attributes": [
+                {"key": "service.name", "value": {"stringValue": service_name}}
+            ]
+        }
+
+    @classmethod
+    def from_target(cls, target: str, service_name: str = "todoer"):
+        """An exporter to stdout for "stdout", otherwise appending to the file path given."""
+        if target == "stdout":
+            return cls(sys.stdout, service_name)
+        # line buffered, several workers append whole lines to the same file
+        return cls(open(target, "a", buffering=1), service_name)
+
+    def export(self, spans: List[Span]) -> None:
+        request = {
+            "resourceSpans": [
+                {
+                    "resource": self.resource,
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": "todoer"},
+                            "spans": [span.to_otlp() for span in spans],
+                        }
+                    ],
+                }
+            ]
+        }
+        self.stream.write(json.dumps(request, separators=(",", ":")) + "\n")
+        self.stream.flush()
+
+
+# endregion exporters
+
+
+class Tracer:
+    """Opens spans in the current trace and hands finished traces to the exporters."""
+
+    def __init__(self, exporters: Optional[List[Any]] = None) -> None:
+        self.exporters: List[Any] = list(exporters or [])
+
+    @contextmanager
+    def trace(self, name: str, **attributes: Any) -> Iterator[Span]:
+        """Starts a new trace with a request span, exported when the span ends."""
+        root = Span(Trace(), name, "request", attributes=attributes)
+        token = _current_span.set(root)
+        try:
+            yield root
+        except Exception as exc:
+            root.error = repr(exc)
+            raise
+        finally:
+            _current_span.reset(token)
+            root.end()
+            for exporter in self.exporters:
+                exporter.export(root.trace.spans)
+
+    @contextmanager
+    def span(
+        self, name: str, category: str = "internal", **attributes: Any
+    ) -> Iterator[Optional[Span]]:
+        """A child of the current span, nothing is recorded outside a trace."""
+        parent = _current_span.get()
+        if parent is None:
+            yield None
+            return
+        span = Span(parent.trace, name, category, parent.span_id, attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except Exception as exc:
+            span.error = repr(exc)
+            raise
+        finally:
+            _current_span.reset(token)
+            span.end()
+
+    def record(
+        self,
+        parent: Span,
+        name: str,
+        category: str,
+        start_ns: int,
+        end_ns: int,
+        error: Optional[str] = None,
+        **attributes: Any,
+    ) -> Span:
+        """Adds an already finished span, for timings reported after the fact."""
+        span = Span(
+            parent.trace, name, category, parent.span_id, attributes, start_ns=start_ns
+        )
+        span.error = error
+        span.end(end_ns)
+        return span
+
+
+# one per process shared by the middleware, the data layer and the mongo listener
+tracer = Tracer()
+
+
+def traced(category: str, name: Optional[str] = None) -> Callable:
+    """Runs the sync or async function in a span, e.g. a dependency or CRUD method."""
+
+    def decorator(func: Callable) -> Callable:
+        span_name = name or func.__qualname__
+        if asyncio.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with tracer.span(span_name, category):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with tracer.span(span_name, category):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def server_timing(root: Span) -> str:
+    """The Server-Timing header value of the trace so far: the time in each category,
+    counting a span only if it is not inside another of the same category, and the
+    total time of the request so far as "app"."""
+    spans = {span.span_id: span for span in root.trace.spans}
+    totals: Dict[str, float] = {}
+    for span in root.trace.spans:
+        parent = spans.get(span.parent_id)
+        while parent is not None and parent.category != span.category:
+            parent = spans.get(parent.parent_id)
+        if parent is None:
+            totals[span.category] = totals.get(span.category, 0.0) + span.duration_ms
+    metrics = [
+        f"{category};dur={totals[category]:.3f}"
+        for category in TIMING_CATEGORIES
+        if category in totals
+    ]
+    metrics.append(f"app;dur={root.duration_ms:.3f}")
+    return ", ".join(metrics)
+
+
+class TracingMiddleware:
+    """ASGI middleware running each request in a trace and adding a Server-Timing header
+    with the time spent in dependencies, CRUD calls and mongo commands."""
+
+    def __init__(self, app: Callable) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Dict, receive: Callable, send: Callable) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        method = scope["method"]
+        with tracer.trace(
+            method, **{"http.method": method, "http.target": scope["path"]}
+        ) as root:
+
+            async def send_timing(message: Dict) -> None:
+                if message["type"] == "http.response.start":
+                    root.attributes["http.status_code"] = message["status"]
+                    headers = list(message.get("headers", []))
+                    headers.append(
+                        (b"server-timing", server_timing(root).encode("latin-1"))
+                    )
+                    message = {**message, "headers": headers}
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_timing)
+            finally:
+                route = route_path(scope)
+                root.name = f"{method} {route}"
+                root.attributes["http.route"] = route
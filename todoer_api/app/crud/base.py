@@ -1,11 +1,33 @@
 """ Generic class for CRUD operations for data persistence in a Mongo DB. """
-from typing import Any, Dict, Generic, List, Optional, Type, TypeVar, Union
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Generic,
+    List,
+    Optional,
+    Tuple,
+    Type,
+    TypeVar,
+    Union,
+)
+import copy
 import datetime as dt
+import time
 from fastapi.encoders import jsonable_encoder
 from pydantic import BaseModel
-from app.model.base import ObjectId
+from pymongo import ReturnDocument
+from app.model.base import ObjectId, now_ms
 from app.data_layer.mongo_connection import MongoCollection
-from re import S
+from app.data_layer.cache import TTLCache
+from app.data_layer.slow_ops import SlowOpLog
+from app.core.metrics import record_db_op
+from app.core.tracing import traced
+from app.data_layer.change_feed import ChangeEvent
+from app.crud.pagination import decode_cursor, encode_cursor, keyset_filter, sort_spec
+from app.data_layer.indexes import IndexSpec, IndexReport, check_indexes, ensure_indexes
 
 # from httpcore import ReadTimeout
 
@@ -14,21 +36,108 @@ ModelType = TypeVar("ModelType", bound=BaseModel)
 CreateSchemaType = TypeVar("CreateSchemaType", bound=BaseModel)
 UpdateSchemaType = TypeVar("UpdateSchemaType", bound=BaseModel)
 
+# how mutations build the object they return
+#   server - the document as stored, returned atomically by the write itself
+#   local  - the already validated model, no document is sent back by the server
+RETURN_MODES = ("server", "local")
+
 
 class CRUDMongoBase(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
     """Generic class to manage data obejct of type ModelType, with special types for create/update."""
 
-    def __init__(self, model: Type[ModelType], collection: MongoCollection):
+    # indexes the collection needs, ensured at startup
+    INDEXES: List[IndexSpec] = []
+    # fields with a unique index, pages sorted on them need no _id tie breaker
+    UNIQUE_FIELDS = {"_id"}
+
+    def __init__(
+        self,
+        model: Type[ModelType],
+        collection: MongoCollection,
+        return_mode: str = "server",
+        trusted_reads: bool = False,
+        cache: Optional[TTLCache] = None,
+        slow_ops: Optional[SlowOpLog] = None,
+    ):
         """
         CRUD object with default methods to Create, Read, Update, Delete (CRUD).
         **Parameters**
         * `model`: A SQLAlchemy model class
         * `schema`: A Pydantic model (schema) class
+        * `return_mode`: "server" or "local", see RETURN_MODES
+        * `trusted_reads`: build models from stored documents without validating them
+        * `cache`: read-through cache of documents by id and key, `None` to disable
+        * `slow_ops`: log of reads and writes slower than its threshold, `None` to disable
         """
+        if return_mode not in RETURN_MODES:
+            raise ValueError(f"Unknown return mode {return_mode}")
         self.model = model
         self.db_collection = collection
         self._collection = self.db_collection.get_collection()
+        self.return_mode = return_mode
+        self.trusted_reads = trusted_reads
+        self.cache = cache
+        self.slow_ops = slow_ops
+        # key names documents are cached under, to invalidate all entries of a document
+        self._cache_key_names = set()
+        # construct takes field names not aliases (e.g. _id -> id)
+        self._field_names = {
+            field.alias: name
+            for name, field in model.__fields__.items()
+            if field.alias != name
+        }
+
+    def _to_model(self, raw_obj: Optional[Dict]) -> Optional[ModelType]:
+        """Builds the model from a stored document, documents we wrote are not re-validated."""
+        if raw_obj is None:
+            return None
+        if self.trusted_reads:
+            # the document may be a cache entry, the model must not share its lists
+            return self.model.construct(
+                **{
+                    self._field_names.get(name, name): (
+                        copy.deepcopy(val) if isinstance(val, (list, dict)) else val
+                    )
+                    for name, val in raw_obj.items()
+                }
+            )
+        return self.model(**raw_obj)
+
+    def _check_slow(
+        self, op: str, start: float, filter: Any, docs: int, **details: Any
+    ) -> None:
+        """Logs the operation started at start (perf_counter) if it was slow.
+        **Parameters**
+        * `details`: sort, skip, limit and explain as for SlowOpLog.check
+        """
+        if self.slow_ops is not None:
+            self.slow_ops.check(
+                self._collection.name,
+                op,
+                time.perf_counter() - start,
+                filter,
+                docs,
+                **details,
+            )
+
+    def _explain_find(self, filter: Dict) -> Callable[[], Awaitable[Dict]]:
+        # the plan of a single document query on the filter, as run by find_one and updates
+        return lambda: self._collection.find(filter).limit(1).explain()
 
+    async def _find_one(self, filter: Dict) -> Optional[Dict]:
+        start = time.perf_counter()
+        raw_obj = await self._collection.find_one(filter)
+        self._check_slow(
+            "find_one",
+            start,
+            filter,
+            int(raw_obj is not None),
+            limit=1,
+            explain=self._explain_find(filter),
+        )
+        return raw_obj
+
+    @record_db_op
     async def get(self, id: ObjectId) -> Optional[ModelType]:
         """Returns an object given its ID or `None` if it does not exist.
         **Parameters**
@@ -36,9 +145,15 @@ class CRUDMongoBase(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
         **Returns**
         * `obj`: The object or `None` if it does not exist
         """
-        raw_obj = await self._collection.find_one({"_id": id})
-        return self.model(**raw_obj) if raw_obj is not None else None
+        raw_obj = await self._find_one_cached("_id", id)
+        return self._to_model(raw_obj)
+
+    @record_db_op
+    async def get_raw_by_key(self, key_name: str, key_value: Any) -> Optional[Dict]:
+        """As get_by_key but returns the stored document, for serialising straight to JSON."""
+        return await self._find_one_cached(key_name, key_value)
 
+    @record_db_op
     async def get_by_key(self, key_name: str, key_value: Any) -> Optional[ModelType]:
         """Returns an object given key value or `None` if it does not exist (assuming the key is unique).
         **Parameters**
@@ -46,8 +161,47 @@ class CRUDMongoBase(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
         **Returns**
         * `obj`: The object or `None` if it does not exist
         """
-        raw_obj = await self._collection.find_one({key_name: key_value})
-        return self.model(**raw_obj) if raw_obj is not None else None
+        raw_obj = await self._find_one_cached(key_name, key_value)
+        return self._to_model(raw_obj)
+
+    async def _find_one_cached(self, key_name: str, key_value: Any) -> Optional[Dict]:
+        """find_one on a unique key through the cache, the cached documents are not copied."""
+        if self.cache is None:
+            return await self._find_one({key_name: key_value})
+        cache_key = (key_name, key_value)
+        raw_obj = self.cache.get(cache_key)
+        if raw_obj is None:
+            raw_obj = await self._find_one({key_name: key_value})
+            if raw_obj is not None:
+                self._cache_key_names.add(key_name)
+                self.cache.set(cache_key, raw_obj)
+        return raw_obj
+
+    def invalidate(self, id: Any, raw_obj: Optional[Dict] = None) -> None:
+        """Drops the cached entries of an object.
+        **Parameters**
+        * `id`: The ID of the object
+        * `raw_obj`: The object as a dict with its keys, if not given the cache is searched
+        """
+        if self.cache is None:
+            return
+        if raw_obj is None:
+            raw_obj = next(
+                (cached for cached in self.cache.values() if cached["_id"] == id),
+                {"_id": id},
+            )
+        for key_name in self._cache_key_names:
+            if key_name in raw_obj:
+                self.cache.pop((key_name, raw_obj[key_name]))
+
+    async def apply_change(self, event: ChangeEvent) -> None:
+        """Drops the cached entries a change made by any process has made stale."""
+        if self.cache is None:
+            return
+        if event.id is None:
+            self.cache.clear()
+        else:
+            self.invalidate(event.id, event.document)
 
     async def get_all(
         self,
@@ -55,7 +209,8 @@ class CRUDMongoBase(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
         skip: int = 0,
         limit: int = 100,
         sort_field: str = None,
-        sort_ascending: bool = True
+        sort_ascending: bool = True,
+        projection: Optional[Dict[str, Any]] = None,
     ) -> List[ModelType]:
         return await self.filter_multi(
             {},
@@ -63,8 +218,10 @@ class CRUDMongoBase(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
             limit=limit,
             sort_field=sort_field,
             sort_ascending=sort_ascending,
+            projection=projection,
         )
 
+    @record_db_op
     async def filter_one(self, filter: Dict) -> Optional[ModelType]:
         """Returns an object given a filter or `None` if it does not exist.
         **Parameters**
@@ -75,9 +232,10 @@ class CRUDMongoBase(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
         """
         # CHECK: new method
 
-        raw_obj = await self._collection.find_one(filter)
-        return self.model(**raw_obj) if raw_obj is not None else None
+        raw_obj = await self._find_one(filter)
+        return self._to_model(raw_obj)
 
+    @record_db_op
     async def filter_multi(
         self,
         filter: Dict,
@@ -85,13 +243,32 @@ class CRUDMongoBase(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
         skip: int = 0,
         limit: int = 100,
         sort_field: str = None,
-        sort_ascending: bool = True
+        sort_ascending: bool = True,
+        projection: Optional[Dict[str, Any]] = None,
     ) -> List[ModelType]:
+        """Returns the objects matching the filter, a projection returns only some fields
+        which fails validation of required fields unless reads are trusted."""
         # 1 = ascending, -1 = descending
-        query = self._collection.find(filter, skip=skip, limit=limit)
+        start = time.perf_counter()
+        query = self._collection.find(
+            filter, projection=projection, skip=skip, limit=limit
+        )
+        sort = None
         if sort_field is not None:
-            query = query.sort(sort_field, 1 if sort_ascending else -1)
-        return [self.model(**raw_obj) async for raw_obj in query]
+            sort = [(sort_field, 1 if sort_ascending else -1)]
+            query = query.sort(sort)
+        raw_objs = [raw_obj async for raw_obj in query]
+        self._check_slow(
+            "find",
+            start,
+            filter,
+            len(raw_objs),
+            sort=sort,
+            skip=skip,
+            limit=limit,
+            explain=query.explain,
+        )
+        return [self._to_model(raw_obj) for raw_obj in raw_objs]
         # query = (
         #     self.db_collection.get_collection()
         #     .find(filter, skip=skip, limit=limit)
@@ -100,22 +277,173 @@ class CRUDMongoBase(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
         # results = [self.model(**raw_object) async for raw_object in query]
         # return results
 
+    async def filter_page(
+        self,
+        filter: Dict,
+        *,
+        after: Optional[str] = None,
+        skip: int = 0,
+        limit: int = 100,
+        sort_field: str = "_id",
+        sort_ascending: bool = True,
+        projection: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[List[ModelType], Optional[str]]:
+        """Returns a page of objects in a stable order and the cursor for the next page.
+        **Parameters**
+        * `filter`: The filter to apply
+        * `after`: The cursor returned with the previous page, seeks by index rather than skipping
+        * `skip`, `limit`: As for filter_multi, a limit of 0 returns all remaining objects
+        * `sort_field`, `sort_ascending`: The order, _id breaks ties
+        * `projection`: The fields to return as for filter_multi
+        **Returns**
+        * `(objs, next_cursor)`: The objects and a cursor or `None` if this is the last page
+        """
+        raw_objs, next_cursor = await self.filter_page_raw(
+            filter,
+            after=after,
+            skip=skip,
+            limit=limit,
+            sort_field=sort_field,
+            sort_ascending=sort_ascending,
+            projection=projection,
+        )
+        return [self._to_model(raw_obj) for raw_obj in raw_objs], next_cursor
+
+    @record_db_op
+    async def filter_page_raw(
+        self,
+        filter: Dict,
+        *,
+        after: Optional[str] = None,
+        skip: int = 0,
+        limit: int = 100,
+        sort_field: str = "_id",
+        sort_ascending: bool = True,
+        projection: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[List[Dict], Optional[str]]:
+        """As filter_page but returns the stored documents."""
+        if projection is not None:
+            # the cursor needs the sort field, _id is returned unless excluded
+            projection = {**projection, sort_field: True}
+        if after is not None:
+            cursor_field, value, last_id = decode_cursor(after)
+            if cursor_field != sort_field:
+                raise ValueError(f"Cursor is for sort field {cursor_field}")
+            seek = keyset_filter(
+                sort_field,
+                value,
+                last_id,
+                sort_ascending,
+                unique=sort_field in self.UNIQUE_FIELDS,
+            )
+            filter = {"$and": [filter, seek]} if filter else seek
+
+        # fetch one extra to know if there is a next page
+        start = time.perf_counter()
+        sort = sort_spec(
+            sort_field, sort_ascending, unique=sort_field in self.UNIQUE_FIELDS
+        )
+        query = self._collection.find(
+            filter,
+            projection=projection,
+            skip=skip,
+            limit=limit + 1 if limit > 0 else 0,
+        ).sort(sort)
+        raw_objs = [raw_obj async for raw_obj in query]
+        self._check_slow(
+            "find",
+            start,
+            filter,
+            len(raw_objs),
+            sort=sort,
+            skip=skip,
+            limit=limit,
+            explain=query.explain,
+        )
+        next_cursor = None
+        if 0 < limit < len(raw_objs):
+            raw_objs = raw_objs[:limit]
+            last_obj = raw_objs[-1]
+            next_cursor = encode_cursor(
+                sort_field, last_obj.get(sort_field), last_obj["_id"]
+            )
+        return raw_objs, next_cursor
+
+    async def iter_raw(
+        self, filter: Dict, *, batch_size: int = 1000
+    ) -> AsyncIterator[Dict]:
+        """Yields the raw documents matching the filter without building models or a list.
+        **Parameters**
+        * `filter`: The filter to apply
+        * `batch_size`: Number of documents fetched from the server per round trip
+        """
+        async for raw_obj in self._collection.find(filter, batch_size=batch_size):
+            yield raw_obj
+
+    @record_db_op
     async def add(self, *, obj_in: CreateSchemaType) -> ModelType:
         obj_in_data = jsonable_encoder(obj_in)
 
         # datetimes not needed as done by model defaults
         db_obj = self.model(**obj_in_data)  # type: ignore
+        return await self._insert(db_obj)
 
-        result = await self._collection.insert_one(db_obj.dict(by_alias=True))
-        # logger.info(f"Inserted task id {str(result.inserted_id)} key {new_key}")
-        return await self.get(result.inserted_id)
+    async def _insert(self, db_obj: ModelType) -> ModelType:
+        """Insert a validated object returning it as per the return mode, one round trip."""
+        if self.return_mode == "local":
+            await self._collection.insert_one(db_obj.dict(by_alias=True))
+            return db_obj
+        # upsert on a new _id is an insert that returns the stored document
+        raw_obj = await self._collection.find_one_and_update(
+            {"_id": db_obj.id},
+            {"$setOnInsert": db_obj.dict(by_alias=True)},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return self._to_model(raw_obj)
 
+    @record_db_op
     async def update(
         self,
         *,
         obj_original: ModelType,
-        obj_update: Union[UpdateSchemaType, Dict[str, Any]]
+        obj_update: Union[UpdateSchemaType, Dict[str, Any]],
     ) -> ModelType:
+        set_data = self._update_set_data(obj_original, obj_update)
+        filter = {"_id": obj_original.id}
+        start = time.perf_counter()
+        if self.return_mode == "local":
+            result = await self._collection.update_one(filter, {"$set": set_data})
+            self._check_slow(
+                "update_one",
+                start,
+                filter,
+                result.modified_count,
+                explain=self._explain_find(filter),
+            )
+            self.invalidate(obj_original.id, set_data)
+            return obj_original
+        raw_obj = await self._collection.find_one_and_update(
+            filter,
+            {"$set": set_data},
+            return_document=ReturnDocument.AFTER,
+        )
+        self._check_slow(
+            "find_one_and_update",
+            start,
+            filter,
+            int(raw_obj is not None),
+            explain=self._explain_find(filter),
+        )
+        self.invalidate(obj_original.id, set_data)
+        return self._to_model(raw_obj)
+
+    @staticmethod
+    @traced("internal")
+    def _update_set_data(
+        obj_original: ModelType, obj_update: Union[UpdateSchemaType, Dict[str, Any]]
+    ) -> Dict[str, Any]:
+        """Applies the update to the original and returns the fields to store."""
         obj_data = jsonable_encoder(obj_original)
         # convert obj_in -> dict as update_data
         if isinstance(obj_update, dict):
@@ -124,7 +452,7 @@ class CRUDMongoBase(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
             update_data = obj_update.dict(exclude_unset=True)
 
         # ensure update set to now and do not allow created to be modified
-        update_data["updated"] = dt.datetime.now()
+        update_data["updated"] = now_ms()
         if "created" in update_data:
             del update_data["created"]
 
@@ -132,19 +460,90 @@ class CRUDMongoBase(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
             if field in update_data:
                 setattr(obj_original, field, update_data[field])
 
-        await self._collection.update_one(
-            {"_id": obj_original.id},
-            {"$set": obj_original.dict(by_alias=True, exclude_unset=True)},
+        return obj_original.dict(by_alias=True, exclude_unset=True)
+
+    @record_db_op
+    async def update_by_key(
+        self,
+        key_name: str,
+        key_value: Any,
+        *,
+        obj_update: Union[UpdateSchemaType, Dict[str, Any]],
+    ) -> Optional[ModelType]:
+        """Updates the object with the key value in a single round trip without reading it first.
+        **Parameters**
+        * `key_name`: The name of the unique key field
+        * `key_value`: The key value of the object to update
+        * `obj_update`: The fields to change, only fields that were set are written
+        **Returns**
+        * `obj`: The updated object or `None` if it does not exist
+        """
+        filter = {key_name: key_value}
+        start = time.perf_counter()
+        raw_obj = await self._collection.find_one_and_update(
+            filter,
+            {"$set": self._update_by_key_data(obj_update)},
+            return_document=ReturnDocument.AFTER,
+        )
+        self._check_slow(
+            "find_one_and_update",
+            start,
+            filter,
+            int(raw_obj is not None),
+            explain=self._explain_find(filter),
         )
-        return await self.get(obj_original.id)
+        if raw_obj is not None:
+            self.invalidate(raw_obj["_id"], raw_obj)
+        return self._to_model(raw_obj)
 
-    async def delete(self, *, id: Any) -> ModelType:
-        obj = await self.get(id)
-        await self._collection.delete_one({"_id": id})
-        return obj
+    @staticmethod
+    def _update_by_key_data(
+        obj_update: Union[UpdateSchemaType, Dict[str, Any]]
+    ) -> Dict[str, Any]:
+        """The fields set in the update to store, with updated set to now."""
+        if isinstance(obj_update, dict):
+            update_data = dict(obj_update)
+        else:
+            update_data = obj_update.dict(exclude_unset=True)
+        update_data.pop("created", None)
+        update_data["updated"] = now_ms()
+        return update_data
 
+    @record_db_op
+    async def delete(self, *, id: Any) -> Optional[ModelType]:
+        # a single round trip in either mode, the deleted document comes back with the delete
+        filter = {"_id": id}
+        start = time.perf_counter()
+        raw_obj = await self._collection.find_one_and_delete(filter)
+        self._check_slow(
+            "find_one_and_delete",
+            start,
+            filter,
+            int(raw_obj is not None),
+            explain=self._explain_find(filter),
+        )
+        if raw_obj is not None:
+            self.invalidate(id, raw_obj)
+        return self._to_model(raw_obj)
+
+    @record_db_op
     async def delete_all(self) -> None:
         await self._collection.delete_many({})
+        if self.cache is not None:
+            self.cache.clear()
 
     async def drop_db(self) -> None:
         await self.db_collection.drop_db()
+        if self.cache is not None:
+            self.cache.clear()
+
+    async def ensure_indexes(self) -> IndexReport:
+        return await ensure_indexes(self.db_collection, self.INDEXES)
+
+    async def check_indexes(self) -> IndexReport:
+        return await check_indexes(self.db_collection, self.INDEXES)
+
+    async def warm_up(self) -> None:
+        """Runs a trial page query so the first list request finds the plan cached and the
+        index in the server's memory."""
+        await self.filter_page_raw({}, limit=1)
@@ -1,6 +1,24 @@
-from typing import Optional
+import datetime as dt
+import time
+from typing import Any, Dict, List, Optional, Tuple, Union
+from bson import json_util
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from app.crud.base import CRUDMongoBase, MongoCollection
-from app.model.task import TaskCreate, TaskUpdate, Task
+from app.data_layer.indexes import IndexSpec
+from app.data_layer.cache import TTLCache
+from app.data_layer.change_feed import ChangeEvent
+from app.data_layer.shared_cache import SharedCache
+from app.data_layer.slow_ops import SlowOpLog
+from app.core.encoders import dumps
+from app.core.metrics import record_db_op
+from app.model.task import (
+    TaskCreate,
+    TaskUpdate,
+    Task,
+    TaskBatchResult,
+    TaskStats,
+    TaskStatsBucket,
+)
 from app.data_layer.id_generator import TaskIdGenerator
 from app.core.config import get_logger
 
@@ -8,17 +26,216 @@ logger = get_logger("data layer")
 
 
 class CRUDTask(CRUDMongoBase[Task, TaskCreate, TaskUpdate]):
-    def __init__(self, model: Task, db: MongoCollection, id_gen: TaskIdGenerator):
+    # every filter from build_filter and sort in SORT_FIELDS is served by an index
+    INDEXES = [
+        IndexSpec(name="key_unique", keys=[("key", 1)], unique=True),
+        IndexSpec(
+            name="project_status_updated",
+            keys=[("project", 1), ("status", 1), ("updated", -1)],
+        ),
+        IndexSpec(name="status_updated", keys=[("status", 1), ("updated", -1)]),
+        IndexSpec(name="tags_updated", keys=[("tags", 1), ("updated", -1)]),
+        IndexSpec(name="updated_id", keys=[("updated", -1), ("_id", -1)]),
+        IndexSpec(name="created_id", keys=[("created", -1), ("_id", -1)]),
+    ]
+    UNIQUE_FIELDS = {"_id", "key"}
+    SORT_FIELDS = {"_id", "key", "created", "updated"}
+    # $dateTrunc units the created and updated histograms can be bucketed by
+    STATS_INTERVALS = ("hour", "day", "week", "month")
+
+    def __init__(
+        self,
+        model: Task,
+        db: MongoCollection,
+        id_gen: TaskIdGenerator,
+        return_mode: str = "server",
+        trusted_reads: bool = False,
+        cache: Optional[TTLCache] = None,
+        shared_cache: Optional[SharedCache] = None,
+        stats_cache: Optional[TTLCache] = None,
+        slow_ops: Optional[SlowOpLog] = None,
+    ):
         """
         CRUD object with default methods to Create, Read, Update, Delete (CRUD).
         **Parameters**
         * `model`: A SQLAlchemy model class
         * `db`: A connetionc to the DB for persistence
         * `id_gen`: ID generator needed for the seq and key.
+        * `return_mode`: "server" or "local" how mutations build their result
+        * `trusted_reads`: build models from stored documents without validating them
+        * `cache`: read-through cache of tasks by id and key, `None` to disable
+        * `shared_cache`: cache of task and page JSON shared across workers, `None` to disable
+        * `stats_cache`: short lived cache of stats results, `None` to disable
+        * `slow_ops`: log of reads and writes slower than its threshold, `None` to disable
         """
-        super().__init__(model, db)
+        super().__init__(model, db, return_mode, trusted_reads, cache, slow_ops)
         self.id_gen = id_gen
+        self.shared_cache = shared_cache
+        self.stats_cache = stats_cache
+
+    @staticmethod
+    def build_filter(
+        *,
+        project: Optional[str] = None,
+        status: Optional[str] = None,
+        tags: Optional[List[str]] = None,
+        tags_match: str = "any",
+        updated_since: Optional[dt.datetime] = None,
+    ) -> Dict[str, Any]:
+        """Builds a mongo filter from the optional criteria, unset criteria match all.
+        **Parameters**
+        * `tags`: Tags to match, with `tags_match` "any" for at least one or "all"
+        """
+        filter: Dict[str, Any] = {}
+        if project is not None:
+            filter["project"] = project
+        if status is not None:
+            filter["status"] = status
+        if tags:
+            if tags_match not in ("any", "all"):
+                raise ValueError(f"Unknown tags match {tags_match}")
+            filter["tags"] = {"$in" if tags_match == "any" else "$all": tags}
+        if updated_since is not None:
+            filter["updated"] = {"$gte": updated_since}
+        return filter
+
+    @record_db_op
+    async def get_json_by_key(self, task_key: str) -> Optional[bytes]:
+        """Returns the task as JSON or `None`, from the shared cache when there is one."""
+        if self.shared_cache is None:
+            raw_task = await self._find_one_cached("key", task_key)
+            return None if raw_task is None else dumps(raw_task)
+        cache_key = await self.shared_cache.task_key(task_key)
+        content = await self.shared_cache.get_task(cache_key)
+        if content is not None:
+            return content
+        # not through the local cache, it may hold a task another worker has since changed
+        raw_task = await self._find_one({"key": task_key})
+        if raw_task is None:
+            return None
+        content = dumps(raw_task)
+        await self.shared_cache.set_task(cache_key, content)
+        return content
+
+    async def filter_page_json(
+        self, filter: Dict, **page_args: Any
+    ) -> Tuple[bytes, Optional[str]]:
+        """As filter_page but returns the page as JSON, from the shared cache when there is one."""
+        if self.shared_cache is None:
+            raw_tasks, next_cursor = await self.filter_page_raw(filter, **page_args)
+            return dumps(raw_tasks), next_cursor
+        page_key = await self.shared_cache.page_key([filter, page_args])
+        cached = await self.shared_cache.get_page(page_key)
+        if cached is not None:
+            return cached
+        raw_tasks, next_cursor = await self.filter_page_raw(filter, **page_args)
+        content = dumps(raw_tasks)
+        await self.shared_cache.set_page(page_key, content, next_cursor)
+        return content, next_cursor
+
+    @staticmethod
+    def _histogram_stage(field: str, interval: str) -> List[Dict[str, Any]]:
+        return [
+            {
+                "$group": {
+                    "_id": {"$dateTrunc": {"date": f"${field}", "unit": interval}},
+                    "count": {"$sum": 1},
+                }
+            },
+            {"$sort": {"_id": 1}},
+        ]
+
+    @record_db_op
+    async def stats(self, filter: Dict, interval: str = "day") -> TaskStats:
+        """Counts of the matching tasks by project, status and tag with created and updated
+        histograms, all from a single aggregation run by the server.
+        **Parameters**
+        * `filter`: Mongo filter of the tasks to count, as from build_filter
+        * `interval`: Histogram bucket size, one of STATS_INTERVALS
+        """
+        if interval not in self.STATS_INTERVALS:
+            raise ValueError(f"Unknown stats interval {interval}")
+        cache_key = json_util.dumps([filter, interval], sort_keys=True)
+        if self.stats_cache is not None:
+            cached = self.stats_cache.get(cache_key)
+            if cached is not None:
+                return cached
+
+        facets = {
+            "by_project": [{"$group": {"_id": "$project", "count": {"$sum": 1}}}],
+            "by_status": [{"$group": {"_id": "$status", "count": {"$sum": 1}}}],
+            "by_tag": [
+                {"$unwind": "$tags"},
+                {"$group": {"_id": "$tags", "count": {"$sum": 1}}},
+            ],
+            "created": self._histogram_stage("created", interval),
+            "updated": self._histogram_stage("updated", interval),
+        }
+        pipeline = [{"$facet": facets}]
+        if filter:
+            # the unfiltered total comes from the collection metadata instead
+            facets["total"] = [{"$count": "count"}]
+            pipeline.insert(0, {"$match": filter})
+        start = time.perf_counter()
+        results = await self._collection.aggregate(pipeline).to_list(length=1)
+        self._check_slow(
+            "aggregate",
+            start,
+            pipeline,
+            len(results),
+            explain=lambda: self._collection.database.command(
+                "aggregate", self._collection.name, pipeline=pipeline, explain=True
+            ),
+        )
+        result = results[0] if results else {}
+
+        def counts(facet: str) -> Dict[str, int]:
+            return {str(row["_id"]): row["count"] for row in result.get(facet, [])}
+
+        def buckets(facet: str) -> List[TaskStatsBucket]:
+            return [
+                TaskStatsBucket(start=row["_id"], count=row["count"])
+                for row in result.get(facet, [])
+                if row["_id"] is not None
+            ]
 
+        if filter:
+            total_rows = result.get("total", [])
+            total = total_rows[0]["count"] if total_rows else 0
+        else:
+            total = await self.db_collection.estimated_document_count()
+        task_stats = TaskStats(
+            total=total,
+            by_project=counts("by_project"),
+            by_status=counts("by_status"),
+            by_tag=counts("by_tag"),
+            interval=interval,
+            created=buckets("created"),
+            updated=buckets("updated"),
+        )
+        if self.stats_cache is not None:
+            self.stats_cache.set(cache_key, task_stats)
+        return task_stats
+
+    async def apply_change(self, event: ChangeEvent) -> None:
+        await super().apply_change(event)
+        # the write may come from a process that does not use the shared cache
+        if event.key is not None:
+            await self._invalidate_shared(event.key)
+            return
+        # a collection change or a streamed delete, which has no document to give the key
+        if self.stats_cache is not None:
+            self.stats_cache.clear()
+        if self.shared_cache is not None:
+            await self.shared_cache.invalidate_all()
+
+    async def _invalidate_shared(self, *task_keys: str) -> None:
+        if self.stats_cache is not None:
+            self.stats_cache.clear()
+        if self.shared_cache is not None:
+            await self.shared_cache.invalidate(*task_keys)
+
+    @record_db_op
     async def add(self, *, obj_in: TaskCreate) -> Task:
         # TODO! - lock ID gen then ensure it works before commiting
         new_id = await self.id_gen.get_next_id(obj_in.project)
@@ -26,16 +243,124 @@ class CRUDTask(CRUDMongoBase[Task, TaskCreate, TaskUpdate]):
         new_task = Task(**new_data)
         new_key = new_task.key
 
-        if await self.get_by_key("key", new_key) is not None:
+        # the unique key index rejects duplicates, no need to check first
+        try:
+            added_task = await self._insert(new_task)
+        except DuplicateKeyError:
             raise ValueError(
                 f"Error in creating task the key {new_key} already exists!"
             )
+        logger.info(f"Created task with ID {added_task.id}")
+        await self._invalidate_shared()
+        return added_task
+
+    async def _new_tasks(self, objs_in: List[TaskCreate]) -> List[Task]:
+        # reserve a contiguous block of seq numbers per project
+        by_project: Dict[str, List[int]] = {}
+        for i, obj_in in enumerate(objs_in):
+            by_project.setdefault(obj_in.project, []).append(i)
+        new_tasks: List[Optional[Task]] = [None] * len(objs_in)
+        for project, indexes in by_project.items():
+            first_id = await self.id_gen.get_next_ids(project, len(indexes))
+            for offset, i in enumerate(indexes):
+                new_tasks[i] = Task(**objs_in[i].get_dict_inc_seq(first_id + offset))
+        return new_tasks
+
+    @record_db_op
+    async def add_many(self, *, objs_in: List[TaskCreate]) -> List[TaskBatchResult]:
+        """Add many tasks using one ID reservation per project, one key check and one insert.
+        **Parameters**
+        * `objs_in`: The tasks to create
+        **Returns**
+        * `results`: One result per task in the same order as `objs_in`
+        """
+        new_tasks = await self._new_tasks(objs_in)
+        results = [
+            TaskBatchResult(index=i, created=False, key=task.key)
+            for i, task in enumerate(new_tasks)
+        ]
+
+        # check all keys for collisions in a single query
+        start = time.perf_counter()
+        key_filter = {"key": {"$in": [task.key for task in new_tasks]}}
+        query = self._collection.find(
+            key_filter, projection={"key": True, "_id": False}
+        )
+        existing_keys = {raw_obj["key"] async for raw_obj in query}
+        self._check_slow(
+            "find", start, key_filter, len(existing_keys), explain=query.explain
+        )
+        to_insert = []
+        for i, task in enumerate(new_tasks):
+            if task.key in existing_keys:
+                results[i].detail = f"Task key {task.key} already exists"
+            else:
+                to_insert.append(i)
+        if not to_insert:
+            return results
+
+        write_errors = {}
+        try:
+            await self._collection.insert_many(
+                [new_tasks[i].dict(by_alias=True) for i in to_insert], ordered=False
+            )
+        except BulkWriteError as exc:
+            # error index refers to the position in the inserted list
+            write_errors = {
+                err["index"]: err.get("errmsg", "write failed")
+                for err in exc.details.get("writeErrors", [])
+            }
+        for pos, i in enumerate(to_insert):
+            if pos in write_errors:
+                results[i].detail = write_errors[pos]
+            else:
+                results[i].created = True
+                results[i].task = new_tasks[i]
+        logger.info(
+            f"Created {len(to_insert) - len(write_errors)} of {len(objs_in)} tasks in batch"
+        )
+        await self._invalidate_shared()
+        return results
+
+    async def update(
+        self,
+        *,
+        obj_original: Task,
+        obj_update: Union[TaskUpdate, Dict[str, Any]],
+    ) -> Task:
+        task = await super().update(obj_original=obj_original, obj_update=obj_update)
+        await self._invalidate_shared(obj_original.key)
+        return task
+
+    async def update_by_key(
+        self,
+        key_name: str,
+        key_value: Any,
+        *,
+        obj_update: Union[TaskUpdate, Dict[str, Any]],
+    ) -> Optional[Task]:
+        task = await super().update_by_key(key_name, key_value, obj_update=obj_update)
+        if task is not None:
+            await self._invalidate_shared(task.key)
+        return task
+
+    async def delete(self, *, id: Any) -> Optional[Task]:
+        task = await super().delete(id=id)
+        if task is not None:
+            await self._invalidate_shared(task.key)
+        return task
 
-        result = await self.db_collection().insert_one(new_task.dict(by_alias=True))
-        # result = await self.tasks.insert_one(new_task.dict(by_alias=True))
-        logger.info(f"Created task with ID {result.inserted_id}")
-        return await self.get(result.inserted_id)
+    async def delete_all(self) -> None:
+        await super().delete_all()
+        if self.stats_cache is not None:
+            self.stats_cache.clear()
+        if self.shared_cache is not None:
+            await self.shared_cache.invalidate_all()
 
     async def drop_db(self) -> None:
         await super().drop_db()
         await self.id_gen.reset()
+        if self.stats_cache is not None:
+            self.stats_cache.clear()
+        if self.shared_cache is not None:
+            await self.shared_cache.invalidate_all()
@@ -0,0 +1,229 @@
+""" Task CRUD on documents held in process memory, for running without mongo. """
+
+import datetime as dt
+from collections import Counter
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple, Union
+from pymongo.errors import DuplicateKeyError
+from app.crud.crud_task import CRUDTask
+from app.crud.pagination import decode_cursor, encode_cursor
+from app.data_layer.indexes import IndexReport
+from app.data_layer.inmem_collection import InMemCollection, project
+from app.data_layer.id_generator import TaskIdGenerator
+from app.model.task import (
+    Task,
+    TaskBatchResult,
+    TaskCreate,
+    TaskStats,
+    TaskStatsBucket,
+    TaskUpdate,
+)
+from app.core.config import get_logger
+from app.core.metrics import record_db_op
+
+logger = get_logger("data layer")
+
+
+def truncate_date(date: dt.datetime, interval: str) -> dt.datetime:
+    """Start of the interval the date is in, as $dateTrunc with weeks starting on Sunday."""
+    start = date.replace(minute=0, second=0, microsecond=0)
+    if interval == "hour":
+        return start
+    start = start.replace(hour=0)
+    if interval == "week":
+        return start - dt.timedelta(days=(start.weekday() + 1) % 7)
+    if interval == "month":
+        return start.replace(day=1)
+    return start
+
+
+class CRUDTaskInMem(CRUDTask):
+    """CRUDTask storing the documents in an InMemCollection, one per process.
+
+    Documents are stored as they would be in mongo so reads, pages, projections and JSON
+    are the same. There is no cache, a read is already a dict lookup or an index seek.
+    """
+
+    # fields with a sorted index, every field of SORT_FIELDS and build_filter but tags
+    INDEX_FIELDS = ("key", "project", "status", "created", "updated")
+
+    def __init__(
+        self,
+        model: Task,
+        db: InMemCollection,
+        id_gen: TaskIdGenerator,
+        return_mode: str = "server",
+        trusted_reads: bool = False,
+    ):
+        super().__init__(model, db, id_gen, return_mode, trusted_reads)
+
+    async def _find_one_cached(self, key_name: str, key_value: Any) -> Optional[Dict]:
+        return self._collection.find_one(key_name, key_value)
+
+    @record_db_op
+    async def filter_one(self, filter: Dict) -> Optional[Task]:
+        return self._to_model(next(self._collection.find(filter), None))
+
+    @record_db_op
+    async def filter_multi(
+        self,
+        filter: Dict,
+        *,
+        skip: int = 0,
+        limit: int = 100,
+        sort_field: str = None,
+        sort_ascending: bool = True,
+        projection: Optional[Dict[str, Any]] = None,
+    ) -> List[Task]:
+        raw_objs = self._collection.find(
+            filter,
+            sort_field=sort_field or "_id",
+            ascending=sort_ascending,
+            skip=skip,
+            limit=limit,
+        )
+        return [self._to_model(project(raw_obj, projection)) for raw_obj in raw_objs]
+
+    @record_db_op
+    async def filter_page_raw(
+        self,
+        filter: Dict,
+        *,
+        after: Optional[str] = None,
+        skip: int = 0,
+        limit: int = 100,
+        sort_field: str = "_id",
+        sort_ascending: bool = True,
+        projection: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[List[Dict], Optional[str]]:
+        position = None
+        if after is not None:
+            cursor_field, value, last_id = decode_cursor(after)
+            if cursor_field != sort_field:
+                raise ValueError(f"Cursor is for sort field {cursor_field}")
+            position = (value, last_id)
+        # the index seeks to the cursor, fetch one extra to know if there is a next page
+        raw_objs = list(
+            self._collection.find(
+                filter,
+                sort_field=sort_field,
+                ascending=sort_ascending,
+                after=position,
+                skip=skip,
+                limit=limit + 1 if limit > 0 else 0,
+            )
+        )
+        next_cursor = None
+        if 0 < limit < len(raw_objs):
+            raw_objs = raw_objs[:limit]
+            last_obj = raw_objs[-1]
+            next_cursor = encode_cursor(
+                sort_field, last_obj.get(sort_field), last_obj["_id"]
+            )
+        if projection is not None:
+            projection = {**projection, sort_field: True}
+            raw_objs = [project(raw_obj, projection) for raw_obj in raw_objs]
+        return raw_objs, next_cursor
+
+    async def iter_raw(
+        self, filter: Dict, *, batch_size: int = 1000
+    ) -> AsyncIterator[Dict]:
+        # the documents matching now, later writes do not change the export
+        for raw_obj in list(self._collection.find(filter)):
+            yield raw_obj
+
+    async def _insert(self, db_obj: Task) -> Task:
+        raw_obj = self._collection.insert(db_obj.dict(by_alias=True))
+        return db_obj if self.return_mode == "local" else self._to_model(raw_obj)
+
+    @record_db_op
+    async def add_many(self, *, objs_in: List[TaskCreate]) -> List[TaskBatchResult]:
+        results = []
+        for i, task in enumerate(await self._new_tasks(objs_in)):
+            result = TaskBatchResult(index=i, created=False, key=task.key)
+            try:
+                self._collection.insert(task.dict(by_alias=True))
+            except DuplicateKeyError:
+                result.detail = f"Task key {task.key} already exists"
+            else:
+                result.created = True
+                result.task = task
+            results.append(result)
+        logger.info(
+            f"Created {sum(result.created for result in results)} of {len(objs_in)} tasks in batch"
+        )
+        return results
+
+    @record_db_op
+    async def update(
+        self,
+        *,
+        obj_original: Task,
+        obj_update: Union[TaskUpdate, Dict[str, Any]],
+    ) -> Task:
+        set_data = self._update_set_data(obj_original, obj_update)
+        raw_obj = self._collection.update(obj_original.id, set_data)
+        return obj_original if self.return_mode == "local" else self._to_model(raw_obj)
+
+    @record_db_op
+    async def update_by_key(
+        self,
+        key_name: str,
+        key_value: Any,
+        *,
+        obj_update: Union[TaskUpdate, Dict[str, Any]],
+    ) -> Optional[Task]:
+        raw_obj = self._collection.find_one(key_name, key_value)
+        if raw_obj is None:
+            return None
+        raw_obj = self._collection.update(
+            raw_obj["_id"], self._update_by_key_data(obj_update)
+        )
+        return self._to_model(raw_obj)
+
+    @record_db_op
+    async def delete(self, *, id: Any) -> Optional[Task]:
+        return self._to_model(self._collection.delete(id))
+
+    @record_db_op
+    async def delete_all(self) -> None:
+        self._collection.clear()
+
+    async def drop_db(self) -> None:
+        self._collection.clear()
+        await self.id_gen.reset()
+
+    @record_db_op
+    async def stats(self, filter: Dict, interval: str = "day") -> TaskStats:
+        if interval not in self.STATS_INTERVALS:
+            raise ValueError(f"Unknown stats interval {interval}")
+        by_project, by_status, by_tag = Counter(), Counter(), Counter()
+        created, updated = Counter(), Counter()
+        for raw_obj in self._collection.find(filter):
+            by_project[raw_obj["project"]] += 1
+            by_status[raw_obj["status"]] += 1
+            by_tag.update(raw_obj.get("tags") or [])
+            created[truncate_date(raw_obj["created"], interval)] += 1
+            updated[truncate_date(raw_obj["updated"], interval)] += 1
+
+        def buckets(counts: Counter) -> List[TaskStatsBucket]:
+            return [
+                TaskStatsBucket(start=start, count=count)
+                for start, count in sorted(counts.items())
+            ]
+
+        return TaskStats(
+            total=sum(by_project.values()),
+            by_project=by_project,
+            by_status=by_status,
+            by_tag=by_tag,
+            interval=interval,
+            created=buckets(created),
+            updated=buckets(updated),
+        )
+
+    async def ensure_indexes(self) -> IndexReport:
+        # the indexes are built with the collection
+        return IndexReport(collection=self.db_collection.name)
+
+    async def check_indexes(self) -> IndexReport:
+        return IndexReport(collection=self.db_collection.name)
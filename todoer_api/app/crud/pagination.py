@@ -0,0 +1,61 @@
+""" Opaque cursors for keyset pagination, a cursor holds the sort field and the last (value, _id) seen. """
+
+import base64
+from typing import Any, Dict, List, Tuple
+from bson import json_util
+from app.model.base import ObjectId
+
+# dates decode naive, as stored and as the in-memory backend compares them
+CURSOR_JSON_OPTIONS = json_util.JSONOptions(tz_aware=False)
+
+
+def encode_cursor(sort_field: str, value: Any, last_id: ObjectId) -> str:
+    raw = json_util.dumps([sort_field, value, last_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[str, Any, ObjectId]:
+    """Returns (sort_field, value, last_id) raising ValueError for a malformed cursor."""
+    try:
+        sort_field, value, last_id = json_util.loads(
+            base64.urlsafe_b64decode(cursor.encode()), json_options=CURSOR_JSON_OPTIONS
+        )
+    except (ValueError, TypeError) as exc:
+        raise ValueError(f"Invalid cursor {cursor}") from exc
+    if not isinstance(sort_field, str) or not isinstance(last_id, ObjectId):
+        raise ValueError(f"Invalid cursor {cursor}")
+    return sort_field, value, last_id
+
+
+def sort_spec(
+    sort_field: str, ascending: bool, unique: bool = False
+) -> List[Tuple[str, int]]:
+    """Sort on the field with _id as the tie breaker so the order is total and stable.
+
+    A unique field needs no tie breaker, nor an index that includes _id to sort on.
+    """
+    direction = 1 if ascending else -1
+    if sort_field == "_id" or unique:
+        return [(sort_field, direction)]
+    return [(sort_field, direction), ("_id", direction)]
+
+
+def keyset_filter(
+    sort_field: str,
+    value: Any,
+    last_id: ObjectId,
+    ascending: bool,
+    unique: bool = False,
+) -> Dict:
+    """Filter for the documents after (value, last_id) in the order given by sort_spec."""
+    op = "$gt" if ascending else "$lt"
+    if sort_field == "_id":
+        return {"_id": {op: last_id}}
+    if unique:
+        return {sort_field: {op: value}}
+    return {
+        "$or": [
+            {sort_field: {op: value}},
+            {sort_field: value, "_id": {op: last_id}},
+        ]
+    }
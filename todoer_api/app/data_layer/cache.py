@@ -0,0 +1,93 @@
+""" Bounded in-process LRU cache with a TTL for data layer reads.
+
+Each process (gunicorn worker) has its own cache and only sees its own writes, so an entry
+written by another worker can be stale for at most `ttl` seconds after that write.
+"""
+
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Iterator, Optional, Tuple
+from pydantic import BaseModel
+
+
+class CacheStats(BaseModel):
+    name: str
+    size: int
+    maxsize: int
+    ttl: float
+    hits: int
+    misses: int
+    evictions: int
+    expirations: int
+
+
+class TTLCache:
+    """Least recently used cache of at most maxsize entries that expire ttl seconds after set."""
+
+    def __init__(
+        self,
+        maxsize: int,
+        ttl: float,
+        name: str = "cache",
+        timer: Callable[[], float] = time.monotonic,
+    ) -> None:
+        if maxsize <= 0:
+            raise ValueError(f"Cache size must be positive not {maxsize}")
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self._timer = timer
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Returns the value or `None` if it is not cached or has expired."""
+        try:
+            expires_at, value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        if expires_at <= self._timer():
+            del self._data[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._data[key] = (self._timer() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: Hashable) -> Optional[Any]:
+        entry = self._data.pop(key, None)
+        return entry[1] if entry is not None else None
+
+    def values(self) -> Iterator[Any]:
+        """The cached values including any expired ones not yet removed."""
+        return (value for _, value in self._data.values())
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def stats(self) -> CacheStats:
+        return CacheStats(
+            name=self.name,
+            size=len(self._data),
+            maxsize=self.maxsize,
+            ttl=self.ttl,
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            expirations=self.expirations,
+        )
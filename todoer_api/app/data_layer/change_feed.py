@@ -0,0 +1,263 @@
+""" Feed of changes to a collection, from a change stream or by polling `updated`.
+
+Each worker runs its own feed so it sees the writes made by all workers and replicas. Its
+last position is saved in a tokens collection, keyed by feed, host and worker slot, so the
+worker gunicorn starts in the place of one that exited carries on where it stopped. Without
+a slot the position is keyed by pid and only resumes a feed restarted in the same process.
+Positions not saved for STALE_POSITION_AGE seconds are removed.
+
+Change streams need a replica set, on a standalone server the feed polls for documents with
+a newer `updated` instead, which does not see deletes.
+"""
+
+import asyncio
+import datetime as dt
+import os
+import socket
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+from pydantic import BaseModel
+from pymongo.errors import OperationFailure, PyMongoError
+from app.core.config import get_logger
+from app.model.base import now_ms
+from .mongo_connection import MongoCollection
+
+logger = get_logger("data layer")
+
+# server error codes of a standalone server and of a resume token no longer in the oplog
+CHANGE_STREAM_UNSUPPORTED = {40573}
+CHANGE_STREAM_HISTORY_LOST = {280, 286}
+# operations after which every cached document of the collection is stale
+COLLECTION_OPS = {"drop", "dropDatabase", "rename", "invalidate"}
+# positions of workers gone for good, e.g. replicas scaled down, longer than an oplog lasts
+STALE_POSITION_AGE = 7 * 24 * 3600
+
+
+class ChangeEvent(BaseModel):
+    """A change to one document, or the whole collection when `id` is `None`."""
+
+    op: str
+    id: Optional[Any] = None
+    key: Optional[str] = None
+    document: Optional[Dict[str, Any]] = None
+
+
+ChangeHandler = Callable[[ChangeEvent], Awaitable[None]]
+
+
+class ChangeFeed:
+    """Watches a collection in a background task and passes each change to the handlers
+    then to every subscriber queue."""
+
+    def __init__(
+        self,
+        collection: MongoCollection,
+        token_collection: MongoCollection,
+        name: str = "tasks",
+        poll_interval: float = 1.0,
+        save_interval: float = 1.0,
+        queue_size: int = 100,
+        worker_slot: Optional[int] = None,
+    ) -> None:
+        """
+        **Parameters**
+        * `collection`: The collection to watch
+        * `token_collection`: Where the last position of each worker's feed is kept
+        * `poll_interval`: Seconds between polls when change streams are unavailable
+        * `save_interval`: Seconds between saves of the position, it is also saved on stop
+        * `queue_size`: Events held per subscriber, the oldest are dropped when full
+        * `worker_slot`: Set by gunicorn_conf.py, keeps the position across worker restarts
+        """
+        self.collection = collection
+        self.token_collection = token_collection
+        self.name = name
+        # each worker has its own position, sharing one would skip the changes a worker
+        # has not seen yet
+        worker = f"pid{os.getpid()}" if worker_slot is None else worker_slot
+        self.position_id = f"{name}:{socket.gethostname()}:{worker}"
+        self.poll_interval = poll_interval
+        self.save_interval = save_interval
+        self.queue_size = queue_size
+        self.mode: Optional[str] = None
+        self._handlers: List[ChangeHandler] = []
+        self._subscribers: Set[asyncio.Queue] = set()
+        self._task: Optional[asyncio.Task] = None
+        self._position: Dict[str, Any] = {}
+        self._saved_at = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def add_handler(self, handler: ChangeHandler) -> None:
+        self._handlers.append(handler)
+
+    def subscribe(self) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue) -> None:
+        self._subscribers.discard(queue)
+
+    def start(self) -> None:
+        if not self.running:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await self._save_position(force=True)
+
+    async def _publish(self, event: ChangeEvent) -> None:
+        for handler in self._handlers:
+            try:
+                await handler(event)
+            except Exception:
+                logger.exception(f"change feed {self.name} handler failed")
+        for queue in self._subscribers:
+            if queue.full():
+                # a slow client loses the oldest events rather than holding up the feed
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+    async def _load_position(self) -> Dict[str, Any]:
+        tokens = self.token_collection.get_collection()
+        stale = dt.datetime.utcnow() - dt.timedelta(seconds=STALE_POSITION_AGE)
+        await tokens.delete_many({"feed": self.name, "saved": {"$lt": stale}})
+        saved = await tokens.find_one({"_id": self.position_id})
+        return {} if saved is None else saved.get("position", {})
+
+    async def _save_position(self, force: bool = False) -> None:
+        if not self._position:
+            return
+        now = time.monotonic()
+        if not force and now - self._saved_at < self.save_interval:
+            return
+        self._saved_at = now
+        try:
+            await self.token_collection.get_collection().update_one(
+                {"_id": self.position_id},
+                {
+                    "$set": {
+                        "feed": self.name,
+                        "position": self._position,
+                        "saved": dt.datetime.utcnow(),
+                    }
+                },
+                upsert=True,
+            )
+        except PyMongoError as exc:
+            logger.warning(f"change feed {self.name} failed to save position {exc}")
+
+    async def _run(self) -> None:
+        loaded = False
+        while True:
+            try:
+                if not loaded:
+                    self._position = await self._load_position()
+                    loaded = True
+                if self.mode != "poll":
+                    self.mode = "stream"
+                    try:
+                        await self._watch()
+                    except OperationFailure as exc:
+                        if exc.code not in CHANGE_STREAM_UNSUPPORTED:
+                            raise
+                        logger.info(
+                            f"change feed {self.name} polls, no change streams: {exc}"
+                        )
+                        self.mode = "poll"
+                await self._poll()
+            except Exception:
+                # a feed that stops leaves the caches stale, keep trying whatever failed
+                logger.exception(
+                    f"change feed {self.name} failed, retry in {self.poll_interval}s"
+                )
+                await asyncio.sleep(self.poll_interval)
+
+    async def _watch(self) -> None:
+        while True:
+            resume_token = self._position.get("resume_token")
+            try:
+                async with self.collection.get_collection().watch(
+                    full_document="updateLookup", resume_after=resume_token
+                ) as stream:
+                    async for change in stream:
+                        await self._publish(self._stream_event(change))
+                        self._position = {"resume_token": stream.resume_token}
+                        await self._save_position()
+                        if change["operationType"] == "invalidate":
+                            break
+            except OperationFailure as exc:
+                if exc.code in CHANGE_STREAM_UNSUPPORTED:
+                    raise
+                if exc.code not in CHANGE_STREAM_HISTORY_LOST:
+                    logger.warning(f"change feed {self.name} stream failed {exc}")
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+                logger.warning(f"change feed {self.name} lost its position {exc}")
+                await self._publish(ChangeEvent(op="invalidate"))
+            except PyMongoError as exc:
+                # the driver resumes by itself once, keep trying while the server is away
+                logger.warning(f"change feed {self.name} stream failed {exc}")
+                await asyncio.sleep(self.poll_interval)
+                continue
+            # the stream cannot resume after an invalidate or lost history, start afresh
+            self._position = {}
+
+    @staticmethod
+    def _stream_event(change: Dict[str, Any]) -> ChangeEvent:
+        op = change["operationType"]
+        if op in COLLECTION_OPS:
+            return ChangeEvent(op=op)
+        document = change.get("fullDocument")
+        return ChangeEvent(
+            op=op,
+            id=change["documentKey"]["_id"],
+            key=None if document is None else document.get("key"),
+            document=document,
+        )
+
+    async def _poll(self) -> None:
+        since = self._position.get("updated") or now_ms()
+        # writes in the same millisecond can land after a poll so re-read `since` each time
+        # and skip the documents already published at it
+        seen_at_since = set(self._position.get("seen_ids", []))
+        while True:
+            try:
+                query = self.collection.get_collection().find(
+                    {"updated": {"$gte": since}}, sort=[("updated", 1)]
+                )
+                async for document in query:
+                    if (
+                        document["updated"] == since
+                        and document["_id"] in seen_at_since
+                    ):
+                        continue
+                    if document["updated"] > since:
+                        since = document["updated"]
+                        seen_at_since = set()
+                    seen_at_since.add(document["_id"])
+                    # a document never updated since it was created is an insert
+                    never_updated = document.get("created") == document["updated"]
+                    op = "insert" if never_updated else "update"
+                    await self._publish(
+                        ChangeEvent(
+                            op=op,
+                            id=document["_id"],
+                            key=document.get("key"),
+                            document=document,
+                        )
+                    )
+                self._position = {"updated": since, "seen_ids": list(seen_at_since)}
+                await self._save_position()
+            except PyMongoError as exc:
+                logger.warning(f"change feed {self.name} poll failed {exc}")
+            await asyncio.sleep(self.poll_interval)
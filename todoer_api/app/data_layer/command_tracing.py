@@ -0,0 +1,64 @@
+""" Spans for mongo commands from the driver's command monitoring events. """
+
+import time
+from typing import Any, Dict, Optional, Tuple
+from pymongo import monitoring
+from app.core.tracing import Span, current_span, tracer
+
+
+class CommandTracer(monitoring.CommandListener):
+    """Adds a span per command to the trace of the request that ran it.
+
+    Motor runs the driver in a thread pool with a copy of the caller's context, so the
+    current span when a command starts is the CRUD span that issued it. The span is recorded
+    when the command ends, timed by the driver. Only the command and collection names are
+    kept, never the filter or documents.
+    """
+
+    def __init__(self) -> None:
+        # (connection, request id) -> parent span, collection
+        self._started: Dict[Tuple[Any, int], Tuple[Span, Optional[str]]] = {}
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        parent = current_span()
+        if parent is None:
+            return
+        collection = event.command.get(event.command_name)
+        self._started[(event.connection_id, event.request_id)] = (
+            parent,
+            collection if isinstance(collection, str) else None,
+        )
+
+    def _end(self, event: Any, error: Optional[str] = None) -> None:
+        started = self._started.pop((event.connection_id, event.request_id), None)
+        if started is None:
+            return
+        parent, collection = started
+        end_ns = time.time_ns()
+        attributes = {
+            "db.system": "mongodb",
+            "db.name": event.database_name,
+            "db.operation": event.command_name,
+            "net.peer.name": event.connection_id[0],
+        }
+        if collection is not None:
+            attributes["db.mongodb.collection"] = collection
+        tracer.record(
+            parent,
+            f"mongo {event.command_name}",
+            "mongo",
+            end_ns - event.duration_micros * 1000,
+            end_ns,
+            error,
+            **attributes,
+        )
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        self._end(event)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        self._end(event, error=str(event.failure.get("errmsg", "command failed")))
+
+
+# one per process, registered with every client
+command_tracer = CommandTracer()
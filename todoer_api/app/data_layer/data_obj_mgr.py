@@ -1,12 +1,29 @@
-from typing import Any
+import time
+from typing import Any, List, Optional
+from pydantic import BaseModel
 from app.crud.base import CRUDMongoBase
 from app.crud import Task, User
-from .mongo_connection import MongoCollection
+from .mongo_connection import MongoCollection, release_mongo_connection
 from .id_generator import TaskIdGenerator
+from .indexes import IndexReport
+from .cache import CacheStats, TTLCache
+from .shared_cache import SharedCache
+from .change_feed import ChangeFeed
+from .slow_ops import SlowOpLog
 from app.crud.crud_task import CRUDTask
+from app.crud.crud_task_inmem import CRUDTaskInMem
+from .inmem_collection import InMemCollection
 from app.crud.crud_user import CRUDUser
 
 
+class WarmUpReport(BaseModel):
+    """What the warm-up at startup did, before the worker reports ready."""
+
+    connections: int
+    indexes_created: List[str]
+    duration_ms: float
+
+
 class DataObjectManager:
     """Class responsible for managing a specific persistent data object collection.
 
@@ -14,17 +31,43 @@ class DataObjectManager:
         ModelType, CreateSchemaType, UpdateSchemaType
     """
 
-    def __init__(self, collection: MongoCollection, id_gen: TaskIdGenerator) -> None:
+    def __init__(
+        self,
+        collection: MongoCollection,
+        id_gen: TaskIdGenerator,
+        return_mode: str = "server",
+        trusted_reads: bool = False,
+        task_cache: Optional[TTLCache] = None,
+        shared_cache: Optional[SharedCache] = None,
+        stats_cache: Optional[TTLCache] = None,
+        change_feed: Optional[ChangeFeed] = None,
+        slow_ops: Optional[SlowOpLog] = None,
+    ) -> None:
         super().__init__()
         self.db_type = "Data-object-manager-mongo"
         self.collection = collection
         self.id_gen = id_gen
-        task = CRUDTask(Task, self.collection, self.id_gen)
+        self.shared_cache = shared_cache
+        self.change_feed = change_feed
+        self.slow_ops = slow_ops
+        task = CRUDTask(
+            Task,
+            self.collection,
+            self.id_gen,
+            return_mode,
+            trusted_reads,
+            task_cache,
+            shared_cache,
+            stats_cache,
+            slow_ops,
+        )
         user = None  # cannot use same collection user = CRUDUser(User, self.collection)
         # self._factory = {"task": task, Task: task, "user": user, User: user}
         self._factory = {}
         self.add_manager("task", task)
         self.add_manager(Task, task)
+        if change_feed is not None:
+            change_feed.add_handler(task.apply_change)
 
     def add_manager(self, key: Any, obj_mgr: Any) -> None:
         self._factory[key] = obj_mgr
@@ -34,3 +77,98 @@ class DataObjectManager:
             return self._factory[object_type.lower()]
         else:
             return self._factory[object_type]
+
+    def _object_managers(self) -> List[CRUDMongoBase]:
+        # the same manager is registered under several keys
+        unique_mgrs = {id(obj_mgr): obj_mgr for obj_mgr in self._factory.values()}
+        return list(unique_mgrs.values())
+
+    async def ensure_indexes(self) -> List[IndexReport]:
+        """Create any missing indexes for all object managers and the ID generator."""
+        reports = [
+            await obj_mgr.ensure_indexes() for obj_mgr in self._object_managers()
+        ]
+        id_report = await self.id_gen.ensure_indexes()
+        return reports if id_report is None else reports + [id_report]
+
+    async def check_indexes(self) -> List[IndexReport]:
+        """Report missing and extra indexes without changing anything."""
+        reports = [await obj_mgr.check_indexes() for obj_mgr in self._object_managers()]
+        id_report = await self.id_gen.check_indexes()
+        return reports if id_report is None else reports + [id_report]
+
+    async def warm_up(self, connections: int = 1) -> WarmUpReport:
+        """Does the work the first requests would otherwise wait for: opens the pool,
+        ensures the indexes and runs a trial query. The caches are not primed, their entries
+        would expire after TASK_CACHE_TTL seconds, long before most are read.
+        **Parameters**
+        * `connections`: The number of connections to open e.g. the pool's minPoolSize
+        """
+        start = time.perf_counter()
+        opened = await self._open_connections(connections)
+        created = [
+            f"{report.collection}.{name}"
+            for report in await self.ensure_indexes()
+            for name in report.created
+        ]
+        for obj_mgr in self._object_managers():
+            await obj_mgr.warm_up()
+        return WarmUpReport(
+            connections=opened,
+            indexes_created=created,
+            duration_ms=round((time.perf_counter() - start) * 1000, 3),
+        )
+
+    async def _open_connections(self, connections: int) -> int:
+        await self.collection.get_connection().warm_up(connections)
+        return max(1, connections)
+
+    def cache_stats(self) -> List[CacheStats]:
+        caches = []
+        for obj_mgr in self._object_managers():
+            caches.append(obj_mgr.cache)
+            caches.append(getattr(obj_mgr, "stats_cache", None))
+        return [cache.stats() for cache in caches if cache is not None]
+
+    def start_change_feed(self) -> None:
+        """Start watching for writes by other processes, needs a running event loop."""
+        if self.change_feed is not None:
+            self.change_feed.start()
+
+    async def close(self) -> None:
+        """Return unused ids and release the connections, the mongo client is shared."""
+        if self.change_feed is not None:
+            await self.change_feed.stop()
+        await self.id_gen.close()
+        if self.shared_cache is not None:
+            await self.shared_cache.close()
+        release_mongo_connection(self.collection.get_connection())
+
+
+class InMemDataObjectManager(DataObjectManager):
+    """DataObjectManager keeping the tasks in process memory, each worker has its own tasks."""
+
+    def __init__(
+        self,
+        collection: InMemCollection,
+        id_gen: TaskIdGenerator,
+        return_mode: str = "server",
+        trusted_reads: bool = False,
+    ) -> None:
+        self.db_type = "Data-object-manager-in-memory"
+        self.collection = collection
+        self.id_gen = id_gen
+        self.shared_cache = None
+        self.change_feed = None
+        self.slow_ops = None
+        task = CRUDTaskInMem(Task, collection, id_gen, return_mode, trusted_reads)
+        self._factory = {}
+        self.add_manager("task", task)
+        self.add_manager(Task, task)
+
+    async def _open_connections(self, connections: int) -> int:
+        # nothing to connect to
+        return 0
+
+    async def close(self) -> None:
+        await self.id_gen.close()
@@ -1,7 +1,8 @@
 # import imp
 # from sqlite3 import connect
+import asyncio
 import datetime as dt
-from typing import Any, List, Union
+from typing import Any, Dict, List, Optional, Union
 
 # from app.core.config import get_logger
 # from motor.motor_asyncio import (
@@ -15,6 +16,7 @@ from app.model.base import ObjectId
 from app.model.task import Task, TaskCreate, TaskPartialUpdate, TaskUpdate
 from .mongo_connection import MongoCollection
 from .dl_exception import DataLayerException
+from .indexes import IndexSpec, IndexReport, check_indexes, ensure_indexes
 
 logger = get_logger("data layer")
 
@@ -27,11 +29,26 @@ class TaskIdGenerator:
     def get_next_id(self, index: Any) -> int:
         pass
 
+    def get_next_ids(self, index: Any, count: int) -> int:
+        """Reserve `count` contiguous ids for index and return the first of them."""
+        pass
+
     async def reset(self):
         pass
 
+    async def ensure_indexes(self) -> Optional[IndexReport]:
+        return None
+
+    async def check_indexes(self) -> Optional[IndexReport]:
+        return None
+
+    async def close(self) -> None:
+        pass
+
 
 class TaskIdGeneratorMogo(TaskIdGenerator):
+    INDEXES = [IndexSpec(name="index_unique", keys=[("index", 1)], unique=True)]
+
     def __init__(self, collection: MongoCollection) -> None:
         super().__init__()
         self.collection: MongoCollection = collection
@@ -48,6 +65,16 @@ class TaskIdGeneratorMogo(TaskIdGenerator):
         )
         return rslt["next_id"]
 
+    async def get_next_ids(self, index: str, count: int) -> int:
+        # reserve a contiguous block with a single $inc, the block is (next_id - count, next_id]
+        rslt = await self.collection.get_collection().find_one_and_update(
+            {"index": index},
+            {"$inc": {"next_id": count}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return rslt["next_id"] - count + 1
+
     async def get_next_id_deprecated(self, index: str) -> int:
         index_dict = {"index": index}
         id_list = list(self.collection().find(index_dict))
@@ -70,6 +97,74 @@ class TaskIdGeneratorMogo(TaskIdGenerator):
     async def reset(self):
         await self.collection.drop_db()
 
+    async def ensure_indexes(self) -> IndexReport:
+        return await ensure_indexes(self.collection, self.INDEXES)
+
+    async def check_indexes(self) -> IndexReport:
+        return await check_indexes(self.collection, self.INDEXES)
+
+
+class TaskIdGeneratorMongoLeased(TaskIdGeneratorMogo):
+    """Leases blocks of ids from the mongo counter and hands them out locally.
+
+    One $inc per block_size ids per project instead of one per task, so concurrent creates
+    do not contend on the counter document. Ids stay unique but are only ordered by creation
+    within a worker. The unused part of a block is lost unless returned by close(), which only
+    works if no other worker has leased after it.
+    """
+
+    def __init__(
+        self,
+        collection: MongoCollection,
+        block_size: int = 100,
+        release_on_close: bool = True,
+    ) -> None:
+        super().__init__(collection)
+        if block_size < 1:
+            raise ValueError(f"Block size must be positive not {block_size}")
+        self.block_size = block_size
+        self.release_on_close = release_on_close
+        # index -> [next id to hand out, last id of the block]
+        self._blocks: Dict[str, List[int]] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    async def get_next_id(self, index: str) -> int:
+        return await self.get_next_ids(index, 1)
+
+    async def get_next_ids(self, index: str, count: int) -> int:
+        # one lock per project, only held across the DB call when a new block is leased
+        lock = self._locks.setdefault(index, asyncio.Lock())
+        async with lock:
+            block = self._blocks.get(index)
+            if block is None or block[1] - block[0] + 1 < count:
+                # the rest of a block too small for the request is lost
+                lease_size = max(count, self.block_size)
+                first_id = await super().get_next_ids(index, lease_size)
+                block = [first_id, first_id + lease_size - 1]
+                self._blocks[index] = block
+                logger.info(f"Leased ids {block[0]}-{block[1]} for {index}")
+            first_id = block[0]
+            block[0] += count
+            return first_id
+
+    async def close(self) -> None:
+        """Return the unused ids of each block if the block is still the latest leased."""
+        if self.release_on_close:
+            for index, (next_id, last_id) in self._blocks.items():
+                if next_id > last_id:
+                    continue
+                result = await self.collection.get_collection().update_one(
+                    {"index": index, "next_id": last_id},
+                    {"$set": {"next_id": next_id - 1}},
+                )
+                if result.modified_count:
+                    logger.info(f"Returned ids {next_id}-{last_id} for {index}")
+        self._blocks.clear()
+
+    async def reset(self):
+        self._blocks.clear()
+        await super().reset()
+
 
 class TaskIdGeneratorInmem(TaskIdGenerator):
     def __init__(self) -> None:
@@ -77,7 +172,7 @@ class TaskIdGeneratorInmem(TaskIdGenerator):
         # id indexed by: user: str, project: str
         self.ids = {}
 
-    def get_next_id(self, index: Any) -> int:
+    async def get_next_id(self, index: Any) -> int:
         # # index = (user, project)
         # index = project
         try:
@@ -88,5 +183,10 @@ class TaskIdGeneratorInmem(TaskIdGenerator):
             self.ids[index] = self.INIT_VALUE + 1
             return self.INIT_VALUE
 
-    def reset(self):
+    async def get_next_ids(self, index: Any, count: int) -> int:
+        first_id = self.ids.get(index, self.INIT_VALUE)
+        self.ids[index] = first_id + count
+        return first_id
+
+    async def reset(self):
         self.ids = {}
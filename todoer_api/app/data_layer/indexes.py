@@ -0,0 +1,60 @@
+""" Declarative index definitions that are ensured idempotently on mongo collections. """
+
+from typing import List, Tuple
+from pydantic import BaseModel, Field
+from pymongo import IndexModel
+from .mongo_connection import MongoCollection
+
+# always present and not declared
+DEFAULT_INDEX_NAME = "_id_"
+
+
+class IndexSpec(BaseModel):
+    """An index a collection must have, the name identifies it when checking."""
+
+    name: str
+    keys: List[Tuple[str, int]]
+    unique: bool = False
+
+    def to_index_model(self) -> IndexModel:
+        return IndexModel(self.keys, name=self.name, unique=self.unique)
+
+
+class IndexReport(BaseModel):
+    """State of the declared indexes of a collection."""
+
+    collection: str
+    created: List[str] = Field(default_factory=list)
+    missing: List[str] = Field(default_factory=list)
+    extra: List[str] = Field(default_factory=list)
+
+
+async def check_indexes(
+    collection: MongoCollection, specs: List[IndexSpec]
+) -> IndexReport:
+    """Compare the declared indexes with those on the collection, a changed definition is missing."""
+    info = await collection.index_information()
+    report = IndexReport(collection=collection.name)
+    for spec in specs:
+        existing = info.get(spec.name)
+        if (
+            existing is None
+            or [tuple(key) for key in existing["key"]] != spec.keys
+            or existing.get("unique", False) != spec.unique
+        ):
+            report.missing.append(spec.name)
+    declared = {spec.name for spec in specs}
+    report.extra = [
+        name for name in info if name != DEFAULT_INDEX_NAME and name not in declared
+    ]
+    return report
+
+
+async def ensure_indexes(
+    collection: MongoCollection, specs: List[IndexSpec]
+) -> IndexReport:
+    """Create the declared indexes, createIndexes is a no-op for indexes that already exist."""
+    created = await collection.create_indexes([spec.to_index_model() for spec in specs])
+    report = await check_indexes(collection, specs)
+    report.created = created
+    return report
@@ -0,0 +1,286 @@
+""" Documents held in process memory with sorted secondary indexes, for running without mongo.
+
+Each index is a sorted list of (value, _id) entries kept with bisect, so an equality lookup
+or a page from a cursor position is O(log n + k). Inserts and deletes shift the list which
+is a memmove, fast at the sizes a single process holds. Filters are the subset of the mongo
+query language the CRUD classes build: equality, $in, $all, $gt(e), $lt(e), $ne, $and, $or.
+"""
+
+import bisect
+import heapq
+import itertools
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from pymongo.errors import DuplicateKeyError
+from app.model.base import ObjectId
+
+
+class _Max:
+    """Sorts after every value, to find the end of a run of equal values."""
+
+    def __lt__(self, other: Any) -> bool:
+        return False
+
+    def __gt__(self, other: Any) -> bool:
+        return True
+
+
+_MAX = _Max()
+
+
+def sort_key(value: Any) -> Tuple:
+    # null sorts first as in mongo and is never compared with a value
+    return (False,) if value is None else (True, value)
+
+
+class SortedIndex:
+    """Entries of (sort_key(value), _id) in order, unique indexes reject a repeated value."""
+
+    def __init__(self, field: str, unique: bool = False) -> None:
+        self.field = field
+        self.unique = unique
+        self._entries: List[Tuple[Tuple, ObjectId]] = []
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _entry(self, doc: Dict) -> Tuple[Tuple, ObjectId]:
+        return (sort_key(doc.get(self.field)), doc["_id"])
+
+    def check(self, doc: Dict) -> None:
+        """Raise DuplicateKeyError if adding the document breaks the unique constraint."""
+        if not self.unique:
+            return
+        for _id in self.equal(doc.get(self.field)):
+            if _id != doc["_id"]:
+                raise DuplicateKeyError(
+                    f"E11000 duplicate key {self.field}: {doc.get(self.field)}"
+                )
+
+    def add(self, doc: Dict) -> None:
+        bisect.insort(self._entries, self._entry(doc))
+
+    def remove(self, doc: Dict) -> None:
+        entry = self._entry(doc)
+        pos = bisect.bisect_left(self._entries, entry)
+        if pos < len(self._entries) and self._entries[pos] == entry:
+            del self._entries[pos]
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def equal(self, value: Any) -> Iterator[ObjectId]:
+        """The ids of the documents with the value, in _id order."""
+        key = sort_key(value)
+        start = bisect.bisect_left(self._entries, (key,))
+        end = bisect.bisect_right(self._entries, (key, _MAX))
+        return (_id for _, _id in itertools.islice(self._entries, start, end))
+
+    def count(self, value: Any) -> int:
+        key = sort_key(value)
+        return bisect.bisect_right(self._entries, (key, _MAX)) - bisect.bisect_left(
+            self._entries, (key,)
+        )
+
+    def scan(
+        self,
+        ascending: bool = True,
+        after: Optional[Tuple[Any, ObjectId]] = None,
+    ) -> Iterator[ObjectId]:
+        """The ids in (value, _id) order, starting after the (value, _id) position if given."""
+        if ascending:
+            start = 0
+            if after is not None:
+                start = bisect.bisect_right(
+                    self._entries, (sort_key(after[0]), after[1])
+                )
+            return (_id for _, _id in itertools.islice(self._entries, start, None))
+        end = len(self._entries)
+        if after is not None:
+            end = bisect.bisect_left(self._entries, (sort_key(after[0]), after[1]))
+        return (self._entries[pos][1] for pos in range(end - 1, -1, -1))
+
+
+def _match_op(value: Any, op: str, arg: Any) -> bool:
+    values = value if isinstance(value, list) else [value]
+    if op == "$eq":
+        return arg in values or value == arg
+    if op == "$ne":
+        return not _match_op(value, "$eq", arg)
+    if op == "$in":
+        return any(val in arg for val in values)
+    if op == "$all":
+        return isinstance(value, list) and all(val in value for val in arg)
+    comparisons: Dict[str, Callable[[Any, Any], bool]] = {
+        "$gt": lambda a, b: a > b,
+        "$gte": lambda a, b: a >= b,
+        "$lt": lambda a, b: a < b,
+        "$lte": lambda a, b: a <= b,
+    }
+    if op in comparisons:
+        return value is not None and comparisons[op](value, arg)
+    raise ValueError(f"Unsupported query operator {op}")
+
+
+def matches(doc: Dict, filter: Dict) -> bool:
+    """True if the document matches the mongo style filter."""
+    for field, cond in filter.items():
+        if field == "$and":
+            if not all(matches(doc, sub_filter) for sub_filter in cond):
+                return False
+        elif field == "$or":
+            if not any(matches(doc, sub_filter) for sub_filter in cond):
+                return False
+        elif isinstance(cond, dict) and cond and next(iter(cond)).startswith("$"):
+            value = doc.get(field)
+            if not all(_match_op(value, op, arg) for op, arg in cond.items()):
+                return False
+        elif not _match_op(doc.get(field), "$eq", cond):
+            return False
+    return True
+
+
+def project(doc: Dict, projection: Optional[Dict[str, Any]]) -> Dict:
+    """The fields of an inclusion projection plus _id, the document itself without one."""
+    if projection is None:
+        return doc
+    return {
+        field: val
+        for field, val in doc.items()
+        if field == "_id" or projection.get(field)
+    }
+
+
+class InMemCollection:
+    """Documents by _id with the secondary indexes given, the documents returned are shared
+    and must not be modified, updates store a new document."""
+
+    def __init__(
+        self, name: str, index_fields: Iterable[str], unique_fields: Iterable[str] = ()
+    ) -> None:
+        self.name = name
+        unique_fields = set(unique_fields)
+        self._docs: Dict[ObjectId, Dict] = {}
+        self.indexes: Dict[str, SortedIndex] = {"_id": SortedIndex("_id", unique=True)}
+        for field in index_fields:
+            self.indexes[field] = SortedIndex(field, unique=field in unique_fields)
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    def get_collection(self) -> "InMemCollection":
+        # stands in for a MongoCollection, the collection is the store itself
+        return self
+
+    def get(self, id: Any) -> Optional[Dict]:
+        return self._docs.get(id)
+
+    def find_one(self, field: str, value: Any) -> Optional[Dict]:
+        if field == "_id":
+            return self._docs.get(value)
+        index = self.indexes.get(field)
+        if index is None:
+            return next((doc for doc in self.find({field: value})), None)
+        _id = next(index.equal(value), None)
+        return None if _id is None else self._docs[_id]
+
+    def insert(self, doc: Dict) -> Dict:
+        """Adds the document, raising DuplicateKeyError if a unique value is taken."""
+        if doc["_id"] in self._docs:
+            raise DuplicateKeyError(f"E11000 duplicate key _id: {doc['_id']}")
+        for index in self.indexes.values():
+            index.check(doc)
+        for index in self.indexes.values():
+            index.add(doc)
+        self._docs[doc["_id"]] = doc
+        return doc
+
+    def update(self, id: Any, set_data: Dict) -> Optional[Dict]:
+        """Stores the document with the fields set, only indexes of changed fields move."""
+        old_doc = self._docs.get(id)
+        if old_doc is None:
+            return None
+        new_doc = {**old_doc, **set_data}
+        changed = [
+            index
+            for field, index in self.indexes.items()
+            if old_doc.get(field) != new_doc.get(field)
+        ]
+        for index in changed:
+            index.check(new_doc)
+        for index in changed:
+            index.remove(old_doc)
+            index.add(new_doc)
+        self._docs[id] = new_doc
+        return new_doc
+
+    def delete(self, id: Any) -> Optional[Dict]:
+        doc = self._docs.pop(id, None)
+        if doc is not None:
+            for index in self.indexes.values():
+                index.remove(doc)
+        return doc
+
+    def clear(self) -> None:
+        self._docs.clear()
+        for index in self.indexes.values():
+            index.clear()
+
+    def _equality_index(self, filter: Dict) -> Optional[Tuple[SortedIndex, Any]]:
+        """The most selective index with an equality condition in the filter, if any."""
+        candidates = [
+            (self.indexes[field], cond)
+            for field, cond in filter.items()
+            if field in self.indexes
+            and not isinstance(cond, (dict, list))
+            and field != "_id"
+        ]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda candidate: candidate[0].count(candidate[1]))
+
+    def find(
+        self,
+        filter: Dict,
+        *,
+        sort_field: str = "_id",
+        ascending: bool = True,
+        after: Optional[Tuple[Any, ObjectId]] = None,
+        skip: int = 0,
+        limit: int = 0,
+    ) -> Iterator[Dict]:
+        """The matching documents in (sort_field, _id) order after the (value, _id) position.
+
+        With an equality condition on an index only the documents with that value are read
+        and the top skip + limit of them selected. Otherwise the sort index is walked from the
+        position until enough documents match, a limit of 0 returns all.
+        """
+        sort_index = self.indexes.get(sort_field)
+        if sort_index is None:
+            raise ValueError(f"Cannot sort on {sort_field}, it is not indexed")
+        stop = skip + limit if limit > 0 else None
+        equality = self._equality_index(filter)
+        if equality is not None:
+            index, value = equality
+            docs = (self._docs[_id] for _id in index.equal(value))
+            docs = (doc for doc in docs if matches(doc, filter))
+
+            def order(doc: Dict) -> Tuple:
+                return (sort_key(doc.get(sort_field)), doc["_id"])
+
+            if after is not None:
+                position = (sort_key(after[0]), after[1])
+                if ascending:
+                    docs = (doc for doc in docs if order(doc) > position)
+                else:
+                    docs = (doc for doc in docs if order(doc) < position)
+            if stop is None:
+                ordered = sorted(docs, key=order, reverse=not ascending)
+            elif ascending:
+                ordered = heapq.nsmallest(stop, docs, key=order)
+            else:
+                ordered = heapq.nlargest(stop, docs, key=order)
+            return iter(ordered[skip:])
+        docs = (self._docs[_id] for _id in sort_index.scan(ascending, after))
+        if filter:
+            docs = (doc for doc in docs if matches(doc, filter))
+        return itertools.islice(docs, skip, stop)
@@ -1,3 +1,7 @@
+import asyncio
+import os
+from typing import Any, Dict, List, Optional, Tuple
+from pymongo import IndexModel
 from motor.motor_asyncio import (
     AsyncIOMotorClient,
     AsyncIOMotorDatabase,
@@ -5,18 +9,46 @@ from motor.motor_asyncio import (
 )
 
 
+from .command_tracing import command_tracer
+from .pool_metrics import pool_metrics
+
+
 class MongoConnection:
-    def __init__(self, username: str, password: str, host: str) -> None:
+    def __init__(
+        self,
+        username: str,
+        password: str,
+        host: str,
+        port: int = 27017,
+        **client_options: Any,
+    ) -> None:
+        """
+        **Parameters**
+        * `client_options`: passed to the client e.g. maxPoolSize, compressors, w
+        """
         self._username = username
         self._password = password
         self._host = host
-        self._url = f"mongodb://{self._username}:{self._password}@{self._host}:27017/"
-        self._client: AsyncIOMotorClient = AsyncIOMotorClient(self._url)
+        self._url = f"mongodb://{self._username}:{self._password}@{self._host}:{port}/"
+        self._client: AsyncIOMotorClient = AsyncIOMotorClient(
+            self._url, event_listeners=[pool_metrics, command_tracer], **client_options
+        )
         # note DONOT explicitly del self._client in dstructor - problems
 
+    def close(self) -> None:
+        self._client.close()
+
     def __call__(self) -> AsyncIOMotorClient:
         return self._client
 
+    async def warm_up(self, connections: int = 1) -> None:
+        """Selects a server and opens up to `connections` pooled connections, by running
+        that many pings at once. The driver only opens connections when they are needed."""
+        admin = self._client.admin
+        await asyncio.gather(
+            *(admin.command("ping") for _ in range(max(1, connections)))
+        )
+
     @property
     def url(self) -> str:
         return self._url
@@ -43,6 +75,10 @@ class MongoCollection:
     def __call__(self) -> AsyncIOMotorCollection:
         return self.get_collection()
 
+    @property
+    def name(self) -> str:
+        return f"{self._db_name}.{self._collection_name}"
+
     def get_connection(self) -> MongoConnection:
         return self._mongo_connection
 
@@ -55,8 +91,77 @@ class MongoCollection:
     async def count_documents(self) -> int:
         return await self.get_collection().count_documents({})
 
+    async def estimated_document_count(self) -> int:
+        """Count from the collection metadata, no documents are scanned."""
+        return await self.get_collection().estimated_document_count()
+
+    async def create_indexes(self, indexes: List[IndexModel]) -> List[str]:
+        if not indexes:
+            return []
+        return await self.get_collection().create_indexes(indexes)
+
+    async def index_information(self) -> Dict[str, Any]:
+        return await self.get_collection().index_information()
+
     async def drop_db(self) -> None:
         await self._mongo_connection.client.drop_database(self._db_name)
 
     def __str__(self) -> str:
         return f"MongoCollection:db={self._db_name}, collection={self._collection_name}, mongo_connection={str(self._mongo_connection)}"
+
+
+# region connection registry
+# one client (and so one pool) per process for each set of connection settings, shared by
+# every user and closed when the last one releases it
+
+_connections: Dict[Tuple, MongoConnection] = {}
+_connection_users: Dict[Tuple, int] = {}
+
+
+def _registry_key(host: str, port: int, username: str, client_options: Dict) -> Tuple:
+    # clients must not be shared across a fork so the pid is part of the key
+    return (os.getpid(), host, port, username, tuple(sorted(client_options.items())))
+
+
+def acquire_mongo_connection(
+    username: str, password: str, host: str, port: int = 27017, **client_options: Any
+) -> MongoConnection:
+    """Returns the process wide connection for the settings, creating it on first use."""
+    key = _registry_key(host, port, username, client_options)
+    if key not in _connections:
+        _connections[key] = MongoConnection(
+            username, password, host, port, **client_options
+        )
+        _connection_users[key] = 0
+    _connection_users[key] += 1
+    return _connections[key]
+
+
+def release_mongo_connection(mongo_conn: MongoConnection) -> None:
+    """Release a connection from acquire_mongo_connection, closing it if no longer used."""
+    for key, conn in list(_connections.items()):
+        if conn is mongo_conn:
+            _connection_users[key] -= 1
+            if _connection_users[key] <= 0:
+                del _connections[key]
+                del _connection_users[key]
+                conn.close()
+            return
+
+
+def get_mongo_connections() -> List[MongoConnection]:
+    return list(_connections.values())
+
+
+def forget_inherited_connections() -> None:
+    """Drops the connections of the parent process from the registry, call after a fork.
+
+    They are not closed, closing would end the parent's sessions on sockets the child shares.
+    """
+    pid = os.getpid()
+    for key in [key for key in _connections if key[0] != pid]:
+        del _connections[key]
+        del _connection_users[key]
+
+
+# endregion
@@ -0,0 +1,99 @@
+""" Connection pool metrics collected from the driver's CMAP (connection monitoring) events. """
+
+import threading
+import time
+from pydantic import BaseModel
+from pymongo import monitoring
+
+
+class PoolStats(BaseModel):
+    pools: int
+    connections: int
+    checked_out: int
+    checkouts: int
+    checkout_failures: int
+    checkout_wait_ms_total: float
+    checkout_wait_ms_max: float
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """Counts connections and check outs across all pools of the clients it is registered with.
+
+    Motor runs the driver in a thread pool, a check out starts and completes on the same thread
+    so the start time is kept per thread to give the wait time.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.pools = 0
+        self.connections = 0
+        self.checked_out = 0
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.wait_secs_total = 0.0
+        self.wait_secs_max = 0.0
+
+    def stats(self) -> PoolStats:
+        with self._lock:
+            return PoolStats(
+                pools=self.pools,
+                connections=self.connections,
+                checked_out=self.checked_out,
+                checkouts=self.checkouts,
+                checkout_failures=self.checkout_failures,
+                checkout_wait_ms_total=round(self.wait_secs_total * 1000, 3),
+                checkout_wait_ms_max=round(self.wait_secs_max * 1000, 3),
+            )
+
+    def _wait_secs(self) -> float:
+        started = getattr(self._local, "check_out_started", None)
+        self._local.check_out_started = None
+        return 0.0 if started is None else time.perf_counter() - started
+
+    def pool_created(self, event) -> None:
+        with self._lock:
+            self.pools += 1
+
+    def pool_cleared(self, event) -> None:
+        pass
+
+    def pool_closed(self, event) -> None:
+        with self._lock:
+            self.pools -= 1
+
+    def connection_created(self, event) -> None:
+        with self._lock:
+            self.connections += 1
+
+    def connection_ready(self, event) -> None:
+        pass
+
+    def connection_closed(self, event) -> None:
+        with self._lock:
+            self.connections -= 1
+
+    def connection_check_out_started(self, event) -> None:
+        self._local.check_out_started = time.perf_counter()
+
+    def connection_check_out_failed(self, event) -> None:
+        wait_secs = self._wait_secs()
+        with self._lock:
+            self.checkout_failures += 1
+            self.wait_secs_total += wait_secs
+
+    def connection_checked_out(self, event) -> None:
+        wait_secs = self._wait_secs()
+        with self._lock:
+            self.checked_out += 1
+            self.checkouts += 1
+            self.wait_secs_total += wait_secs
+            self.wait_secs_max = max(self.wait_secs_max, wait_secs)
+
+    def connection_checked_in(self, event) -> None:
+        with self._lock:
+            self.checked_out -= 1
+
+
+# one per process shared by all clients
+pool_metrics = PoolMetrics()
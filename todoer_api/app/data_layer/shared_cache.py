@@ -0,0 +1,109 @@
+""" Cache of serialised JSON task responses in redis, shared by all gunicorn workers.
+
+Keys are versioned:
+    <prefix>:v<CACHE_VERSION>:tasks:gen                      -> generation of all the tasks
+    <prefix>:v<CACHE_VERSION>:taskver:<task key>             -> version of the task
+    <prefix>:v<CACHE_VERSION>:task:<gen>:<task key>:<ver>    -> JSON of the task
+    <prefix>:v<CACHE_VERSION>:pages:gen                      -> generation of the list pages
+    <prefix>:v<CACHE_VERSION>:page:<gen>:<query digest>      -> next cursor + JSON of the page
+A write bumps the version of the tasks it changed and the page generation, so the old
+entries are never read again and expire by TTL. Bump CACHE_VERSION when the serialised format
+changes.
+"""
+
+import hashlib
+from typing import Any, Optional, Tuple
+from bson import json_util
+from .dl_exception import DataLayerException
+
+CACHE_VERSION = 2
+# task versions outlive the entries stored under them, see task_key
+VERSION_TTL_FACTOR = 10
+
+
+class SharedCache:
+    """Task and list page JSON in redis, the client can be any redis.asyncio compatible client."""
+
+    def __init__(self, client: Any, prefix: str = "todoer", ttl: int = 60) -> None:
+        self.client = client
+        self.ttl = ttl
+        self._prefix = f"{prefix}:v{CACHE_VERSION}"
+        self._gen_key = f"{self._prefix}:pages:gen"
+        self._tasks_gen_key = f"{self._prefix}:tasks:gen"
+
+    @classmethod
+    def from_url(cls, url: str, max_connections: int = 20, **kwargs) -> "SharedCache":
+        """Shared cache with a pooled client, connections are made on first use."""
+        # imported on first use, most deployments run without redis
+        try:
+            from redis import asyncio as aioredis
+        except ImportError:  # optional dependency
+            raise DataLayerException("Shared cache needs the redis package installed")
+        pool = aioredis.ConnectionPool.from_url(url, max_connections=max_connections)
+        return cls(aioredis.Redis(connection_pool=pool), **kwargs)
+
+    def _version_key(self, task_key: str) -> str:
+        return f"{self._prefix}:taskver:{task_key}"
+
+    async def task_key(self, task_key: str) -> str:
+        """Key of the task at its current version.
+
+        As for page_key get the key before querying the DB, then a task read before a
+        concurrent write is stored under the old version and is never read. A version key
+        expires VERSION_TTL_FACTOR times later than the entries, so by the time it restarts
+        from 0 every entry stored under an old version has expired.
+        """
+        gen, ver = await self.client.mget(
+            self._tasks_gen_key, self._version_key(task_key)
+        )
+        return f"{self._prefix}:task:{int(gen or 0)}:{task_key}:{int(ver or 0)}"
+
+    async def page_key(self, query: Any) -> str:
+        """Key of the page for the query in the current generation.
+
+        Get the key before querying the DB, then a page built from data older than a
+        concurrent write is stored under the old generation and is never read.
+        """
+        gen = await self.client.get(self._gen_key)
+        digest = hashlib.sha1(json_util.dumps(query, sort_keys=True).encode())
+        return f"{self._prefix}:page:{int(gen or 0)}:{digest.hexdigest()}"
+
+    async def get_task(self, cache_key: str) -> Optional[bytes]:
+        return await self.client.get(cache_key)
+
+    async def set_task(self, cache_key: str, content: bytes) -> None:
+        await self.client.set(cache_key, content, ex=self.ttl)
+
+    async def get_page(self, page_key: str) -> Optional[Tuple[bytes, Optional[str]]]:
+        """Returns (content, next_cursor) of the page or `None` if not cached."""
+        cached = await self.client.get(page_key)
+        if cached is None:
+            return None
+        next_cursor, content = cached.split(b"\n", 1)
+        return content, next_cursor.decode() or None
+
+    async def set_page(
+        self, page_key: str, content: bytes, next_cursor: Optional[str]
+    ) -> None:
+        # cursors are base64 so the first line holds it
+        value = (next_cursor or "").encode() + b"\n" + content
+        await self.client.set(page_key, value, ex=self.ttl)
+
+    async def invalidate(self, *task_keys: str) -> None:
+        """Drop the given tasks and all list pages."""
+        async with self.client.pipeline(transaction=False) as pipe:
+            for task_key in task_keys:
+                version_key = self._version_key(task_key)
+                pipe.incr(version_key)
+                pipe.expire(version_key, self.ttl * VERSION_TTL_FACTOR)
+            pipe.incr(self._gen_key)
+            await pipe.execute()
+
+    async def invalidate_all(self) -> None:
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.incr(self._tasks_gen_key)
+            pipe.incr(self._gen_key)
+            await pipe.execute()
+
+    async def close(self) -> None:
+        await self.client.close()
@@ -0,0 +1,150 @@
+""" Log of DB operations slower than a threshold, to find queries missing an index.
+
+Each slow operation is kept with the shape of its filter, its values replaced by "?" so no
+task data is held, and optionally the query plan from explain() run after the operation.
+Only the last maxlen operations are kept, per process.
+"""
+
+import asyncio
+import datetime as dt
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple
+from pydantic import BaseModel
+from pymongo.errors import PyMongoError
+from app.core.config import get_logger
+
+logger = get_logger("data layer")
+
+REDACTED = "?"
+
+
+class SlowOp(BaseModel):
+    at: dt.datetime
+    collection: str
+    op: str
+    duration_ms: float
+    filter: Any
+    sort: Optional[Any] = None
+    skip: int = 0
+    limit: int = 0
+    docs: int
+    # stages of the winning plan outermost first e.g. ["FETCH", "IXSCAN"], with explain
+    plan: Optional[List[str]] = None
+    indexes: Optional[List[str]] = None
+    collscan: Optional[bool] = None
+
+
+def redact(value: Any) -> Any:
+    """The shape of a filter or pipeline, field names and operators with the values as "?"."""
+    if isinstance(value, dict):
+        return {key: redact(val) for key, val in value.items()}
+    if isinstance(value, list) and value and all(isinstance(v, dict) for v in value):
+        # $and, $or and pipelines, a list of values is a single value
+        return [redact(val) for val in value]
+    return REDACTED
+
+
+def plan_summary(explain: Dict) -> Tuple[List[str], List[str]]:
+    """The stages and indexes of the winning plan of find or aggregate explain output."""
+    stages: List[str] = []
+    indexes: List[str] = []
+
+    def walk(node: Any) -> None:
+        if isinstance(node, list):
+            for child in node:
+                walk(child)
+        elif isinstance(node, dict):
+            if isinstance(node.get("stage"), str):
+                stages.append(node["stage"])
+                if "indexName" in node:
+                    indexes.append(node["indexName"])
+            for key, child in node.items():
+                if key != "rejectedPlans":
+                    walk(child)
+
+    walk(explain)
+    return stages, indexes
+
+
+class SlowOpLog:
+    """The last maxlen operations that took at least threshold_ms, newest last."""
+
+    def __init__(
+        self, threshold_ms: float, maxlen: int = 100, explain: bool = False
+    ) -> None:
+        self.threshold_ms = threshold_ms
+        self.explain = explain
+        self._ops: Deque[SlowOp] = deque(maxlen=maxlen)
+        self._explaining: Set[asyncio.Task] = set()
+
+    def check(
+        self,
+        collection: str,
+        op: str,
+        duration_secs: float,
+        filter: Any,
+        docs: int,
+        *,
+        sort: Optional[Any] = None,
+        skip: int = 0,
+        limit: int = 0,
+        explain: Optional[Callable[[], Awaitable[Dict]]] = None,
+    ) -> Optional[SlowOp]:
+        """Records the operation if it was slow, explain is called after to add the plan.
+        **Parameters**
+        * `filter`: The filter or pipeline, only its shape is kept
+        * `docs`: The number of documents returned or changed
+        * `explain`: Returns the explain output of the operation, used if explain is on
+        """
+        duration_ms = duration_secs * 1000
+        if duration_ms < self.threshold_ms:
+            return None
+        slow_op = SlowOp(
+            at=dt.datetime.now(dt.timezone.utc),
+            collection=collection,
+            op=op,
+            duration_ms=round(duration_ms, 3),
+            filter=redact(filter),
+            sort=sort,
+            skip=skip,
+            limit=limit,
+            docs=docs,
+        )
+        self._ops.append(slow_op)
+        logger.warning(
+            f"slow {op} on {collection} {slow_op.duration_ms}ms filter={slow_op.filter} "
+            f"sort={sort} skip={skip} limit={limit} docs={docs}"
+        )
+        if self.explain and explain is not None:
+            # off the request path, the plan is added to the record when it arrives
+            task = asyncio.create_task(self._add_plan(slow_op, explain))
+            self._explaining.add(task)
+            task.add_done_callback(self._explaining.discard)
+        return slow_op
+
+    async def _add_plan(
+        self, slow_op: SlowOp, explain: Callable[[], Awaitable[Dict]]
+    ) -> None:
+        try:
+            output = await explain()
+        except PyMongoError as exc:
+            logger.warning(f"explain of slow {slow_op.op} failed {exc}")
+            return
+        slow_op.plan, slow_op.indexes = plan_summary(output)
+        slow_op.collscan = "COLLSCAN" in slow_op.plan
+        if slow_op.collscan:
+            logger.warning(
+                f"slow {slow_op.op} on {slow_op.collection} is a collection scan "
+                f"filter={slow_op.filter}"
+            )
+
+    async def wait_explained(self) -> None:
+        """Waits for the explains in progress."""
+        if self._explaining:
+            await asyncio.gather(*self._explaining)
+
+    def ops(self) -> List[SlowOp]:
+        return list(self._ops)
+
+    def clear(self) -> None:
+        self._ops.clear()
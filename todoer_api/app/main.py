@@ -1,13 +1,18 @@
-from operator import ge
-from typing import List, Optional, Tuple, Dict
+import functools
+from typing import Any, List, Optional, Tuple, Dict, Union
 from fastapi import FastAPI, HTTPException, Depends, Query, status
-from fastapi.templating import Jinja2Templates
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pathlib import Path
-from fastapi import Request  # , Response
-from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+from fastapi import Request, Response
+import asyncio
 import datetime as dt
 
-from app.core.config import get_logger
+from app.core.config import get_logger, settings
+from app.core.encoders import dumps
+from app.core.metrics import MetricsMiddleware, metrics, render
+from app.core.profiler import ProfileConfig, ProfilerMiddleware, profiler
+from app.core.tracing import JsonLinesExporter, TracingMiddleware, traced, tracer
+from app.core.responses import FastJSONResponse
 from app.model.base import ObjectId
 from app.model.todoerinfo import TodoerInfo
 from app.model.task import (
@@ -15,34 +20,64 @@ from app.model.task import (
     TaskCreate,
     TaskUpdate,
     TaskPartialUpdate,
+    TaskBatchResult,
+    TaskSummary,
+    TaskStats,
+    TASK_SUMMARY_FIELDS,
 )
 from app.data_layer.dl_exception import DataLayerException
 from app.data_layer.database import database_factory
-from app.data_layer.data_obj_mgr import DataObjectManager, CRUDMongoBase
+from app.data_layer.data_obj_mgr import DataObjectManager, CRUDMongoBase, WarmUpReport
+from app.crud.crud_task import CRUDTask
+from app.data_layer.indexes import IndexReport
+from app.data_layer.cache import CacheStats
+from app.data_layer.slow_ops import SlowOp
+from app.data_layer.pool_metrics import PoolStats, pool_metrics
 from todoer_api import __version__, __service_name__
+from pymongo.errors import PyMongoError
+
+from fastapi.encoders import jsonable_encoder
 
-# from fastapi.encoders import jsonable_encoder
 # from starlette.responses import JSONResponse
 
 logger = get_logger("todoer")
+MAX_BATCH_SIZE = 1000
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+EXPORT_BATCH_SIZE = 1000
+EXPORT_CHUNK_LINES = 100
+# seconds between comments sent on an idle event stream to keep proxies from closing it
+EVENTS_KEEPALIVE_SECS = 15.0
 BASE_PATH = Path(__file__).resolve().parent
-TEMPLATES = Jinja2Templates(directory=str(BASE_PATH / "templates"))
 
 
 # ------------------------------------------------------------------------------
 # Globals
-app = FastAPI()
+app = FastAPI(default_response_class=FastJSONResponse)
+if settings.METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+if settings.TRACING_ENABLED:
+    # outermost so the Server-Timing app time covers the whole request
+    app.add_middleware(TracingMiddleware)
+    if settings.TRACE_EXPORT:
+        tracer.exporters.append(JsonLinesExporter.from_target(settings.TRACE_EXPORT))
+# off until switched on at /todoer/admin/v1/profile/config
+app.add_middleware(ProfilerMiddleware)
 # this is intiatied in the startup ans shutdown functions (must be async)
 object_db: DataObjectManager = None
+# set when the warm-up at startup is done, until then the worker is not ready
+warm_up_report: Optional[WarmUpReport] = None
+warm_up_task: Optional[asyncio.Task] = None
 
 
 # region dependencies
 
 
+@traced("dependency")
 async def get_database() -> DataObjectManager:
     return object_db
 
 
+@traced("dependency")
 def pagination(
     skip: int = Query(0, ge=0),
     limit: int = Query(10, ge=0),
@@ -51,6 +86,7 @@ def pagination(
     return (skip, capped_limit)
 
 
+@traced("dependency")
 def pagination_dict(
     skip: int = Query(0, ge=0),
     limit: int = Query(10, ge=0),
@@ -59,6 +95,58 @@ def pagination_dict(
     return {"skip": skip, "limit": capped_limit}
 
 
+@traced("dependency")
+def task_filter(
+    project: Optional[str] = None,
+    # named status in the query, not here where it would hide fastapi.status
+    task_status: Optional[str] = Query(None, alias="status"),
+    tags: Optional[List[str]] = Query(None),
+    tags_match: str = Query("any", regex="^(any|all)$"),
+    updated_since: Optional[dt.datetime] = None,
+) -> Dict[str, Any]:
+    return CRUDTask.build_filter(
+        project=project,
+        status=task_status,
+        tags=tags,
+        tags_match=tags_match,
+        updated_since=updated_since,
+    )
+
+
+@traced("dependency")
+def task_sort(
+    sort: str = Query(
+        "_id",
+        description="Field to sort on prefixed by - for descending, one of "
+        + ", ".join(sorted(CRUDTask.SORT_FIELDS)),
+    ),
+) -> Dict[str, Any]:
+    sort_field = sort.lstrip("-")
+    if sort_field not in CRUDTask.SORT_FIELDS:
+        raise HTTPException(status_code=400, detail=f"Cannot sort on {sort_field}")
+    return {"sort_field": sort_field, "sort_ascending": not sort.startswith("-")}
+
+
+@traced("dependency")
+def task_projection(
+    fields: Optional[str] = Query(
+        None,
+        description="Comma separated fields to return as a TaskSummary, "
+        + ", ".join(sorted(TASK_SUMMARY_FIELDS)),
+    ),
+) -> Optional[Dict[str, bool]]:
+    if fields is None:
+        return None
+    requested = {field.strip() for field in fields.split(",") if field.strip()}
+    unknown = requested - TASK_SUMMARY_FIELDS
+    if unknown:
+        raise HTTPException(
+            status_code=400, detail=f"Unknown fields {', '.join(sorted(unknown))}"
+        )
+    return {field: True for field in sorted(requested | {"key"})}
+
+
+@traced("dependency")
 async def get_task_or_404(task_key: str, database=Depends(get_database)) -> Task:
     task_mgr: CRUDMongoBase = database.get_object_manager("Task")
     task = await task_mgr.get_by_key("key", task_key)
@@ -67,6 +155,7 @@ async def get_task_or_404(task_key: str, database=Depends(get_database)) -> Task
     return task
 
 
+@traced("dependency")
 async def get_task_id_or_404(task_id: str, database=Depends(get_database)) -> Task:
     task_mgr: CRUDMongoBase = database.get_object_manager("Task")
     task = await task_mgr.get(ObjectId(task_id))
@@ -77,20 +166,83 @@ async def get_task_id_or_404(task_id: str, database=Depends(get_database)) -> Ta
 
 # endregion dependencies
 
+
+@functools.lru_cache(maxsize=None)
+def get_templates():
+    """The HTML templates, jinja2 is only imported once a page is asked for."""
+    from fastapi.templating import Jinja2Templates
+
+    return Jinja2Templates(directory=str(BASE_PATH / "templates"))
+
+
+def json_bytes_response(content: bytes) -> Response:
+    """Response for already serialised JSON, skipping response_model validation."""
+    return Response(content=content, media_type=FastJSONResponse.media_type)
+
+
 # region non-data
 
 
+async def warm_up(database: DataObjectManager) -> None:
+    """Warms up the database, retrying while mongo is unavailable, then marks the worker
+    ready. Any other failure is logged and leaves the worker not ready."""
+    global warm_up_report
+    while True:
+        try:
+            report = await database.warm_up(settings.MONGO_MIN_POOL_SIZE)
+        except PyMongoError as exc:
+            logger.warning(
+                f"warm up failed {exc}, retry in {settings.WARM_UP_RETRY_INTERVAL}s"
+            )
+            await asyncio.sleep(settings.WARM_UP_RETRY_INTERVAL)
+            continue
+        except Exception:
+            # retrying would fail the same way, it needs fixing
+            logger.exception("warm up failed, not ready")
+            return
+        logger.info(
+            f"warmed up in {report.duration_ms}ms connections={report.connections} "
+            f"indexes created={report.indexes_created}"
+        )
+        warm_up_report = report
+        return
+
+
 @app.on_event("startup")
 async def startup():
-    global object_db
-    object_db = database_factory("mongo-data-obj-mgr")
+    global object_db, warm_up_task
+    object_db = database_factory(settings.DATABASE_TYPE)
+    # the worker takes requests once startup returns, wait for the warm-up up to the
+    # timeout so they find it warm, it carries on in the background if it takes longer
+    warm_up_task = asyncio.create_task(warm_up(object_db))
+    await asyncio.wait({warm_up_task}, timeout=settings.WARM_UP_TIMEOUT)
+    if not warm_up_task.done():
+        logger.warning(f"not warmed up after {settings.WARM_UP_TIMEOUT}s, not ready")
+    object_db.start_change_feed()
+    if settings.METRICS_DIR:
+        metrics.start_flusher(settings.METRICS_DIR, settings.METRICS_FLUSH_INTERVAL)
+    if settings.PROFILE_DIR:
+        profiler.start_sync(settings.PROFILE_DIR, settings.PROFILE_SYNC_INTERVAL)
 
 
 @app.on_event("shutdown")
 async def shutdown():
-    global object_db
-    del object_db
+    global object_db, warm_up_report, warm_up_task
+    if warm_up_task is not None and not warm_up_task.done():
+        warm_up_task.cancel()
+        try:
+            await warm_up_task
+        except asyncio.CancelledError:
+            pass
+    warm_up_task = None
+    warm_up_report = None
+    # releases this process' share of the mongo client, closing it if no longer used
+    await object_db.close()
     object_db = None
+    if settings.METRICS_DIR:
+        await metrics.stop_flusher(settings.METRICS_DIR)
+    if settings.PROFILE_DIR:
+        await profiler.stop_sync(settings.PROFILE_DIR)
 
 
 @app.get("/todoer/v1/tasks", status_code=200)
@@ -105,7 +257,7 @@ async def root(
     task_mgr: CRUDMongoBase = database.get_object_manager("Task")
     tasks = await task_mgr.get_all(**pagination)
     # tasks = await database.get_all(*pagination)
-    return TEMPLATES.TemplateResponse(
+    return get_templates().TemplateResponse(
         "index.html",
         {"request": request, "tasks": tasks},
     )
@@ -116,9 +268,17 @@ async def model_ping():
     return {"ping": dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
 
 
+@app.get("/todoer/api/v1/ready", response_model=WarmUpReport)
+async def model_ready() -> WarmUpReport:
+    """200 once the worker has warmed up, 503 until then, for readiness probes."""
+    if warm_up_report is None:
+        raise HTTPException(status_code=503, detail="Warming up")
+    return warm_up_report
+
+
 @app.get("/todoer/api/v1/info", response_model=TodoerInfo)
 async def model_info(database=Depends(get_database)) -> TodoerInfo:
-    logger.info(f"get info")
+    logger.info("get info")
     return TodoerInfo(
         timestamp=dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
         service=__service_name__,
@@ -141,21 +301,121 @@ async def test(test_id: int, qry: Optional[str] = None):
 @app.get("/todoer/api/v1/tasks")
 async def get_tasks(
     pagination: Dict[str, int] = Depends(pagination_dict),
+    after: Optional[str] = Query(
+        None, description=f"{NEXT_CURSOR_HEADER} of the last page"
+    ),
+    projection: Optional[Dict[str, bool]] = Depends(task_projection),
+    filter: Dict[str, Any] = Depends(task_filter),
+    sort: Dict[str, Any] = Depends(task_sort),
     database=Depends(get_database),
-) -> List[Task]:
+) -> List[Union[Task, TaskSummary]]:
     task_mgr = database.get_object_manager("Task")
-    return await task_mgr.get_all(**pagination)
+    try:
+        if task_mgr.trusted_reads:
+            content, next_cursor = await task_mgr.filter_page_json(
+                filter, after=after, projection=projection, **sort, **pagination
+            )
+        else:
+            raw_tasks, next_cursor = await task_mgr.filter_page_raw(
+                filter, after=after, projection=projection, **sort, **pagination
+            )
+            model = Task if projection is None else TaskSummary
+            tasks = [model(**raw_task) for raw_task in raw_tasks]
+            content = dumps(jsonable_encoder(tasks, exclude_unset=True))
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    response = json_bytes_response(content)
+    if next_cursor is not None:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
+    return response
+
+
+@app.get("/todoer/api/v1/tasks/export")
+async def export_tasks(
+    filter: Dict[str, Any] = Depends(task_filter),
+    database=Depends(get_database),
+) -> StreamingResponse:
+    """
+    GET all matching tasks as NDJSON, streamed from the DB cursor without building a list
+    """
+    logger.info(f"request to export tasks filter={filter}")
+    task_mgr = database.get_object_manager("Task")
+
+    async def ndjson_chunks():
+        lines = []
+        async for raw_task in task_mgr.iter_raw(filter, batch_size=EXPORT_BATCH_SIZE):
+            lines.append(dumps(raw_task))
+            if len(lines) >= EXPORT_CHUNK_LINES:
+                yield b"\n".join(lines) + b"\n"
+                lines = []
+        if lines:
+            yield b"\n".join(lines) + b"\n"
+
+    return StreamingResponse(ndjson_chunks(), media_type="application/x-ndjson")
+
+
+@app.get("/todoer/api/v1/tasks/events")
+async def task_events(database=Depends(get_database)) -> StreamingResponse:
+    """
+    GET changes to tasks made by any process as server-sent events, until the client leaves
+    """
+    change_feed = database.change_feed
+    if change_feed is None or not change_feed.running:
+        raise HTTPException(status_code=503, detail="Task events are not available")
+    queue = change_feed.subscribe()
+    logger.info(f"task events subscribed mode={change_feed.mode}")
+
+    async def event_stream():
+        # the response cancels this generator when the client disconnects
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(
+                        queue.get(), timeout=EVENTS_KEEPALIVE_SECS
+                    )
+                except asyncio.TimeoutError:
+                    yield b": keepalive\n\n"
+                    continue
+                data = dumps(event.dict())
+                yield b"event: " + event.op.encode() + b"\ndata: " + data + b"\n\n"
+        finally:
+            change_feed.unsubscribe(queue)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
+@app.get("/todoer/api/v1/tasks/stats", response_model=TaskStats)
+async def get_task_stats(
+    filter: Dict[str, Any] = Depends(task_filter),
+    interval: str = Query(
+        "day",
+        description="Histogram bucket size, one of "
+        + ", ".join(CRUDTask.STATS_INTERVALS),
+    ),
+    database=Depends(get_database),
+) -> TaskStats:
+    """
+    GET counts of the matching tasks by project, status and tag with created and updated
+    histograms, aggregated by the DB
+    """
+    task_mgr = database.get_object_manager("Task")
+    try:
+        return await task_mgr.stats(filter, interval=interval)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
 
 
 @app.get("/todoer/api/v1/tasks/{task_key}", response_model=Task)
-async def get_task_key(task: Task = Depends(get_task_or_404)) -> Task:
-    # to return with id iso _id do the follwing but breaks tests
-    # as rebuild from dict assume _id is present
-    # retrun a JSONResponse to avoid casting back to Task which uses _id
-    # tsk_dict = jsonable_encoder(task, by_alias=False)
-    # return JSONResponse(content=tsk_dict)
-    logger.info(f"get task by key {task.key} id = {task.id}")
-    return task
+async def get_task_key(task_key: str, database=Depends(get_database)) -> Task:
+    task_mgr: CRUDMongoBase = database.get_object_manager("Task")
+    if not task_mgr.trusted_reads:
+        return await get_task_or_404(task_key, database)
+    # stored document serialised as is, "_id" as by_alias=True would give
+    content = await task_mgr.get_json_by_key(task_key)
+    if content is None:
+        raise HTTPException(status_code=404, detail=f"Task {task_key} not found")
+    logger.info(f"get task by key {task_key}")
+    return json_bytes_response(content)
 
 
 @app.get("/todoer/api/v1/tasks/id/{task_id}", response_model=Task)
@@ -177,28 +437,54 @@ async def create_task(task: TaskCreate, database=Depends(get_database)) -> Task:
         )
 
 
+@app.post(
+    "/todoer/api/v1/tasks:batch",
+    status_code=201,
+    response_model=List[TaskBatchResult],
+)
+async def create_tasks(
+    tasks: List[TaskCreate], database=Depends(get_database)
+) -> List[TaskBatchResult]:
+    if len(tasks) > MAX_BATCH_SIZE:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Batch of {len(tasks)} tasks exceeds limit of {MAX_BATCH_SIZE}",
+        )
+    logger.info(f"request to create {len(tasks)} tasks in batch")
+    task_mgr = database.get_object_manager("Task")
+    return await task_mgr.add_many(objs_in=tasks)
+
+
+async def update_task_or_404(
+    task_key: str,
+    task_upd: Union[TaskUpdate, TaskPartialUpdate],
+    database: DataObjectManager,
+) -> Task:
+    task_mgr: CRUDMongoBase = database.get_object_manager("Task")
+    task_new = await task_mgr.update_by_key("key", task_key, obj_update=task_upd)
+    if task_new is None:
+        raise HTTPException(status_code=404, detail=f"Task {task_key} not found")
+    return task_new
+
+
 @app.put("/todoer/api/v1/tasks/{task_key}", response_model=Task)
 async def update_task(
+    task_key: str,
     task_upd: TaskUpdate,
-    task_orig: Task = Depends(get_task_or_404),
     database=Depends(get_database),
 ) -> Task:
-    logger.info(f"request to update task: {task_orig.key}")
-    task_mgr: CRUDMongoBase = database.get_object_manager("Task")
-    task_new = await task_mgr.update(obj_original=task_orig, obj_update=task_upd)
-    return task_new
+    logger.info(f"request to update task: {task_key}")
+    return await update_task_or_404(task_key, task_upd, database)
 
 
 @app.patch("/todoer/api/v1/tasks/{task_key}", response_model=Task)
 async def patch_task(
+    task_key: str,
     task_upd: TaskPartialUpdate,
-    task_orig: Task = Depends(get_task_or_404),
     database=Depends(get_database),
 ) -> Task:
-    logger.info(f"request to patch task: {task_orig.key}")
-    task_mgr: CRUDMongoBase = database.get_object_manager("Task")
-    task_new = await task_mgr.update(obj_original=task_orig, obj_update=task_upd)
-    return task_new
+    logger.info(f"request to patch task: {task_key}")
+    return await update_task_or_404(task_key, task_upd, database)
 
 
 @app.delete("/todoer/api/v1/tasks/{task_key}", status_code=204)
@@ -210,6 +496,89 @@ async def del_task(
     await task_mgr.delete(id=task.id)
 
 
+@app.get("/todoer/admin/v1/indexes", response_model=List[IndexReport])
+async def get_indexes(database=Depends(get_database)) -> List[IndexReport]:
+    return await database.check_indexes()
+
+
+@app.post("/todoer/admin/v1/indexes", response_model=List[IndexReport])
+async def create_indexes(database=Depends(get_database)) -> List[IndexReport]:
+    logger.info("request to ensure indexes")
+    return await database.ensure_indexes()
+
+
+@app.get("/todoer/admin/v1/cache", response_model=List[CacheStats])
+async def get_cache_stats(database=Depends(get_database)) -> List[CacheStats]:
+    return database.cache_stats()
+
+
+@app.get("/todoer/admin/v1/slow-ops", response_model=List[SlowOp])
+async def get_slow_ops(database=Depends(get_database)) -> List[SlowOp]:
+    """
+    GET the last reads and writes of this worker slower than SLOW_OP_MS, oldest first
+    """
+    if database.slow_ops is None:
+        return []
+    return database.slow_ops.ops()
+
+
+@app.delete("/todoer/admin/v1/slow-ops", status_code=204)
+async def clear_slow_ops(database=Depends(get_database)) -> None:
+    if database.slow_ops is not None:
+        database.slow_ops.clear()
+
+
+@app.get("/todoer/admin/v1/pool", response_model=PoolStats)
+async def get_pool_stats() -> PoolStats:
+    return pool_metrics.stats()
+
+
+@app.get("/todoer/admin/v1/metrics", response_class=PlainTextResponse)
+async def get_metrics() -> PlainTextResponse:
+    """
+    GET request and DB op metrics of all workers in the Prometheus text format
+    """
+    return PlainTextResponse(
+        render(metrics.collect(settings.METRICS_DIR)),
+        media_type="text/plain; version=0.0.4",
+    )
+
+
+@app.get("/todoer/admin/v1/profile", response_class=PlainTextResponse)
+async def get_profile(
+    format: str = Query("collapsed", regex="^(collapsed|pstats)$")
+) -> PlainTextResponse:
+    """
+    GET the CPU profile of the profiled requests of all workers, as flamegraph collapsed
+    stacks from sampling or the top functions from cProfile
+    """
+    if format == "pstats":
+        return PlainTextResponse(profiler.pstats(settings.PROFILE_DIR))
+    return PlainTextResponse(profiler.collapsed(settings.PROFILE_DIR))
+
+
+@app.delete("/todoer/admin/v1/profile", status_code=204)
+async def reset_profile() -> None:
+    logger.info("request to reset the profile")
+    profiler.save_config(settings.PROFILE_DIR, reset=True)
+
+
+@app.get("/todoer/admin/v1/profile/config", response_model=ProfileConfig)
+async def get_profile_config() -> ProfileConfig:
+    return profiler.config
+
+
+@app.put("/todoer/admin/v1/profile/config", response_model=ProfileConfig)
+async def set_profile_config(config: ProfileConfig) -> ProfileConfig:
+    """
+    PUT which requests are profiled, the other workers follow within PROFILE_SYNC_INTERVAL
+    """
+    logger.info(f"request to set the profile config {config}")
+    profiler.set_config(config)
+    profiler.save_config(settings.PROFILE_DIR)
+    return profiler.config
+
+
 @app.delete("/todoer/admin/v1/tasks", status_code=204)
 async def del_all_task(database=Depends(get_database)):
     logger.info("request to delete all tasks")
@@ -1,10 +1,17 @@
 """ Defines the pydantic model base classes. """
 
 # from typing import List, Optional  # Dict,
+import datetime as dt
 from pydantic import BaseModel, Field
 from bson import ObjectId
 
 
+def now_ms() -> dt.datetime:
+    """Now truncated to the millisecond precision BSON stores, so local copies match the DB."""
+    now = dt.datetime.now()
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+
 class PyObjectId(ObjectId):
     @classmethod
     def __get_validators__(cls):
@@ -1,9 +1,9 @@
 """ Defines the pydantic models. """
 
-from typing import List, Optional
+from typing import Dict, List, Optional
 from pydantic import BaseModel, Field
 from datetime import datetime
-from .base import MongoBaseModel
+from .base import MongoBaseModel, now_ms
 
 
 def _get_task_key(project: str, seq: int) -> str:
@@ -45,9 +45,59 @@ class TaskDB(TaskCreate, MongoBaseModel):
 
     seq: int
     key: str
-    created: datetime = Field(default_factory=datetime.now)
-    updated: datetime = Field(default_factory=datetime.now)
+    created: datetime = Field(default_factory=now_ms)
+    updated: datetime = Field(default_factory=now_ms)
 
 
 class Task(TaskDB):
     pass
+
+
+class TaskSummary(MongoBaseModel):
+    """A task with only some fields, as returned by listings with a projection."""
+
+    key: Optional[str] = None
+    project: Optional[str] = None
+    summary: Optional[str] = None
+    status: Optional[str] = None
+    tags: Optional[List[str]] = None
+    seq: Optional[int] = None
+    created: Optional[datetime] = None
+    updated: Optional[datetime] = None
+
+
+# fields of a task a listing can be projected to, key is always included
+TASK_SUMMARY_FIELDS = {name for name in TaskSummary.__fields__ if name != "id"}
+
+
+class TaskBatchResult(BaseModel):
+    """Outcome of a single item in a batch create, `index` is its position in the request."""
+
+    index: int
+    created: bool
+    key: Optional[str] = None
+    task: Optional[Task] = None
+    detail: Optional[str] = None
+
+    class Config:
+        # responses are encoded with the outer model's encoders, the task's _id needs them
+        json_encoders = MongoBaseModel.Config.json_encoders
+
+
+class TaskStatsBucket(BaseModel):
+    """Number of tasks in the histogram interval starting at `start`."""
+
+    start: datetime
+    count: int
+
+
+class TaskStats(BaseModel):
+    """Counts of the matching tasks, tags counts each task once per tag it has."""
+
+    total: int
+    by_project: Dict[str, int]
+    by_status: Dict[str, int]
+    by_tag: Dict[str, int]
+    interval: str
+    created: List[TaskStatsBucket]
+    updated: List[TaskStatsBucket]
@@ -3,7 +3,7 @@
 from typing import List, Optional
 from pydantic import BaseModel, Field, EmailStr
 from datetime import datetime
-from .base import MongoBaseModel
+from .base import MongoBaseModel, now_ms
 
 
 class UserBase(BaseModel):
@@ -31,8 +31,8 @@ class UserCreate(UserBase):
 
 
 class UserDB(UserCreate, MongoBaseModel):
-    created: datetime = Field(default_factory=datetime.now)
-    updated: datetime = Field(default_factory=datetime.now)
+    created: datetime = Field(default_factory=now_ms)
+    updated: datetime = Field(default_factory=now_ms)
 
 
 class User(UserDB):
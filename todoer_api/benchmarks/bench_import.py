@@ -0,0 +1,159 @@
+""" Import time of the app, the bulk of a gunicorn worker's boot.
+
+Imports each module in a fresh interpreter under `python -X importtime`, takes the median of
+the runs and prints a JSON report of the total import time, the time by top level package
+and the slowest modules. Exits 1 if the total is over --budget-ms, a module that should be
+loaded lazily was imported or the total regressed from the saved baseline:
+
+    python -m benchmarks.bench_import --repeat 5 --budget-ms 1500
+    python -m benchmarks.bench_import --save-baseline
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple, Set
+
+from benchmarks.common import BASELINE_DIR, check_baseline
+
+PROJECT_DIR = Path(__file__).resolve().parent.parent
+COMPARED = {"total_ms": False}
+# only imported when a request needs them, never while a worker boots
+LAZY_MODULES = (
+    "black",
+    "jinja2",
+    "redis",
+    "app.data_layer.legacy_database",
+)
+TOP = 15
+
+
+class ImportEntry(NamedTuple):
+    name: str
+    self_us: int
+    cumulative_us: int
+    level: int
+
+
+def parse_importtime(stderr: str) -> List[ImportEntry]:
+    """The entries of -X importtime output, a nested module is indented two spaces a level."""
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:") :].split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            # the header line
+            continue
+        name = fields[2][1:]
+        level = (len(name) - len(name.lstrip(" "))) // 2
+        entries.append(ImportEntry(name.strip(), int(fields[0]), int(fields[1]), level))
+    return entries
+
+
+def run_import(statement: str) -> List[ImportEntry]:
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        cwd=PROJECT_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return parse_importtime(completed.stderr)
+
+
+def measure(module: str, repeat: int, startup: Set[str]) -> Dict[str, Any]:
+    """Median figures of repeat imports, leaving out the modules the interpreter starts with."""
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        entries = [
+            entry
+            for entry in run_import(f"import {module}")
+            if entry.name not in startup
+        ]
+        process_secs = time.perf_counter() - start
+        runs.append((entries, process_secs))
+    totals = [
+        sum(e.cumulative_us for e in entries if e.level == 0) for entries, _ in runs
+    ]
+    median_total = statistics.median(totals)
+    # the breakdown is of the run closest to the median
+    entries = runs[totals.index(min(totals, key=lambda t: abs(t - median_total)))][0]
+
+    by_package: Dict[str, int] = defaultdict(int)
+    for entry in entries:
+        by_package[entry.name.split(".")[0]] += entry.self_us
+    imported = {entry.name for entry in entries}
+    return {
+        "total_ms": round(median_total / 1000, 1),
+        "process_ms": round(statistics.median(s for _, s in runs) * 1000, 1),
+        "modules": len(entries),
+        "lazy_imported": [
+            name
+            for name in LAZY_MODULES
+            if name in imported or any(m.startswith(f"{name}.") for m in imported)
+        ],
+        "by_package_ms": {
+            package: round(us / 1000, 1)
+            for package, us in sorted(by_package.items(), key=lambda item: -item[1])[
+                :TOP
+            ]
+        },
+        "slowest_ms": {
+            entry.name: round(entry.self_us / 1000, 1)
+            for entry in sorted(entries, key=lambda entry: -entry.self_us)[:TOP]
+        },
+    }
+
+
+def main(args: argparse.Namespace) -> int:
+    startup = {entry.name for entry in run_import("pass")}
+    results = {module: measure(module, args.repeat, startup) for module in args.modules}
+    report = {"repeat": args.repeat, "results": results}
+    print(json.dumps(report, indent=2))
+
+    exit_code = 0
+    for module, result in results.items():
+        if result["lazy_imported"]:
+            print(
+                f"LAZY {module} imports {', '.join(result['lazy_imported'])}",
+                file=sys.stderr,
+            )
+            exit_code = 1
+        if args.budget_ms and result["total_ms"] > args.budget_ms:
+            print(
+                f"BUDGET {module} {result['total_ms']}ms over {args.budget_ms}ms",
+                file=sys.stderr,
+            )
+            exit_code = 1
+    baseline_path = Path(args.baseline or BASELINE_DIR / "import.json")
+    return (
+        check_baseline(
+            report, baseline_path, COMPARED, args.tolerance, save=args.save_baseline
+        )
+        or exit_code
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--modules", nargs="+", default=["app.main"], help="modules to import"
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="imports per module")
+    parser.add_argument(
+        "--budget-ms", type=float, default=0, help="largest total import time allowed"
+    )
+    parser.add_argument("--baseline", help=f"baseline file, default in {BASELINE_DIR}")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2, help="allowed fractional regression"
+    )
+    sys.exit(main(parser.parse_args()))
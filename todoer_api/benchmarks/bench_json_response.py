@@ -0,0 +1,55 @@
+""" Benchmark of rendering task responses, default JSONResponse against FastJSONResponse.
+
+Runs in-process without a DB and prints renders/sec for a list of 100 tasks and a single task:
+
+    python -m benchmarks.bench_json_response --repeat 2000
+"""
+import argparse
+import json
+import timeit
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from app.core.encoders import orjson
+from app.core.responses import FastJSONResponse
+from app.model.task import Task, TaskCreate
+
+
+def make_tasks(num: int):
+    return [
+        Task(
+            **TaskCreate(
+                summary=f"bench {i}",
+                description="bench task " * 20,
+                status="New",
+                tags=["bench", "json"],
+                project="Bench",
+            ).get_dict_inc_seq(i)
+        )
+        for i in range(num)
+    ]
+
+
+def main(repeat: int) -> None:
+    report = {"orjson": orjson is not None}
+    for name, tasks in (("list_100", make_tasks(100)), ("single", make_tasks(1)[0])):
+        # FastAPI runs jsonable_encoder before rendering for both response classes
+        default_secs = timeit.timeit(
+            lambda: JSONResponse(jsonable_encoder(tasks)), number=repeat
+        )
+        fast_secs = timeit.timeit(
+            lambda: FastJSONResponse(jsonable_encoder(tasks)), number=repeat
+        )
+        report[name] = {
+            "default_per_sec": round(repeat / default_secs, 1),
+            "fast_per_sec": round(repeat / fast_secs, 1),
+        }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=1000)
+    args = parser.parse_args()
+    main(args.repeat)
@@ -0,0 +1,176 @@
+""" Load test of the task API, each operation in turn at a fixed concurrency.
+
+Drives the ASGI app in-process as the tests do, against mongo or the in-memory backend, or a
+live server given by --url. Prints a JSON report of requests/sec and p50/p95/p99 per
+operation and compares it with a saved baseline, exiting 1 if any operation regressed:
+
+    python -m benchmarks.bench_load --backend memory --num 1000 --concurrency 20
+    python -m benchmarks.bench_load --backend memory --save-baseline
+    python -m benchmarks.bench_load --url http://localhost:8000/todoer/api/v1
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Tuple
+
+import httpx
+from asgi_lifespan import LifespanManager
+from fastapi.encoders import jsonable_encoder
+
+from app.core.config import settings
+from app.main import app, get_database
+from app.data_layer import database as db
+from app.model.task import TaskCreate
+from benchmarks.common import BASELINE_DIR, check_baseline, summarise
+
+BACKENDS = {"mongo": "mongo-data-obj-mgr", "memory": "in-memory-data-obj-mgr"}
+# figures compared with the baseline, and whether a larger value is better
+COMPARED = {"per_sec": True, "p95_ms": False}
+
+
+async def run_phase(
+    concurrency: int,
+    calls: List[Callable[[], Awaitable[httpx.Response]]],
+) -> Tuple[Dict[str, Any], List[httpx.Response]]:
+    """Runs the calls with at most `concurrency` in flight, returns the summary and responses."""
+    samples: List[float] = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def timed(call) -> httpx.Response:
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            response = await call()
+            samples.append(time.perf_counter() - start)
+        if response.is_error:
+            errors += 1
+        return response
+
+    start = time.perf_counter()
+    responses = await asyncio.gather(*[timed(call) for call in calls])
+    elapsed = time.perf_counter() - start
+    summary = summarise(samples)
+    summary["per_sec"] = round(len(calls) / elapsed, 1)
+    summary["errors"] = errors
+    return summary, responses
+
+
+async def run_load(
+    client: httpx.AsyncClient, num: int, concurrency: int, limits: List[int]
+) -> Dict[str, Dict[str, Any]]:
+    report = {}
+    task_in = TaskCreate(
+        summary="bench", description="bench task", status="New", project="Load"
+    )
+    create_body = jsonable_encoder(task_in)
+    report["create"], responses = await run_phase(
+        concurrency,
+        [lambda: client.post("/tasks", json=create_body) for _ in range(num)],
+    )
+    created = [response.json() for response in responses if response.is_success]
+    keys = [task["key"] for task in created]
+    ids = [task["_id"] for task in created]
+
+    report["get_key"], _ = await run_phase(
+        concurrency, [lambda key=key: client.get(f"/tasks/{key}") for key in keys]
+    )
+    report["get_id"], _ = await run_phase(
+        concurrency, [lambda id=id: client.get(f"/tasks/id/{id}") for id in ids]
+    )
+    for limit in limits:
+        params = {"limit": limit, "project": "Load"}
+        report[f"list_{limit}"], _ = await run_phase(
+            concurrency,
+            [lambda: client.get("/tasks", params=params) for _ in range(num)],
+        )
+    put_body = jsonable_encoder(task_in.copy(update={"status": "Updated"}))
+    report["put"], _ = await run_phase(
+        concurrency,
+        [lambda key=key: client.put(f"/tasks/{key}", json=put_body) for key in keys],
+    )
+    report["patch"], _ = await run_phase(
+        concurrency,
+        [
+            lambda key=key: client.patch(f"/tasks/{key}", json={"status": "Done"})
+            for key in keys
+        ],
+    )
+    report["delete"], _ = await run_phase(
+        concurrency, [lambda key=key: client.delete(f"/tasks/{key}") for key in keys]
+    )
+    return report
+
+
+@asynccontextmanager
+async def in_process_client(backend: str) -> AsyncIterator[httpx.AsyncClient]:
+    # the startup hook builds the app's own backend, keep it off mongo for a memory run
+    settings.DATABASE_TYPE = BACKENDS[backend]
+    object_mgr = db.database_factory(
+        BACKENDS[backend], db_name="bench_taskdb", id_db_name="bench_taskdb_id"
+    )
+
+    async def get_bench_database():
+        return object_mgr
+
+    app.dependency_overrides[get_database] = get_bench_database
+    try:
+        async with LifespanManager(app):
+            async with httpx.AsyncClient(
+                app=app, base_url="http://127.0.0.1:8000/todoer/api/v1"
+            ) as client:
+                yield client
+        await object_mgr.get_object_manager("Task").drop_db()
+        await object_mgr.close()
+    finally:
+        app.dependency_overrides.clear()
+
+
+async def main(args: argparse.Namespace) -> int:
+    limits = [int(limit) for limit in args.limits.split(",")]
+    if args.url:
+        target = args.url
+        client_cm = httpx.AsyncClient(
+            base_url=args.url,
+            limits=httpx.Limits(max_connections=args.concurrency),
+            timeout=30.0,
+        )
+    else:
+        target = args.backend
+        client_cm = in_process_client(args.backend)
+    async with client_cm as client:
+        results = await run_load(client, args.num, args.concurrency, limits)
+    report = {
+        "target": target,
+        "num": args.num,
+        "concurrency": args.concurrency,
+        "results": results,
+    }
+    print(json.dumps(report, indent=2))
+
+    name = "live" if args.url else args.backend
+    baseline_path = Path(args.baseline or BASELINE_DIR / f"load_{name}.json")
+    return check_baseline(
+        report, baseline_path, COMPARED, args.tolerance, save=args.save_baseline
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="memory")
+    parser.add_argument("--url", help="base URL of a live server, e.g. .../api/v1")
+    parser.add_argument("--num", type=int, default=500, help="requests per operation")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--limits", default="10,100", help="list page sizes")
+    parser.add_argument("--baseline", help=f"baseline file, default in {BASELINE_DIR}")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2, help="allowed fractional regression"
+    )
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,111 @@
+""" Micro-benchmarks of the model construction and serialisation done on every request.
+
+Runs without a DB across task sizes (tag count x description length) and prints the
+calls/sec and the bytes allocated per call, as peak during the call and as retained by its
+result, then compares with a saved baseline as bench_load does:
+
+    python -m benchmarks.bench_models --repeat 2000
+    python -m benchmarks.bench_models --save-baseline
+"""
+import argparse
+import itertools
+import json
+import sys
+import timeit
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+from fastapi.encoders import jsonable_encoder
+
+from app.model.base import ObjectId, PyObjectId
+from app.model.task import Task, TaskCreate, TaskUpdate
+from benchmarks.common import BASELINE_DIR, check_baseline
+
+TAG_COUNTS = (0, 10, 100)
+DESCRIPTION_LENGTHS = (10, 1000, 10000)
+COMPARED = {"per_sec": True, "peak_bytes": False}
+# calls measured one at a time for their peak allocation
+ALLOC_SAMPLES = 50
+
+
+def make_task_in(num_tags: int, desc_len: int) -> TaskCreate:
+    return TaskCreate(
+        summary="bench",
+        description="d" * desc_len,
+        status="New",
+        tags=[f"tag{i}" for i in range(num_tags)],
+        project="Bench",
+    )
+
+
+def hot_paths(num_tags: int, desc_len: int) -> Dict[str, Callable[[], Any]]:
+    """The calls to measure for one task size, as made by the CRUD and API layers."""
+    task_in = make_task_in(num_tags, desc_len)
+    task = Task(**task_in.get_dict_inc_seq(1))
+    raw_task = task.dict(by_alias=True)
+    task_upd = TaskUpdate(**task_in.dict())
+    id_str = str(ObjectId())
+    return {
+        "task_from_raw": lambda: Task(**raw_task),
+        "task_construct": lambda: Task.construct(**task.dict()),
+        "get_dict_inc_seq": lambda: task_in.get_dict_inc_seq(1),
+        "jsonable_encoder_create": lambda: jsonable_encoder(task_in),
+        "jsonable_encoder_task": lambda: jsonable_encoder(task),
+        "update_dict_exclude_unset": lambda: task_upd.dict(exclude_unset=True),
+        "dict_by_alias": lambda: task.dict(by_alias=True),
+        "objectid_validate": lambda: PyObjectId.validate(id_str),
+    }
+
+
+def measure(call: Callable[[], Any], repeat: int) -> Dict[str, float]:
+    secs = timeit.timeit(call, number=repeat)
+    # peak is the transient allocation during the call, retained what the result keeps
+    peaks: List[int] = []
+    results = []
+    tracemalloc.start()
+    try:
+        for _ in range(ALLOC_SAMPLES):
+            before, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            results.append(call())
+            _, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - before)
+        retained, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    peaks.sort()
+    return {
+        "per_sec": round(repeat / secs, 1),
+        "us_per_call": round(secs / repeat * 1e6, 3),
+        "peak_bytes": peaks[len(peaks) // 2],
+        "retained_bytes": round(retained / ALLOC_SAMPLES),
+    }
+
+
+def main(args: argparse.Namespace) -> int:
+    results = {}
+    for num_tags, desc_len in itertools.product(TAG_COUNTS, DESCRIPTION_LENGTHS):
+        for name, call in hot_paths(num_tags, desc_len).items():
+            results[f"{name}/tags={num_tags}/desc={desc_len}"] = measure(
+                call, args.repeat
+            )
+    report = {"repeat": args.repeat, "results": results}
+    print(json.dumps(report, indent=2))
+    baseline_path = Path(args.baseline or BASELINE_DIR / "models.json")
+    return check_baseline(
+        report, baseline_path, COMPARED, args.tolerance, save=args.save_baseline
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--repeat", type=int, default=1000, help="calls timed per path")
+    parser.add_argument("--baseline", help=f"baseline file, default in {BASELINE_DIR}")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2, help="allowed fractional regression"
+    )
+    sys.exit(main(parser.parse_args()))
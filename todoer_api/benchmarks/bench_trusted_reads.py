@@ -0,0 +1,78 @@
+""" Benchmark of GET /tasks?limit=100 with validated and trusted reads.
+
+Drives the ASGI app in-process against the mongo test DB and prints requests/sec per mode:
+
+    python -m benchmarks.bench_trusted_reads --requests 500
+"""
+import argparse
+import asyncio
+import json
+import time
+from typing import Dict
+
+import httpx
+from asgi_lifespan import LifespanManager
+
+from app.main import app, get_database
+from app.data_layer import database as db
+from app.model.task import TaskCreate
+from benchmarks.common import summarise
+
+NUM_TASKS = 100
+
+
+async def run_mode(trusted_reads: bool, num_requests: int) -> Dict[str, float]:
+    object_mgr = db.database_factory(
+        "mongo-data-obj-mgr",
+        db_name="bench_taskdb",
+        id_db_name="bench_taskdb_id",
+        trusted_reads=trusted_reads,
+    )
+
+    async def get_bench_database():
+        return object_mgr
+
+    task_mgr = object_mgr.get_object_manager("Task")
+    await task_mgr.add_many(
+        objs_in=[
+            TaskCreate(
+                summary=f"bench {i}",
+                description="bench task " * 20,
+                status="New",
+                tags=["bench", "read"],
+                project="Bench",
+            )
+            for i in range(NUM_TASKS)
+        ]
+    )
+    app.dependency_overrides[get_database] = get_bench_database
+    samples = []
+    async with LifespanManager(app):
+        async with httpx.AsyncClient(
+            app=app, base_url="http://127.0.0.1:8000/todoer/api/v1"
+        ) as client:
+            start_all = time.perf_counter()
+            for _ in range(num_requests):
+                start = time.perf_counter()
+                response = await client.get("/tasks", params={"limit": NUM_TASKS})
+                samples.append(time.perf_counter() - start)
+                response.raise_for_status()
+            elapsed = time.perf_counter() - start_all
+    await task_mgr.drop_db()
+    app.dependency_overrides.clear()
+    return {"requests_per_sec": round(num_requests / elapsed, 1), **summarise(samples)}
+
+
+async def main(num_requests: int) -> None:
+    report = {
+        "validated": await run_mode(False, num_requests),
+        "trusted": await run_mode(True, num_requests),
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=300, help="requests per mode")
+    args = parser.parse_args()
+    asyncio.run(main(args.requests))
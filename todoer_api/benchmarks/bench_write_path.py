@@ -0,0 +1,81 @@
+""" Benchmark of the task write path (create, PUT, PATCH, DELETE) per CRUD return mode.
+
+Drives the ASGI app in-process against the mongo test DB and prints p50/p99 per operation:
+
+    python -m benchmarks.bench_write_path --num 500
+"""
+import argparse
+import asyncio
+import json
+import time
+from typing import Dict, List
+
+import httpx
+from asgi_lifespan import LifespanManager
+from fastapi.encoders import jsonable_encoder
+
+from app.main import app, get_database
+from app.data_layer import database as db
+from app.model.task import TaskCreate
+from benchmarks.common import summarise
+
+
+async def timed(samples: List[float], call) -> httpx.Response:
+    start = time.perf_counter()
+    response = await call
+    samples.append(time.perf_counter() - start)
+    response.raise_for_status()
+    return response
+
+
+async def run_mode(return_mode: str, num: int) -> Dict[str, Dict[str, float]]:
+    object_mgr = db.database_factory(
+        "mongo-data-obj-mgr",
+        db_name="bench_taskdb",
+        id_db_name="bench_taskdb_id",
+        return_mode=return_mode,
+    )
+
+    async def get_bench_database():
+        return object_mgr
+
+    app.dependency_overrides[get_database] = get_bench_database
+    samples = {"create": [], "put": [], "patch": [], "delete": []}
+    task_in = TaskCreate(
+        summary="bench", description="bench task", status="New", project="Bench"
+    )
+    async with LifespanManager(app):
+        async with httpx.AsyncClient(
+            app=app, base_url="http://127.0.0.1:8000/todoer/api/v1"
+        ) as client:
+            keys = []
+            create_body = jsonable_encoder(task_in)
+            for _ in range(num):
+                response = await timed(
+                    samples["create"], client.post("/tasks", json=create_body)
+                )
+                keys.append(response.json()["key"])
+            put_body = jsonable_encoder(task_in.copy(update={"status": "Updated"}))
+            patch_body = {"status": "Done"}
+            for key in keys:
+                await timed(samples["put"], client.put(f"/tasks/{key}", json=put_body))
+                await timed(
+                    samples["patch"], client.patch(f"/tasks/{key}", json=patch_body)
+                )
+            for key in keys:
+                await timed(samples["delete"], client.delete(f"/tasks/{key}"))
+    await object_mgr.get_object_manager("Task").drop_db()
+    app.dependency_overrides.clear()
+    return {op: summarise(op_samples) for op, op_samples in samples.items()}
+
+
+async def main(num: int) -> None:
+    report = {mode: await run_mode(mode, num) for mode in ("server", "local")}
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--num", type=int, default=200, help="tasks per mode")
+    args = parser.parse_args()
+    asyncio.run(main(args.num))
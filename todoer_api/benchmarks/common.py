@@ -0,0 +1,76 @@
+""" Helpers shared by the benchmarks. """
+
+import json
+import statistics
+import sys
+from pathlib import Path
+from typing import Any, Dict, List
+
+BASELINE_DIR = Path(__file__).resolve().parent / "baselines"
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarise(samples: List[float]) -> Dict[str, float]:
+    """Latency summary in milliseconds of samples in seconds."""
+    return {
+        "n": len(samples),
+        "p50_ms": round(percentile(samples, 50) * 1000, 3),
+        "p95_ms": round(percentile(samples, 95) * 1000, 3),
+        "p99_ms": round(percentile(samples, 99) * 1000, 3),
+        "mean_ms": round(statistics.mean(samples) * 1000, 3),
+    }
+
+
+def compare(
+    results: Dict[str, Dict[str, Any]],
+    baseline: Dict[str, Dict[str, Any]],
+    compared: Dict[str, bool],
+    tolerance: float,
+) -> List[str]:
+    """Describes each figure worse than the baseline by more than the tolerance.
+    **Parameters**
+    * `compared`: The figures to compare, each with whether a larger value is better
+    """
+    regressions = []
+    for op, figures in results.items():
+        for name, larger_is_better in compared.items():
+            base = baseline.get(op, {}).get(name)
+            if not base:
+                continue
+            change = (figures[name] - base) / base
+            if (-change if larger_is_better else change) > tolerance:
+                regressions.append(
+                    f"{op} {name} {figures[name]} vs baseline {base} ({change:+.0%})"
+                )
+    return regressions
+
+
+def check_baseline(
+    report: Dict[str, Any],
+    baseline_path: Path,
+    compared: Dict[str, bool],
+    tolerance: float,
+    save: bool = False,
+) -> int:
+    """Saves the report as the baseline or compares its results with the saved one.
+    **Returns**
+    * `exit_code`: 1 if any figure regressed, otherwise 0
+    """
+    if save:
+        baseline_path.parent.mkdir(parents=True, exist_ok=True)
+        baseline_path.write_text(json.dumps(report, indent=2) + "\n")
+        print(f"saved baseline {baseline_path}", file=sys.stderr)
+        return 0
+    if not baseline_path.exists():
+        print(f"no baseline at {baseline_path}", file=sys.stderr)
+        return 0
+    baseline = json.loads(baseline_path.read_text())
+    regressions = compare(report["results"], baseline["results"], compared, tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}", file=sys.stderr)
+    return 1 if regressions else 0
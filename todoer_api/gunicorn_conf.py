@@ -46,6 +46,48 @@ accesslog = use_accesslog
 graceful_timeout = int(graceful_timeout_str)
 timeout = int(timeout_str)
 keepalive = int(keepalive_str)
+# import the app once in the master and fork the workers from it, so a worker's boot is only
+# its startup (the warm-up). The app creates no mongo client until startup, in the worker
+preload_app = os.getenv("PRELOAD_APP", "false").lower() == "true"
+
+
+metrics_dir = os.getenv("METRICS_DIR")
+if metrics_dir:
+    # each worker writes its metrics here, start every run without the last run's files
+    os.makedirs(metrics_dir, exist_ok=True)
+    for name in os.listdir(metrics_dir):
+        if name.startswith("metrics_"):
+            os.remove(os.path.join(metrics_dir, name))
+
+profile_dir = os.getenv("PROFILE_DIR")
+if profile_dir:
+    # the profiler config and each worker's profile, profiling is off at every start
+    os.makedirs(profile_dir, exist_ok=True)
+    for name in os.listdir(profile_dir):
+        if name.startswith("profile_"):
+            os.remove(os.path.join(profile_dir, name))
+
+
+def pre_fork(server, worker):
+    # the lowest slot no running worker has, a worker replacing one that exited gets its slot
+    used = {getattr(running, "slot", None) for running in server.WORKERS.values()}
+    worker.slot = next(slot for slot in range(len(used) + 1) if slot not in used)
+
+
+def post_fork(server, worker):
+    # a client must not be used across a fork, the worker opens its own at startup
+    from app.core.config import settings
+    from app.data_layer.mongo_connection import forget_inherited_connections
+
+    forget_inherited_connections()
+    settings.WORKER_SLOT = worker.slot
+
+
+def child_exit(server, worker):
+    # keep the counts of the exited worker but not its in-flight requests
+    from app.core.metrics import mark_process_dead
+
+    mark_process_dead(worker.pid, metrics_dir)
 
 
 # For debugging and testing
@@ -56,6 +98,7 @@ log_data = {
     "graceful_timeout": graceful_timeout,
     "timeout": timeout,
     "keepalive": keepalive,
+    "preload_app": preload_app,
     "errorlog": errorlog,
     "accesslog": accesslog,
     # Additional, non-gunicorn variables
@@ -63,5 +106,7 @@ log_data = {
     "use_max_workers": use_max_workers,
     "host": host,
     "port": port,
+    "metrics_dir": metrics_dir,
+    "profile_dir": profile_dir,
 }
 print(json.dumps(log_data))
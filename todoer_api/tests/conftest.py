@@ -97,6 +97,7 @@ async def initial_tasks():
     # autouse - means does not need otb eexplicitly called as a param
     # adds intinal tasks and als oreturns them for easy reference
     global test_task_db
+    await test_task_db.ensure_indexes()
     task_mgr = test_task_db.get_object_manager("Task")
     initial_tasks = [new_test_task() for i in range(NUM_INIT_TASKS)]
     inserted_tasks = []
@@ -1,7 +1,14 @@
+import asyncio
 import httpx
+import io
+import time
+import json
+import re
 import pytest
+import pytest_asyncio
 from fastapi import status
 from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
 import datetime as dt
 from todoer_api import __version__, __service_name__
 from app.data_layer import database as db
@@ -10,6 +17,20 @@ from app.model.task import Task, TaskUpdate, TaskPartialUpdate
 from typing import Union
 from app.data_layer.data_obj_mgr import DataObjectManager, CRUDMongoBase
 from app.core.config import get_logger
+from app.core import encoders
+from app.data_layer.cache import TTLCache
+from app.data_layer.shared_cache import SharedCache
+from app.data_layer.slow_ops import SlowOpLog
+from app.data_layer.id_generator import TaskIdGeneratorMongoLeased
+from app.crud.crud_task import CRUDTask
+from app.crud.pagination import sort_spec
+from app.data_layer.change_feed import ChangeEvent, ChangeFeed
+from app.data_layer.mongo_connection import MongoCollection
+from app.model.base import now_ms
+from app.main import app, get_database
+from app.core import metrics as metrics_mod
+from app.core import tracing
+from app.core.profiler import Profiler, ProfileConfig
 
 logger = get_logger("todoer")
 
@@ -56,6 +77,400 @@ class TestInfo:
         assert response_body["service"] == __service_name__
         assert response_body["version"] == __version__
 
+    async def test_ready(self, test_client: httpx.AsyncClient):
+        # startup waits for the warm-up
+        response = await test_client.get(get_url("ready"))
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json()["connections"] >= 1
+
+    async def test_warm_up(self, test_database: DataObjectManager):
+        report = await test_database.warm_up(connections=2)
+        assert report.connections == 2
+        assert report.indexes_created == []
+        assert report.duration_ms >= 0
+
+
+class TestEncoders:
+    def test_dumps_matches_jsonable_encoder(self):
+        task = Task(**new_test_task().get_dict_inc_seq(1))
+        raw_task = task.dict(by_alias=True)
+        assert encoders.dumps(raw_task) == encoders._json_dumps(raw_task)
+        assert json.loads(encoders.dumps(raw_task)) == jsonable_encoder(task)
+
+    def test_dumps_non_ascii(self):
+        task = Task(**new_test_task(desc="café ✓ 日本").get_dict_inc_seq(1))
+        raw_task = task.dict(by_alias=True)
+        # the same bytes with or without orjson, as JSONResponse renders them
+        assert encoders.dumps(raw_task) == encoders._json_dumps(raw_task)
+        content = jsonable_encoder(task)
+        assert encoders.dumps(content) == JSONResponse(content).body
+        assert "café ✓ 日本".encode() in encoders.dumps(raw_task)
+        with pytest.raises(ValueError):
+            encoders._json_dumps({"estimate": float("nan")})
+
+
+class TestTTLCache:
+    def test_lru_eviction(self):
+        cache = TTLCache(2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        assert cache.get("a") == 1
+        cache.set("c", 3)
+        # b was least recently used
+        assert cache.get("b") is None
+        assert cache.get("a") == 1 and cache.get("c") == 3
+        stats = cache.stats()
+        assert (stats.hits, stats.misses, stats.evictions) == (3, 1, 1)
+
+    def test_ttl_expiry(self):
+        now = [0.0]
+        cache = TTLCache(10, ttl=5, timer=lambda: now[0])
+        cache.set("a", 1)
+        now[0] = 4.9
+        assert cache.get("a") == 1
+        now[0] = 5.0
+        assert cache.get("a") is None
+        assert cache.stats().expirations == 1
+        assert len(cache) == 0
+
+
+@pytest.mark.asyncio
+class TestSharedCache:
+    @pytest.fixture
+    def shared_cache(self):
+        aioredis = pytest.importorskip("fakeredis.aioredis")
+        return SharedCache(aioredis.FakeRedis(), prefix="test")
+
+    @pytest_asyncio.fixture
+    async def shared_task(
+        self, shared_cache: SharedCache, test_database: DataObjectManager
+    ):
+        # a task of its own, the shared cache is only on for the test
+        task_mgr = test_database.get_object_manager("Task")
+        task = await task_mgr.add(obj_in=new_test_task(desc="Shared cache"))
+        task_mgr.shared_cache = shared_cache
+        yield task
+        task_mgr.shared_cache = None
+        await task_mgr.delete(id=task.id)
+
+    @staticmethod
+    async def cached_task(shared_cache: SharedCache, task_key: str):
+        return await shared_cache.get_task(await shared_cache.task_key(task_key))
+
+    async def test_task_invalidate(self, shared_cache: SharedCache):
+        cache_key = await shared_cache.task_key("TEST-1")
+        await shared_cache.set_task(cache_key, b"{}")
+        assert await self.cached_task(shared_cache, "TEST-1") == b"{}"
+        await shared_cache.invalidate("TEST-1")
+        assert await self.cached_task(shared_cache, "TEST-1") is None
+        # a task read before the write is stored under the old version, never read
+        await shared_cache.set_task(cache_key, b"{}")
+        assert await self.cached_task(shared_cache, "TEST-1") is None
+
+    async def test_invalidate_all(self, shared_cache: SharedCache):
+        cache_key = await shared_cache.task_key("TEST-1")
+        await shared_cache.set_task(cache_key, b"{}")
+        await shared_cache.invalidate_all()
+        assert await shared_cache.task_key("TEST-1") != cache_key
+        assert await self.cached_task(shared_cache, "TEST-1") is None
+
+    async def test_page_generation(self, shared_cache: SharedCache):
+        query = [{}, {"limit": 10}]
+        page_key = await shared_cache.page_key(query)
+        await shared_cache.set_page(page_key, b"[]", "cursor")
+        assert await shared_cache.get_page(page_key) == (b"[]", "cursor")
+        # any write moves pages to a new generation
+        await shared_cache.invalidate()
+        assert await shared_cache.page_key(query) != page_key
+        page_key = await shared_cache.page_key(query)
+        assert await shared_cache.get_page(page_key) is None
+
+    async def test_api_reads_through(
+        self,
+        shared_cache: SharedCache,
+        shared_task: Task,
+        test_client: httpx.AsyncClient,
+    ):
+        task_get = await get_tasks_via_api(test_client, shared_task.key)
+        cache_key = await shared_cache.task_key(shared_task.key)
+        assert await shared_cache.get_task(cache_key) is not None
+        assert compare_models(
+            task_get, await get_tasks_via_api(test_client, shared_task.key)
+        )
+
+        # a write through the API drops the cached task
+        response = await test_client.patch(
+            get_url(f"tasks/{shared_task.key}"), json={"summary": "Shared"}
+        )
+        assert response.status_code == status.HTTP_200_OK
+        assert await shared_cache.task_key(shared_task.key) != cache_key
+        task_get = await get_tasks_via_api(test_client, shared_task.key)
+        assert task_get.summary == "Shared"
+
+    async def test_miss_reads_the_db(
+        self,
+        shared_cache: SharedCache,
+        shared_task: Task,
+        test_database: DataObjectManager,
+        test_client: httpx.AsyncClient,
+    ):
+        task_mgr = test_database.get_object_manager("Task")
+        # this worker's cache holds the task
+        await task_mgr.get_by_key("key", shared_task.key)
+        # another worker changes it and drops it from redis
+        await task_mgr._collection.update_one(
+            {"_id": shared_task.id}, {"$set": {"summary": "Changed elsewhere"}}
+        )
+        await shared_cache.invalidate(shared_task.key)
+        # the miss is filled from the DB, not the stale local copy
+        task_get = await get_tasks_via_api(test_client, shared_task.key)
+        assert task_get.summary == "Changed elsewhere"
+
+    async def test_change_invalidates(
+        self,
+        shared_cache: SharedCache,
+        shared_task: Task,
+        test_database: DataObjectManager,
+    ):
+        task_mgr = test_database.get_object_manager("Task")
+        cache_key = await shared_cache.task_key(shared_task.key)
+        # a write by another process seen by the change feed
+        await task_mgr.apply_change(
+            ChangeEvent(op="update", id=shared_task.id, key=shared_task.key)
+        )
+        assert await shared_cache.task_key(shared_task.key) != cache_key
+        # a streamed delete has no document, every task is dropped
+        cache_key = await shared_cache.task_key(shared_task.key)
+        other_key = await shared_cache.task_key("OTHER-1")
+        await task_mgr.apply_change(ChangeEvent(op="delete", id=shared_task.id))
+        assert await shared_cache.task_key(shared_task.key) != cache_key
+        assert await shared_cache.task_key("OTHER-1") != other_key
+
+
+class TestMetrics:
+    def test_histogram(self):
+        registry = metrics_mod.Metrics(buckets=(0.1, 1))
+        labels = (("op", "get"),)
+        for value in (0.05, 0.5, 5):
+            registry.observe("latency", labels, value)
+        text = metrics_mod.render(registry.snapshot())
+        assert 'latency_bucket{op="get",le="0.1"} 1' in text
+        assert 'latency_bucket{op="get",le="1"} 2' in text
+        assert 'latency_bucket{op="get",le="+Inf"} 3' in text
+        assert 'latency_count{op="get"} 3' in text
+
+    def test_multiprocess(self, tmp_path):
+        labels = (("route", "/tasks"),)
+        for pid in (1, 2):
+            registry = metrics_mod.Metrics()
+            registry.inc("requests", labels)
+            registry.add_gauge("in_flight", (), 1)
+            metrics_mod._write_json(
+                tmp_path / f"metrics_{pid}.json", registry.snapshot()
+            )
+        # an exited worker keeps its counts but not its gauges
+        metrics_mod.mark_process_dead(1, str(tmp_path))
+        merged = metrics_mod.merge_snapshots(metrics_mod.read_snapshots(str(tmp_path)))
+        text = metrics_mod.render(merged)
+        assert 'requests{route="/tasks"} 2' in text
+        assert "in_flight 1" in text
+
+
+@pytest.mark.asyncio
+class TestTracing:
+    async def test_spans(self, test_client: httpx.AsyncClient):
+        exporter = tracing.InMemoryExporter()
+        tracing.tracer.exporters.append(exporter)
+        try:
+            response = await test_client.get(get_url("tasks"), params={"limit": 2})
+        finally:
+            tracing.tracer.exporters.remove(exporter)
+        assert response.status_code == status.HTTP_200_OK
+        timing = response.headers["server-timing"]
+        for category in ("dependency", "crud", "mongo", "app"):
+            assert f"{category};dur=" in timing
+
+        spans = {span.name: span for span in exporter.traces[-1]}
+        root = spans["GET /todoer/api/v1/tasks"]
+        assert root.parent_id is None
+        assert root.attributes["http.status_code"] == 200
+        assert spans["task_filter"].parent_id == root.span_id
+        crud = spans["CRUDTask.filter_page_raw"]
+        assert crud.parent_id == root.span_id
+        assert spans["mongo find"].parent_id == crud.span_id
+        assert spans["mongo find"].attributes["db.mongodb.collection"] == "tasks"
+
+    async def test_otlp_export(self):
+        stream = io.StringIO()
+        tracer = tracing.Tracer([tracing.JsonLinesExporter(stream)])
+        with tracer.trace("GET /test"):
+            with tracer.span("child", "crud", count=2):
+                pass
+        request = json.loads(stream.getvalue())
+        spans = request["resourceSpans"][0]["scopeSpans"][0]["spans"]
+        child, root = spans
+        assert child["parentSpanId"] == root["spanId"]
+        assert child["traceId"] == root["traceId"]
+        assert {"key": "count", "value": {"intValue": "2"}} in child["attributes"]
+        # nothing is recorded outside a trace
+        with tracer.span("orphan") as span:
+            assert span is None
+
+
+@pytest.mark.asyncio
+class TestProfiler:
+    async def test_sampling(self, tmp_path):
+        profiler = Profiler()
+        profiler.set_config(ProfileConfig(mode="sampling", interval_ms=1))
+
+        def busy_request():
+            start = time.perf_counter()
+            while time.perf_counter() - start < 0.1:
+                pass
+
+        profiler.start_request()
+        busy_request()
+        profiler.end_request()
+        # stacks are root first, the busy function is the leaf
+        assert "busy_request (tests/test_todoer_api.py:" in profiler.collapsed()
+        assert "busy_request" in profiler.collapsed(str(tmp_path))
+
+        # another worker's profile being written
+        tmp_file = tmp_path / "profile_999.tmp999"
+        tmp_file.write_text("")
+        profiler.save_config(str(tmp_path), reset=True)
+        assert profiler.collapsed(str(tmp_path)) == ""
+        assert tmp_file.exists()
+        worker = Profiler()
+        worker.load_config(str(tmp_path))
+        assert worker.generation == profiler.generation
+
+
+@pytest.mark.asyncio
+class TestInMemory:
+    @pytest.fixture
+    def inmem_database(self) -> DataObjectManager:
+        return db.database_factory("in-memory-data-obj-mgr")
+
+    async def test_crud(self, inmem_database: DataObjectManager):
+        task_mgr = inmem_database.get_object_manager("Task")
+        tasks = [await task_mgr.add(obj_in=new_test_task(i)) for i in range(5)]
+        other = await task_mgr.add(
+            obj_in=new_test_task().copy(update={"project": "Other", "status": "Done"})
+        )
+        assert other.key == "OTHER-1"
+        assert compare_models(await task_mgr.get_by_key("key", tasks[1].key), tasks[1])
+        assert compare_models(await task_mgr.get(tasks[2].id), tasks[2])
+
+        # pages of a filter in descending key order follow the cursor
+        keys, after = [], None
+        while True:
+            raw_tasks, after = await task_mgr.filter_page_raw(
+                CRUDTask.build_filter(project="Test"),
+                after=after,
+                limit=2,
+                sort_field="key",
+                sort_ascending=False,
+            )
+            keys.extend(raw_task["key"] for raw_task in raw_tasks)
+            if after is None:
+                break
+        assert keys == sorted((task.key for task in tasks), reverse=True)
+
+        task_upd = await task_mgr.update_by_key(
+            "key", tasks[0].key, obj_update=TaskPartialUpdate(status="Done")
+        )
+        assert task_upd.status == "Done"
+        assert task_upd.summary == tasks[0].summary
+        done, _ = await task_mgr.filter_page_raw(
+            CRUDTask.build_filter(status="Done"), projection={"key": True}
+        )
+        assert sorted(raw_task["key"] for raw_task in done) == sorted(
+            [tasks[0].key, other.key]
+        )
+        assert set(done[0]) == {"_id", "key"}
+
+        stats = await task_mgr.stats({})
+        assert stats.total == 6
+        assert stats.by_project == {"Test": 5, "Other": 1}
+        assert stats.by_status == {"New": 4, "Done": 2}
+
+        assert (await task_mgr.delete(id=tasks[4].id)).key == tasks[4].key
+        assert await task_mgr.get_by_key("key", tasks[4].key) is None
+
+        # reused ids collide with the stored keys
+        await task_mgr.id_gen.reset()
+        results = await task_mgr.add_many(objs_in=[new_test_task(), new_test_task()])
+        assert [result.created for result in results] == [False, False]
+        results = await task_mgr.add_many(objs_in=[new_test_task() for _ in range(3)])
+        assert [result.created for result in results] == [False, False, True]
+
+    async def test_trusted_read_copies(self):
+        inmem_database = db.database_factory(
+            "in-memory-data-obj-mgr", trusted_reads=True
+        )
+        task_mgr = inmem_database.get_object_manager("Task")
+        task = await task_mgr.add(obj_in=new_test_task())
+        task_get = await task_mgr.get_by_key("key", task.key)
+        task_get.tags.append("Changed")
+        # the stored document is untouched
+        assert (await task_mgr.get_by_key("key", task.key)).tags == ["Test"]
+
+    async def test_date_cursor(self, inmem_database: DataObjectManager):
+        # the cursor holds a date, it must compare with the stored ones
+        task_mgr = inmem_database.get_object_manager("Task")
+        tasks = [await task_mgr.add(obj_in=new_test_task(i)) for i in range(5)]
+        for sort_field in ("created", "updated"):
+            for ascending in (True, False):
+                keys, after = [], None
+                while True:
+                    raw_tasks, after = await task_mgr.filter_page_raw(
+                        {},
+                        after=after,
+                        limit=2,
+                        sort_field=sort_field,
+                        sort_ascending=ascending,
+                    )
+                    keys.extend(raw_task["key"] for raw_task in raw_tasks)
+                    if after is None:
+                        break
+                in_order = sorted(
+                    tasks,
+                    key=lambda task: (getattr(task, sort_field), task.id),
+                    reverse=not ascending,
+                )
+                assert keys == [task.key for task in in_order], sort_field
+
+    async def test_api(
+        self, test_client: httpx.AsyncClient, inmem_database: DataObjectManager
+    ):
+        async def get_inmem_database():
+            return inmem_database
+
+        test_override = app.dependency_overrides[get_database]
+        app.dependency_overrides[get_database] = get_inmem_database
+        try:
+            response = await test_client.post(
+                get_url("tasks"), json=jsonable_encoder(new_test_task())
+            )
+            assert response.status_code == status.HTTP_201_CREATED
+            task_key = response.json()["key"]
+            response = await test_client.patch(
+                get_url(f"tasks/{task_key}"), json={"summary": "In memory"}
+            )
+            assert response.status_code == status.HTTP_200_OK
+            response = await test_client.get(
+                get_url("tasks"), params={"project": "Test", "sort": "-updated"}
+            )
+            assert response.status_code == status.HTTP_200_OK
+            assert [tsk_json["summary"] for tsk_json in response.json()] == [
+                "In memory"
+            ]
+            response = await test_client.get(get_url("tasks/stats"))
+            assert response.json()["total"] == 1
+        finally:
+            app.dependency_overrides[get_database] = test_override
+
 
 @pytest.mark.asyncio
 class TestTasksGet:
@@ -94,6 +509,209 @@ class TestTasksGet:
             task_init = initial_dict[task_api.key]
             assert compare_models(task_api, task_init)
 
+    async def test_trusted_reads(self, initial_tasks):
+        # models built without validation must be the validated ones
+        databases = [
+            db.database_factory(
+                "mongo-data-obj-mgr",
+                db_name="test_taskdb",
+                id_db_name="test_taskdb_id",
+                trusted_reads=trusted_reads,
+                task_cache_size=0,
+                change_feed=False,
+            )
+            for trusted_reads in (False, True)
+        ]
+        try:
+            reads = []
+            for database in databases:
+                task_mgr = database.get_object_manager("Task")
+                reads.append(
+                    [
+                        await task_mgr.get(initial_tasks[0].id),
+                        await task_mgr.get_by_key("key", initial_tasks[1].key),
+                        *await task_mgr.get_all(sort_field="key"),
+                    ]
+                )
+            validated, trusted = reads
+            assert len(trusted) == len(validated) == len(initial_tasks) + 2
+            for task_trusted, task_validated in zip(trusted, validated):
+                assert compare_models(task_trusted, task_validated)
+                assert task_trusted.json() == task_validated.json()
+        finally:
+            for database in databases:
+                await database.close()
+
+    async def test_init_tasks_get_pages(
+        self, test_client: httpx.AsyncClient, initial_tasks
+    ):
+        # follow the next cursor until the last page which has none
+        keys = []
+        params = {"limit": 2}
+        while True:
+            response = await test_client.get(get_url("tasks"), params=params)
+            assert response.status_code == status.HTTP_200_OK
+            keys.extend(tsk_json["key"] for tsk_json in response.json())
+            next_cursor = response.headers.get("X-Next-Cursor")
+            if next_cursor is None:
+                break
+            params["after"] = next_cursor
+        assert sorted(keys) == sorted(task.key for task in initial_tasks)
+
+    async def test_export(self, test_client: httpx.AsyncClient, initial_tasks):
+        response = await test_client.get(get_url("tasks/export"))
+        assert response.status_code == status.HTTP_200_OK
+        assert response.headers["content-type"] == "application/x-ndjson"
+        initial_dict = {task.key: task for task in initial_tasks}
+        lines = response.text.splitlines()
+        assert len(lines) == len(initial_tasks)
+        for line in lines:
+            task_export = Task.parse_raw(line)
+            assert compare_models(task_export, initial_dict[task_export.key])
+
+        response = await test_client.get(
+            get_url("tasks/export"), params={"project": "No such project"}
+        )
+        assert response.status_code == status.HTTP_200_OK
+        assert response.text == ""
+
+    async def test_get_fields(self, test_client: httpx.AsyncClient, initial_tasks):
+        response = await test_client.get(
+            get_url("tasks"), params={"fields": "summary,status"}
+        )
+        assert response.status_code == status.HTTP_200_OK
+        response_body = response.json()
+        assert len(response_body) == len(initial_tasks)
+        initial_dict = {task.key: task for task in initial_tasks}
+        for tsk_json in response_body:
+            assert set(tsk_json) == {"_id", "key", "summary", "status"}
+            task_init = initial_dict[tsk_json["key"]]
+            assert tsk_json["summary"] == task_init.summary
+
+        response = await test_client.get(
+            get_url("tasks"), params={"fields": "summary,not_a_field"}
+        )
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+    async def test_get_filtered(self, test_client: httpx.AsyncClient, initial_tasks):
+        params_matching = [
+            {"project": "Test"},
+            {"status": "New", "tags": ["Test", "Other"]},
+            {"tags": ["Test"], "tags_match": "all"},
+            {"updated_since": "2000-01-01T00:00:00"},
+        ]
+        for params in params_matching:
+            response = await test_client.get(get_url("tasks"), params=params)
+            assert response.status_code == status.HTTP_200_OK
+            assert len(response.json()) == len(initial_tasks)
+
+        params_none = [
+            {"project": "Other"},
+            {"tags": ["Test", "Other"], "tags_match": "all"},
+        ]
+        for params in params_none:
+            response = await test_client.get(get_url("tasks"), params=params)
+            assert response.status_code == status.HTTP_200_OK
+            assert response.json() == []
+
+    async def test_get_sorted(self, test_client: httpx.AsyncClient, initial_tasks):
+        # descending key order across pages
+        keys = []
+        params = {"sort": "-key", "limit": 2}
+        while True:
+            response = await test_client.get(get_url("tasks"), params=params)
+            assert response.status_code == status.HTTP_200_OK
+            keys.extend(tsk_json["key"] for tsk_json in response.json())
+            if "X-Next-Cursor" not in response.headers:
+                break
+            params["after"] = response.headers["X-Next-Cursor"]
+        assert keys == sorted((task.key for task in initial_tasks), reverse=True)
+
+        response = await test_client.get(get_url("tasks"), params={"sort": "summary"})
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+    async def test_get_filters_use_index(self, test_database: DataObjectManager):
+        filters = [
+            {},
+            CRUDTask.build_filter(project="Test"),
+            CRUDTask.build_filter(status="New"),
+            CRUDTask.build_filter(project="Test", status="New"),
+            CRUDTask.build_filter(tags=["Test"]),
+            CRUDTask.build_filter(tags=["Test", "Other"], tags_match="all"),
+            CRUDTask.build_filter(updated_since=dt.datetime(2000, 1, 1)),
+            CRUDTask.build_filter(
+                project="Test", updated_since=dt.datetime(2000, 1, 1)
+            ),
+        ]
+        task_mgr: CRUDTask = test_database.get_object_manager("Task")
+        collection = task_mgr.db_collection.get_collection()
+        for filter in filters:
+            for sort_field in CRUDTask.SORT_FIELDS:
+                for ascending in (True, False):
+                    spec = sort_spec(
+                        sort_field,
+                        ascending,
+                        unique=sort_field in CRUDTask.UNIQUE_FIELDS,
+                    )
+                    plan = await collection.find(filter).sort(spec).limit(11).explain()
+                    winning_plan = json.dumps(plan["queryPlanner"]["winningPlan"])
+                    assert "COLLSCAN" not in winning_plan, (filter, spec)
+
+        # filters and sorts only one index can serve
+        expected = [
+            (CRUDTask.build_filter(project="Test"), None, "project_status_updated"),
+            (CRUDTask.build_filter(status="New"), None, "status_updated"),
+            (CRUDTask.build_filter(tags=["Test"]), None, "tags_updated"),
+            (
+                CRUDTask.build_filter(updated_since=dt.datetime(2000, 1, 1)),
+                None,
+                "updated_id",
+            ),
+            ({}, "_id", "_id_"),
+            ({}, "key", "key_unique"),
+            ({}, "created", "created_id"),
+            ({}, "updated", "updated_id"),
+        ]
+        for filter, sort_field, index_name in expected:
+            cursor = collection.find(filter).limit(11)
+            if sort_field is not None:
+                unique = sort_field in CRUDTask.UNIQUE_FIELDS
+                cursor = cursor.sort(sort_spec(sort_field, False, unique=unique))
+            plan = await cursor.explain()
+            winning_plan = json.dumps(plan["queryPlanner"]["winningPlan"])
+            index_names = set(re.findall(r'"indexName": "([^"]+)"', winning_plan))
+            assert index_names == {index_name}, (filter, sort_field)
+
+    async def test_get_stats(self, test_client: httpx.AsyncClient, initial_tasks):
+        response = await test_client.get(get_url("tasks/stats"))
+        assert response.status_code == status.HTTP_200_OK
+        stats = response.json()
+        num_tasks = len(initial_tasks)
+        assert stats["total"] == num_tasks
+        assert stats["by_project"] == {"Test": num_tasks}
+        assert stats["by_status"] == {"New": num_tasks}
+        assert stats["by_tag"] == {"Test": num_tasks}
+        assert sum(bucket["count"] for bucket in stats["created"]) == num_tasks
+        assert sum(bucket["count"] for bucket in stats["updated"]) == num_tasks
+
+        response = await test_client.get(
+            get_url("tasks/stats"), params={"project": "Other", "interval": "month"}
+        )
+        assert response.status_code == status.HTTP_200_OK
+        stats = response.json()
+        assert stats["total"] == 0
+        assert stats["by_project"] == {}
+        assert stats["created"] == []
+
+        response = await test_client.get(
+            get_url("tasks/stats"), params={"interval": "decade"}
+        )
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+    async def test_get_bad_cursor(self, test_client: httpx.AsyncClient):
+        response = await test_client.get(get_url("tasks"), params={"after": "bad"})
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
     async def test_init_tasks_get(self, test_client: httpx.AsyncClient, initial_tasks):
         for task_orig in initial_tasks:
             task_key = task_orig.key
@@ -123,6 +741,27 @@ class TestTasksModify:
         response = await test_client.delete(get_url(f"tasks/{task.key}"))
         assert response.status_code == status.HTTP_204_NO_CONTENT
 
+    async def test_task_add_batch(self, test_client: httpx.AsyncClient):
+        # add tasks in a batch across 2 projects
+        tasks_in = [new_test_task(i, desc="batch task") for i in range(3)]
+        tasks_in[2].project = "Batch"
+        pay_load = jsonable_encoder(tasks_in)
+        response = await test_client.post(get_url("tasks:batch"), json=pay_load)
+        assert response.status_code == status.HTTP_201_CREATED
+
+        # each result in request order and each task readable via the API
+        response_body = response.json()
+        assert [rslt["index"] for rslt in response_body] == [0, 1, 2]
+        assert all(rslt["created"] for rslt in response_body)
+        seqs = [rslt["task"]["seq"] for rslt in response_body[:2]]
+        assert seqs[1] == seqs[0] + 1
+        for rslt in response_body:
+            task = Task(**rslt["task"])
+            task_get = await get_tasks_via_api(test_client, task.key)
+            assert compare_models(task, task_get)
+            response = await test_client.delete(get_url(f"tasks/{task.key}"))
+            assert response.status_code == status.HTTP_204_NO_CONTENT
+
     async def test_task_add_bad_task(self, test_client: httpx.AsyncClient):
         bad_task_in = {"project bad name": "this wont work"}
         response = await test_client.post(get_url("tasks"), json=bad_task_in)
@@ -177,6 +816,42 @@ class TestTasksModify:
         task_revert_db = await task_mgr.get_by_key("key", task_orig.key)
         assert compare_models(task_revert_db, task_revert_rsp)
 
+    async def test_task_patch(
+        self,
+        test_client: httpx.AsyncClient,
+        initial_tasks,
+        test_database: DataObjectManager,
+    ):
+        task_orig = initial_tasks[1]
+        response = await test_client.patch(
+            get_url(f"tasks/{task_orig.key}"), json={"status": "Patched"}
+        )
+        assert response.status_code == status.HTTP_200_OK
+        task_patch_rsp = Task(**(response.json()))
+
+        # only status and updated change
+        assert task_patch_rsp.status == "Patched"
+        assert task_patch_rsp.updated > task_orig.updated
+        unchanged = {"status", "updated"}
+        assert task_patch_rsp.dict(exclude=unchanged) == task_orig.dict(
+            exclude=unchanged
+        )
+        task_mgr: CRUDMongoBase = test_database.get_object_manager("Task")
+        task_db = await task_mgr.get_by_key("key", task_orig.key)
+        assert compare_models(task_db, task_patch_rsp)
+
+        # revert
+        response = await test_client.patch(
+            get_url(f"tasks/{task_orig.key}"), json={"status": task_orig.status}
+        )
+        assert response.status_code == status.HTTP_200_OK
+
+    async def test_task_patch_bad_id(self, test_client: httpx.AsyncClient):
+        response = await test_client.patch(
+            get_url(f"tasks/{self.BAD_KEY}"), json={"status": "Patched"}
+        )
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
     async def test_task_update_bad_id(
         self, test_client: httpx.AsyncClient, initial_tasks
     ):
@@ -202,3 +877,215 @@ class TestTasksModify:
             get_url(f"tasks/{task_orig.key}"), json=bad_task_in
         )
         assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+    async def test_local_return_mode(self, test_database: DataObjectManager):
+        local_database = db.database_factory(
+            "mongo-data-obj-mgr",
+            db_name="test_taskdb",
+            id_db_name="test_taskdb_id",
+            return_mode="local",
+            change_feed=False,
+        )
+        local_mgr = local_database.get_object_manager("Task")
+        server_mgr = test_database.get_object_manager("Task")
+
+        async def stored(task: Task) -> Task:
+            # what server mode returns, the document as stored
+            server_mgr.invalidate(task.id)
+            return await server_mgr.get(task.id)
+
+        try:
+            task_add = await local_mgr.add(obj_in=new_test_task(desc="local mode"))
+            assert compare_models(task_add, await stored(task_add))
+            task_upd = await local_mgr.update(
+                obj_original=task_add.copy(), obj_update={"status": "Local"}
+            )
+            assert task_upd.status == "Local"
+            assert compare_models(task_upd, await stored(task_upd))
+            task_del = await local_mgr.delete(id=task_add.id)
+            assert compare_models(task_del, task_upd)
+            assert await stored(task_add) is None
+        finally:
+            await local_database.close()
+
+
+@pytest.mark.asyncio
+class TestIdGenerator:
+    async def test_leased_ids(self, test_database: DataObjectManager):
+        id_collection = test_database.id_gen.collection
+        id_gen = TaskIdGeneratorMongoLeased(id_collection, block_size=10)
+        # concurrent requests span several blocks without duplicates or gaps
+        ids = await asyncio.gather(*[id_gen.get_next_id("Lease") for _ in range(25)])
+        assert sorted(ids) == list(range(1, 26))
+        first_id = await id_gen.get_next_ids("Lease", 3)
+        assert first_id == 26
+
+        # closing returns the rest of the last block to the counter
+        await id_gen.close()
+        counter = await id_collection.get_collection().find_one({"index": "Lease"})
+        assert counter["next_id"] == 28
+
+
+@pytest.mark.asyncio
+class TestAdmin:
+    async def test_cache_invalidated_on_patch(
+        self, test_client: httpx.AsyncClient, test_database: DataObjectManager
+    ):
+        async def cache_counts():
+            response = await test_client.get("/admin/v1/cache")
+            assert response.status_code == status.HTTP_200_OK
+            stats = next(c for c in response.json() if c["name"] == "task")
+            return stats["misses"], stats["hits"]
+
+        # a task of its own so no other test sees the patch
+        task_mgr = test_database.get_object_manager("Task")
+        task = await task_mgr.add(obj_in=new_test_task(desc="Cache"))
+        try:
+            misses, hits = await cache_counts()
+            # a miss fills the cache then a hit
+            await get_tasks_via_api(test_client, task.key)
+            await get_tasks_via_api(test_client, task.key)
+            assert await cache_counts() == (misses + 1, hits + 1)
+
+            response = await test_client.patch(
+                get_url(f"tasks/{task.key}"), json={"summary": "Cached"}
+            )
+            assert response.status_code == status.HTTP_200_OK
+            # the patch dropped the entry, a miss reads the patched task
+            task_get = await get_tasks_via_api(test_client, task.key)
+            assert task_get.summary == "Cached"
+            assert await cache_counts() == (misses + 2, hits + 1)
+            await get_tasks_via_api(test_client, task.key)
+            assert await cache_counts() == (misses + 2, hits + 2)
+        finally:
+            await task_mgr.delete(id=task.id)
+
+    async def test_pool_stats(self, test_client: httpx.AsyncClient):
+        await test_client.get(get_url("tasks"))
+        response = await test_client.get("/admin/v1/pool")
+        assert response.status_code == status.HTTP_200_OK
+        response_body = response.json()
+        assert response_body["pools"] > 0
+        assert response_body["checkouts"] > 0
+
+    async def test_metrics(self, test_client: httpx.AsyncClient, initial_tasks):
+        task_orig = initial_tasks[0]
+        await get_tasks_via_api(test_client, task_orig.key)
+        response = await test_client.get("/admin/v1/metrics")
+        assert response.status_code == status.HTTP_200_OK
+        assert response.headers["content-type"].startswith("text/plain")
+        text = response.text
+        assert (
+            'todoer_http_requests_total{method="GET",'
+            'route="/todoer/api/v1/tasks/{task_key}",status="200"}'
+        ) in text
+        assert "todoer_http_request_duration_seconds_bucket" in text
+        assert 'todoer_http_requests_in_flight{method="GET"} 1' in text
+        assert 'todoer_db_op_duration_seconds_count{model="CRUDTask"' in text
+
+    async def test_slow_ops(
+        self, test_client: httpx.AsyncClient, test_database: DataObjectManager
+    ):
+        task_mgr = test_database.get_object_manager("Task")
+        slow_ops_orig = test_database.slow_ops
+        # every operation is slow with a threshold of 0
+        task_mgr.slow_ops = test_database.slow_ops = SlowOpLog(0, explain=True)
+        try:
+            response = await test_client.get(
+                get_url("tasks"), params={"project": "Test", "limit": 2}
+            )
+            assert response.status_code == status.HTTP_200_OK
+            # description has no index
+            await task_mgr.filter_multi({"description": "Initial Test Task"}, limit=1)
+            await task_mgr.slow_ops.wait_explained()
+            response = await test_client.get("/admin/v1/slow-ops")
+        finally:
+            task_mgr.slow_ops = test_database.slow_ops = slow_ops_orig
+        assert response.status_code == status.HTTP_200_OK
+        page_op, scan_op = response.json()
+        assert page_op["op"] == "find"
+        assert page_op["filter"] == {"project": "?"}
+        assert page_op["limit"] == 2
+        assert 0 < page_op["docs"] <= 3
+        assert page_op["collscan"] is False
+        assert page_op["indexes"]
+        assert scan_op["filter"] == {"description": "?"}
+        assert scan_op["collscan"] is True
+
+    async def test_profile(self, test_client: httpx.AsyncClient):
+        config = {"header": True, "mode": "cprofile"}
+        response = await test_client.put("/admin/v1/profile/config", json=config)
+        assert response.status_code == status.HTTP_200_OK
+        try:
+            response = await test_client.get(
+                get_url("tasks"), headers={"X-Profile": "1"}
+            )
+            assert response.status_code == status.HTTP_200_OK
+            response = await test_client.get(
+                "/admin/v1/profile", params={"format": "pstats"}
+            )
+            assert response.status_code == status.HTTP_200_OK
+            assert "get_tasks" in response.text
+        finally:
+            await test_client.delete("/admin/v1/profile")
+            await test_client.put("/admin/v1/profile/config", json={})
+        response = await test_client.get("/admin/v1/profile/config")
+        assert response.json()["header"] is False
+
+    async def test_indexes(self, test_client: httpx.AsyncClient):
+        response = await test_client.get("/admin/v1/indexes")
+        assert response.status_code == status.HTTP_200_OK
+        response_body = response.json()
+        assert len(response_body) > 0
+        for report in response_body:
+            assert report["missing"] == []
+            assert report["extra"] == []
+
+
+@pytest.mark.asyncio
+class TestChangeFeed:
+    async def test_events_unavailable(self, test_client: httpx.AsyncClient):
+        # the test database feed is never started
+        response = await test_client.get(get_url("tasks/events"))
+        assert response.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+
+    async def test_feed_invalidates_cache(
+        self, test_database: DataObjectManager, initial_tasks
+    ):
+        task_mgr = test_database.get_object_manager("Task")
+        token_collection = MongoCollection(
+            test_database.collection.get_connection(), "test_taskdb_id", "change_feed"
+        )
+        change_feed = ChangeFeed(
+            test_database.collection, token_collection, name="test", poll_interval=0.05
+        )
+        position_filter = {"_id": change_feed.position_id}
+        await token_collection.get_collection().delete_one(position_filter)
+        change_feed.add_handler(task_mgr.apply_change)
+        queue = change_feed.subscribe()
+        task_orig = initial_tasks[1]
+        change_feed.start()
+        try:
+            await task_mgr.get_by_key("key", task_orig.key)
+            # let the stream open or the first poll run before writing
+            await asyncio.sleep(0.5)
+            # write as another process would, the local cache knows nothing of it
+            await task_mgr._collection.update_one(
+                {"_id": task_orig.id},
+                {"$set": {"summary": "Changed elsewhere", "updated": now_ms()}},
+            )
+            event = await asyncio.wait_for(queue.get(), timeout=5)
+            assert event.key == task_orig.key
+            assert event.op in ("update", "replace")
+            task_get = await task_mgr.get_by_key("key", task_orig.key)
+            assert task_get.summary == "Changed elsewhere"
+        finally:
+            await change_feed.stop()
+            await task_mgr._collection.update_one(
+                {"_id": task_orig.id}, {"$set": {"summary": task_orig.summary}}
+            )
+            task_mgr.invalidate(task_orig.id)
+        saved = await token_collection.get_collection().find_one(position_filter)
+        assert saved["position"]
+        assert saved["feed"] == "test"
+        await token_collection.get_collection().delete_one(position_filter)